@@ -1,6 +1,6 @@
 import os
 from flask import Flask, jsonify, g
-from flask.ext.sqlalchemy import SQLAlchemy
+from .database import SQLAlchemy
 from .decorators import no_cache, json, rate_limit
 
 db = SQLAlchemy()
@@ -15,11 +15,29 @@ def create_app(config_name):
 
 	# initialize extensions
 	db.init_app(app)
+	from .auth import init_app as init_auth
+	init_auth(app)
+	from .cache import init_app as init_cache
+	init_cache(app)
+	# compression is installed first so that its handler runs last
+	from .compression import init_app as init_compression
+	init_compression(app)
+	from .group_commit import init_app as init_group_commit
+	init_group_commit(app)
+
+	# keep the aggregate tables, the change log and the search indexes up
+	# to date on every write
+	from . import summaries, changes, search
 
 	# register blueprints
 	from .api_v1 import api as api_blueprint
 	app.register_blueprint(api_blueprint, url_prefix='/api/v1')
 
+	# optional request profiling, installed after the blueprint so that it
+	# can tell when authentication is complete
+	from .profiling import init_app as init_profiling
+	init_profiling(app)
+
 	# register an after request handler
 	@app.after_request
 	def after_request(rv):
@@ -5,10 +5,11 @@ from ..decorators import etag, rate_limit
 api = Blueprint('api', __name__)
 
 @api.before_request
-# @rate_limit(5, 15)
+@rate_limit()
 @auth_token.login_required
 def before_request():
-	"""All routes in this blueprint require authentication"""
+	"""All routes in this blueprint require authentication, and are rate
+	limited per client when RATELIMIT_REQUESTS is set"""
 	pass
 
 @api.after_request
@@ -17,4 +18,5 @@ def after_request(rv):
 	"""Generate an Etag header for all routes in this blueprint."""
 	return rv
 
-from . import customers, products, orders, items, errors
+from . import customers, products, orders, items, changes, batch, stats, \
+	errors
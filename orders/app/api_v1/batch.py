@@ -0,0 +1,141 @@
+from flask import request, current_app
+from flask.globals import _app_ctx_stack
+from werkzeug.exceptions import NotFound
+from werkzeug.urls import url_parse
+from . import api
+from .. import db
+from ..decorators.json import get_serializer
+from ..exceptions import ValidationError
+
+_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+_SKIPPED_HEADERS = ('Content-Length', 'Content-Type')
+
+@api.route('/batch', methods=['POST'])
+def batch():
+	"""Run a list of api requests in one round trip.
+
+	The body is a list of {"method", "path", "body", "headers"} objects, or
+	an object with that list in "requests" and "transaction": true to run
+	all of them in a single database transaction, which is rolled back if
+	any of them fails. Sub-requests are dispatched in order, as the client
+	of the batch, and share its database session.
+	The response has the status, the headers and the body of each of them
+	in "responses"."""
+	data = request.json
+	transaction = False
+	if isinstance(data, dict):
+		transaction = data.get('transaction', False) is True
+		data = data.get('requests')
+	requests = parse_batch(data)
+
+	dumps = get_serializer().dumps
+	responses = []
+	failed = False
+	for method, path, body, headers in requests:
+		if transaction:
+			# the commits of the views only end their subtransaction
+			subtransaction = db.session.begin(subtransactions=True)
+		rv = dispatch(method, path, body, headers, transaction)
+		if rv.status_code >= 400:
+			# discard what the failed view left in the session; a rollback
+			# closes one subtransaction at a time, up to the real one
+			session = db.session()
+			session.rollback()
+			while not session.is_active:
+				session.rollback()
+			failed = transaction
+		elif transaction and db.session().transaction is subtransaction:
+			# views that do not write leave their subtransaction open
+			db.session.commit()
+		responses.append(b'{"status":' + str(rv.status_code).encode('ascii') +
+			b',"headers":' + dumps(dict((k, v) for k, v in rv.headers
+				if k not in _SKIPPED_HEADERS)) +
+			b',"body":' + response_body(rv, dumps) + b'}')
+		if failed:
+			break
+	if transaction and not failed:
+		db.session.commit()
+
+	rv = b'{"responses":[' + b','.join(responses) + b']'
+	if transaction:
+		rv += b',"committed":' + (b'false' if failed else b'true')
+	return current_app.response_class(rv + b'}', mimetype='application/json')
+
+def parse_batch(data):
+	"""Validate the sub-requests of a batch. Returns (method, path, body,
+	headers) tuples."""
+	if not isinstance(data, list):
+		raise ValidationError('Invalid batch: expected a list of requests')
+	limit = current_app.config.get('BATCH_MAX_REQUESTS', 50)
+	if len(data) > limit:
+		raise ValidationError('Invalid batch: more than {0} requests'.format(
+			limit))
+	requests = []
+	errors = []
+	for i, entry in enumerate(data):
+		if not isinstance(entry, dict) or \
+				not isinstance(entry.get('path'), str):
+			errors.append('requests[{0}]: missing path'.format(i))
+			continue
+		method = str(entry.get('method', 'GET')).upper()
+		if method not in _METHODS:
+			errors.append('requests[{0}]: invalid method {1}'.format(i, method))
+			continue
+		headers = entry.get('headers') or {}
+		if not isinstance(headers, dict):
+			errors.append('requests[{0}]: invalid headers'.format(i))
+			continue
+		requests.append((method, entry['path'], entry.get('body'), headers))
+	if errors:
+		raise ValidationError('Invalid batch', errors)
+	return requests
+
+def dispatch(method, path, body, headers, transaction=False):
+	"""Dispatch a sub-request to its view in the api blueprint and return
+	the response. Sub-requests go through the request handlers, which
+	authenticate them with the credentials of the batch, and each of them
+	gets a g of its own. They share the database session of the batch
+	request, which is what lets a transaction span them; the writes of
+	sub-requests in a transaction are not group committed."""
+	data = None
+	if body is not None:
+		data = get_serializer().dumps(body)
+	headers = dict(headers)
+	if 'Authorization' in request.headers:
+		headers.setdefault('Authorization', request.headers['Authorization'])
+	# paths can be the absolute URLs that the api returns
+	url = url_parse(path)
+	path = url.path + ('?' + url.query if url.query else '')
+	ctx = current_app.test_request_context(path, base_url=request.host_url,
+		method=method, data=data, content_type='application/json',
+		headers=headers, environ_overrides={
+			'REMOTE_ADDR': request.remote_addr,
+			'orders.transaction': transaction})
+	app_ctx = _app_ctx_stack.top
+	batch_g, app_ctx.g = app_ctx.g, current_app.app_ctx_globals_class()
+	try:
+		with ctx:
+			try:
+				if request.routing_exception is None:
+					if request.blueprint != 'api':
+						raise NotFound()
+					if request.endpoint == 'api.batch':
+						raise ValidationError('Invalid batch: batches cannot be nested')
+			except Exception as e:
+				rv = current_app.make_response(
+					current_app.handle_user_exception(e))
+			else:
+				rv = current_app.full_dispatch_request()
+			# consume streamed bodies while their request context is active
+			rv.get_data()
+	finally:
+		app_ctx.g = batch_g
+	return rv
+
+def response_body(rv, dumps):
+	data = rv.get_data()
+	if not data:
+		return b'null'
+	if rv.mimetype == 'application/json':
+		return data
+	return dumps(data.decode('utf-8'))
@@ -0,0 +1,9 @@
+from . import api
+from ..changes import feed
+from ..decorators import json
+
+@api.route('/changes', methods=['GET'])
+@json
+def get_changes():
+	"""Changes to all the resources after the ?since= cursor, oldest first."""
+	return feed('changes')
@@ -1,21 +1,27 @@
 from flask import request
 from . import api
 from .. import db
-from ..models import Customer
-from ..decorators import json, paginate
+from ..filters import filter_names
+from ..includes import export_resource
+from ..models import Customer, CustomerSummary
+from ..decorators import json, paginate, versioned, cached, group_commit
 
 @api.route('/customers/', methods=['GET'])
+@cached(Customer)
 @json
 @paginate('customers')
 def get_customers():
-	return Customer.query
+	return filter_names(Customer.query, Customer)
 
 @api.route('/customers/<int:id>', methods=['GET'])
+@cached(Customer)
+@versioned(Customer)
 @json
 def get_customer(id):
-	return Customer.query.get_or_404(id)
+	return export_resource(Customer, id)
 
 @api.route('/customers/', methods=['POST'])
+@group_commit
 @json
 def new_customer():
 	customer = Customer()
@@ -25,6 +31,7 @@ def new_customer():
 	return {}, 201, {'Location': customer.get_url()}
 
 @api.route('/customers/<int:id>', methods=['PUT'])
+@group_commit
 @json
 def edit_customer(id):
 	customer = Customer.query.get_or_404(id)
@@ -32,3 +39,10 @@ def edit_customer(id):
 	db.session.add(customer)
 	db.session.commit()
 	return {}
+
+@api.route('/customers/<int:id>/summary', methods=['GET'])
+@cached(Customer, CustomerSummary)
+@json
+def get_customer_summary(id):
+	Customer.query.get_or_404(id)
+	return CustomerSummary.get_or_empty(id)
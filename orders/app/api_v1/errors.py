@@ -4,8 +4,11 @@ from . import api
 
 @api.errorhandler(ValidationError)
 def bad_request(e):
-	response = jsonify({'status': 400, 'error': 'bad request',
-		'message': e.args[0]})
+	rv = {'status': 400, 'error': 'bad request', 'message': e.args[0]}
+	if len(e.args) > 1:
+		# bulk requests report the problems of every entry together
+		rv['errors'] = e.args[1]
+	response = jsonify(rv)
 	response.status_code = 400
 	return response
 
@@ -1,25 +1,38 @@
 from flask import request
 from . import api
 from .. import db
+from ..filters import filter_items
+from ..includes import export_resource
 from ..models import Order, Item
-from ..decorators import json, paginate
+from ..utils import fast_url_for
+from ..decorators import json, paginate, versioned, cached, group_commit
 
 @api.route('/orders/<int:id>/items/', methods=['GET'])
+@cached(Order, Item)
 @json
 @paginate('items')
 def get_order_items(id):
 	order = Order.query.get_or_404(id)
-	return order.items
+	return filter_items(order.items)
 
 @api.route('/items/<int:id>', methods=['GET'])
+@cached(Item)
+@versioned(Item)
 @json
 def get_item(id):
-	return Item.query.get_or_404(id).export_data()
+	return export_resource(Item, id)
 
 @api.route('/orders/<int:id>/items/', methods=['POST'])
+@group_commit
 @json
 def new_order_item(id):
 	order = Order.query.get_or_404(id)
+	if isinstance(request.json, list):
+		# bulk creation, all the items are added in a single transaction
+		ids = Item.insert_many(order.id, Item.import_many(request.json))
+		db.session.commit()
+		return {'items': [fast_url_for('api.get_item', id=item_id)
+			for item_id in ids]}, 201
 	item = Item(order=order)
 	item.import_data(request.json)
 	db.session.add(item)
@@ -27,6 +40,7 @@ def new_order_item(id):
 	return {}, 201, {'Location': item.get_url()}
 
 @api.route('/items/<int:id>', methods=['PUT'])
+@group_commit
 @json
 def edit_item(id):
 	item = Item.query.get_or_404(id)
@@ -36,6 +50,7 @@ def edit_item(id):
 	return {}
 
 @api.route('/items/<int:id>', methods=['DELETE'])
+@group_commit
 @json
 def delete_item(id):
 	item = Item.query.get_or_404(id)
@@ -1,38 +1,93 @@
 from flask import request
 from . import api
 from .. import db
-from ..models import Order, Customer
-from ..decorators import json, paginate
+from ..includes import export_resource
+from ..exceptions import ValidationError
+from ..filters import filter_orders
+from ..models import Order, Customer, Item, OrderTotals
+from ..decorators import json, paginate, versioned, cached, group_commit
 
 @api.route('/orders/', methods=['GET'])
+@cached(Order)
 @json
-@paginate('orders')
+@paginate('orders', keyset=('date', 'id'))
 def get_orders():
-	return Order.query
+	return filter_orders(Order.query)
 
 @api.route('/orders/<int:id>', methods=['GET'])
+@cached(Order)
+@versioned(Order)
 @json
 def get_order(id):
-	return Order.query.get_or_404(id).export_data()
+	return export_resource(Order, id)
+
+@api.route('/orders/<int:id>/totals', methods=['GET'])
+@cached(Order, OrderTotals)
+@json
+def get_order_totals(id):
+	Order.query.get_or_404(id)
+	return OrderTotals.get_or_empty(id)
 
 @api.route('/customers/<int:id>/orders/', methods=['GET'])
+@cached(Customer, Order)
 @json
+@paginate('orders', keyset=('date', 'id'), cursor_only=True)
 def get_customer_orders(id):
 	customer = Customer.query.get_or_404(id)
-	return {'orders': [order.get_url() for order in
-		customer.orders.all()]}
+	return filter_orders(customer.orders)
 
 @api.route('/customers/<int:id>/orders/', methods=['POST'])
+@group_commit
 @json
 def new_customer_order(id):
 	customer = Customer.query.get_or_404(id)
-	order = Order(customer=customer)
-	order.import_data(request.json)
-	db.session.add(order)
+	if isinstance(request.json, list):
+		# bulk creation, all the orders are added in a single transaction
+		orders = import_orders(customer, request.json)
+		db.session.commit()
+		return {'orders': [order.get_url() for order in orders]}, 201
+	if isinstance(request.json, dict) and 'items' in request.json:
+		order = import_orders(customer, [request.json], prefix='')[0]
+	else:
+		order = Order(customer=customer)
+		order.import_data(request.json)
+		db.session.add(order)
 	db.session.commit()
 	return {}, 201, {'Location': order.get_url()}
 
+def import_orders(customer, data, prefix='orders[{0}].'):
+	"""Validate and add a list of orders with their nested items, reporting
+	the problems with all of them together."""
+	valid = []
+	errors = []
+	for i, entry in enumerate(data):
+		if not isinstance(entry, dict):
+			errors.append(prefix.format(i) + 'Invalid order: expected an object')
+			continue
+		order = Order(customer=customer)
+		rows = []
+		try:
+			order.import_data(entry)
+		except ValidationError as e:
+			errors.append(prefix.format(i) + e.args[0])
+		try:
+			rows = Item.import_many(entry.get('items', []))
+		except ValidationError as e:
+			errors.extend(prefix.format(i) + error
+				for error in (e.args[1] if len(e.args) > 1 else e.args[:1]))
+		valid.append((order, rows))
+	if errors:
+		raise ValidationError('Invalid orders', errors)
+	orders = []
+	for order, rows in valid:
+		db.session.add(order)
+		db.session.flush()
+		Item.insert_many(order.id, rows)
+		orders.append(order)
+	return orders
+
 @api.route('/orders/<int:id>', methods=['PUT'])
+@group_commit
 @json
 def edit_order(id):
 	order = Order.query.get_or_404(id)
@@ -42,6 +97,7 @@ def edit_order(id):
 	return {}
 
 @api.route('/orders/<int:id>', methods=['DELETE'])
+@group_commit
 @json
 def delete_order(id):
 	order = Order.query.get_or_404(id)
@@ -1,21 +1,28 @@
 from flask import request
 from . import api
 from .. import db
-from ..models import Product
-from ..decorators import json, paginate
+from ..filters import filter_names
+from ..models import Product, ProductSales
+from ..decorators import json, paginate, versioned, cached, group_commit
 
 @api.route('/products/', methods=['GET'])
+@cached(Product)
 @json
 @paginate('products')
 def get_products():
-	return Product.query
+	return filter_names(Product.query, Product)
 
 @api.route('/products/<int:id>', methods=['GET'])
+@cached(Product)
+@versioned(Product)
 @json
 def get_product(id):
-	return Product.query.get_or_404(id).export_data()
+	fields = Product.requested_fields()
+	return Product.load_fields(Product.query, fields).get_or_404(id) \
+		.export_data(fields)
 
 @api.route('/products/', methods=['POST'])
+@group_commit
 @json
 def new_product():
 	product = Product()
@@ -25,6 +32,7 @@ def new_product():
 	return {}, 201, {'Location': product.get_url()}
 
 @api.route('/products/<int:id>', methods=['PUT'])
+@group_commit
 @json
 def edit_product(id):
 	product = Product.query.get_or_404(id)
@@ -32,3 +40,10 @@ def edit_product(id):
 	db.session.add(product)
 	db.session.commit()
 	return {}
+
+@api.route('/products/<int:id>/sales', methods=['GET'])
+@cached(Product, ProductSales)
+@json
+def get_product_sales(id):
+	Product.query.get_or_404(id)
+	return ProductSales.get_or_empty(id)
@@ -0,0 +1,15 @@
+from flask import current_app
+from . import api
+from ..decorators import json
+
+@api.route('/_stats', methods=['GET'])
+@json
+def get_stats():
+	stats = {}
+	cache = current_app.extensions.get('response_cache')
+	if cache is not None:
+		stats['response_cache'] = cache.stats()
+	profiling = current_app.extensions.get('profiling')
+	if profiling is not None:
+		stats['requests'] = profiling.export_data()
+	return stats
@@ -0,0 +1,459 @@
+"""Serving the application from an asyncio event loop.
+
+WsgiToAsgi exposes the Flask application as an ASGI application. Requests
+are parsed and responses are written on the event loop, while the view
+functions, which block on SQLAlchemy, run in a bounded thread pool. Slow
+clients and idle keep-alive connections therefore cost a coroutine instead
+of a thread.
+
+serve() runs it with a small HTTP/1.1 server built on asyncio streams, in
+one or more worker processes sharing the listening socket, and drains the
+requests in progress before exiting on SIGTERM or SIGINT. The server bounds
+the size of the requests it reads and how long it waits for them, and
+answers `Expect: 100-continue` before reading a body. The adapter also works
+with any other ASGI server.
+"""
+import asyncio
+import io
+import os
+import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses
+from urllib.parse import unquote
+
+_END = object()
+_STATUS_LINE = 'HTTP/1.1 {0} {1}\r\n'
+_current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+class _Disconnected(Exception):
+    """Raised in the worker thread when the client of a response is gone."""
+
+
+class _BadRequest(Exception):
+    """Raised by HTTPServer for requests it refuses to read."""
+    def __init__(self, status):
+        super(_BadRequest, self).__init__(status)
+        self.status = status
+
+
+class WsgiToAsgi(object):
+    """ASGI application that runs a WSGI application in a thread pool."""
+    def __init__(self, wsgi_app, threads=8, multiprocess=False):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads)
+        self.multiprocess = multiprocess
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=True)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: ' + scope['type'])
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = self.environ(scope, b''.join(body))
+
+        # the response is passed from the worker thread to the event loop
+        # through a small queue, so streamed bodies are not buffered whole
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=8)
+        disconnected = threading.Event()
+        future = loop.run_in_executor(self.executor, self.run_wsgi, environ,
+                                      loop, queue, disconnected)
+        started = False
+        try:
+            while True:
+                message = await queue.get()
+                if message is _END:
+                    break
+                started = started or message['type'] == 'http.response.start'
+                await send(message)
+        except BaseException:
+            # the client is gone or the request was cancelled: the worker
+            # stops at its next message, and the ones it already queued are
+            # discarded so that it is not left waiting for room in the queue
+            disconnected.set()
+            while not queue.empty():
+                queue.get_nowait()
+            raise
+        try:
+            await future
+        except Exception:
+            if started:
+                raise
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def environ(self, scope, body):
+        """Build the WSGI environment for an ASGI HTTP scope."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                continue
+            else:
+                key = 'HTTP_' + name
+                if key in environ:
+                    value = environ[key] + ',' + value
+                environ[key] = value
+        return environ
+
+    def run_wsgi(self, environ, loop, queue, disconnected):
+        """Run the WSGI application in a worker thread, handing the response
+        messages over to the event loop until `disconnected` is set."""
+        def put(message):
+            if disconnected.is_set():
+                raise _Disconnected()
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'),
+                                    value.encode('latin-1'))
+                                   for name, value in headers]
+            return lambda data: send_body(data)
+
+        def send_body(data):
+            if not response.get('sent'):
+                put({'type': 'http.response.start',
+                     'status': response['status'],
+                     'headers': response['headers']})
+                response['sent'] = True
+            if data:
+                put({'type': 'http.response.body', 'body': data,
+                     'more_body': True})
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for data in result:
+                    if data:
+                        send_body(data)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            send_body(b'')
+            put(_END)
+        except _Disconnected:
+            pass
+        except BaseException:
+            if not disconnected.is_set():
+                put(_END)
+            raise
+
+
+class _Connection(object):
+    """State of a client connection handled by HTTPServer."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.idle = True
+        self.started = False
+
+
+class HTTPServer(object):
+    """Minimal HTTP/1.1 server that drives an ASGI application, with
+    keep-alive connections and graceful shutdown.
+
+    Requests with a line longer than `max_header_size` bytes, more than
+    `max_headers` headers or a body over `max_body_size` bytes are refused,
+    and connections that send nothing for `read_timeout` seconds, idle ones
+    included, are closed. When the application fails, the client gets a 500
+    if its response has not started, and the connection is closed in any
+    case, so that a truncated response is not taken for a complete one."""
+    max_header_size = 65536
+    max_headers = 100
+    max_body_size = 10 * 1024 * 1024
+    read_timeout = 30
+
+    def __init__(self, app, loop=None):
+        self.app = app
+        self.loop = loop or asyncio.get_event_loop()
+        self.connections = {}
+        self.draining = False
+        self.server = None
+
+    async def start(self, sock):
+        self.server = await asyncio.start_server(
+            self.handle, sock=sock, limit=self.max_header_size)
+        return self.server
+
+    async def drain(self, timeout):
+        """Stop accepting connections, close the idle ones and wait up to
+        `timeout` seconds for the requests in progress to complete."""
+        self.draining = True
+        self.server.close()
+        for connection in list(self.connections.values()):
+            if connection.idle:
+                connection.writer.close()
+        tasks = list(self.connections)
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        task = _current_task()
+        connection = self.connections[task] = _Connection(writer)
+        try:
+            while not self.draining:
+                keep_alive = await self.handle_request(reader, writer,
+                                                       connection)
+                if not keep_alive:
+                    break
+        except _BadRequest as e:
+            writer.write(_STATUS_LINE.format(
+                e.status, responses[e.status]).encode('latin-1') +
+                b'content-length: 0\r\nconnection: close\r\n\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not connection.started:
+                writer.write(_STATUS_LINE.format(
+                    500, responses[500]).encode('latin-1') +
+                    b'content-length: 0\r\nconnection: close\r\n\r\n')
+            self.loop.call_exception_handler({
+                'message': 'Error while serving a request',
+                'exception': e})
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def read(self, coroutine):
+        return await asyncio.wait_for(coroutine, self.read_timeout)
+
+    async def read_body(self, reader, writer, headers, http_version):
+        chunked = headers.get(b'transfer-encoding', b'').lower() == b'chunked'
+        length = 0 if chunked else int(headers.get(b'content-length', b'0'))
+        if length > self.max_body_size:
+            raise _BadRequest(413)
+        expect = headers.get(b'expect', b'').lower()
+        if expect and http_version == '1.1':
+            # the client waits for this before it sends the body
+            if expect != b'100-continue':
+                raise _BadRequest(417)
+            if chunked or length:
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                await writer.drain()
+        if chunked:
+            chunks = []
+            length = 0
+            while True:
+                size = int((await self.read(reader.readline()))
+                           .split(b';')[0], 16)
+                if size == 0:
+                    await self.read(reader.readline())
+                    return b''.join(chunks)
+                length += size
+                if length > self.max_body_size:
+                    raise _BadRequest(413)
+                chunks.append(await self.read(reader.readexactly(size)))
+                await self.read(reader.readexactly(2))
+        return await self.read(reader.readexactly(length)) if length else b''
+
+    async def handle_request(self, reader, writer, connection):
+        """Serve one request. Returns whether the connection stays open."""
+        line = await self.read(reader.readline())
+        if not line:
+            return False
+        connection.idle = connection.started = False
+        method, target, version = line.decode('latin-1').split()
+        http_version = version.split('/', 1)[1]
+        raw_headers = []
+        headers = {}
+        while True:
+            line = await self.read(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(raw_headers) >= self.max_headers:
+                raise _BadRequest(431)
+            name, value = line.split(b':', 1)
+            name, value = name.strip().lower(), value.strip()
+            raw_headers.append((name, value))
+            headers[name] = value
+        body = await self.read_body(reader, writer, headers, http_version)
+
+        connection_header = headers.get(b'connection', b'').lower()
+        keep_alive = connection_header != b'close' if http_version == '1.1' \
+            else connection_header == b'keep-alive'
+
+        path, _, query = target.partition('?')
+        sockname = writer.get_extra_info('sockname')
+        peername = writer.get_extra_info('peername')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': http_version,
+            'method': method,
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': raw_headers,
+            'client': peername[:2] if peername else None,
+            'server': sockname[:2] if sockname else None
+        }
+
+        received = [False]
+
+        async def receive():
+            if received[0]:
+                return {'type': 'http.disconnect'}
+            received[0] = True
+            return {'type': 'http.request', 'body': body,
+                    'more_body': False}
+
+        state = {'chunked': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                connection.started = True
+                response_headers = list(message['headers'])
+                names = set(name for name, value in response_headers)
+                if b'content-length' not in names:
+                    if http_version == '1.1':
+                        state['chunked'] = True
+                        response_headers.append((b'transfer-encoding',
+                                                 b'chunked'))
+                    else:
+                        state['close'] = True
+                if self.draining or not keep_alive or state.get('close'):
+                    response_headers.append((b'connection', b'close'))
+                lines = [_STATUS_LINE.format(
+                    message['status'],
+                    responses.get(message['status'], 'Unknown'))
+                    .encode('latin-1')]
+                lines.extend(name + b': ' + value + b'\r\n'
+                             for name, value in response_headers)
+                lines.append(b'\r\n')
+                writer.write(b''.join(lines))
+            elif message['type'] == 'http.response.body':
+                data = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if state['chunked']:
+                    if data:
+                        writer.write('{0:x}\r\n'.format(len(data))
+                                     .encode('latin-1') + data + b'\r\n')
+                    if not more_body:
+                        writer.write(b'0\r\n\r\n')
+                elif data:
+                    writer.write(data)
+                await writer.drain()
+
+        await self.app(scope, receive, send)
+        connection.idle = True
+        return keep_alive and not self.draining and not state.get('close')
+
+
+def _run_worker(app, sock, threads, drain_timeout, multiprocess,
+                after_fork=None):
+    """Run an event loop serving the application on a bound socket until
+    SIGTERM or SIGINT is received, then drain it."""
+    if after_fork is not None:
+        after_fork()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asgi_app = WsgiToAsgi(app, threads=threads, multiprocess=multiprocess)
+    server = HTTPServer(asgi_app, loop)
+    loop.run_until_complete(server.start(sock))
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    loop.run_until_complete(stopping.wait())
+    loop.run_until_complete(server.drain(drain_timeout))
+    asgi_app.executor.shutdown(wait=True)
+    loop.close()
+
+
+def serve(app, host='127.0.0.1', port=5000, workers=1, threads=8,
+          drain_timeout=30, after_fork=None):
+    """Serve a WSGI application from `workers` processes, each running an
+    event loop with a pool of `threads` threads for the views.
+    `after_fork` is called in every worker process before it starts
+    serving, for example to discard inherited database connections."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+
+    if workers <= 1:
+        _run_worker(app, sock, threads, drain_timeout, False, after_fork)
+        return
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, sock, threads, drain_timeout, True,
+                            after_fork)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # the parent only forwards shutdown signals and waits for the workers
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except InterruptedError:
+                continue
+    sock.close()
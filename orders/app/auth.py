@@ -1,16 +1,74 @@
+import hmac
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from time import time
 from flask import jsonify, g, current_app
 from flask.ext.httpauth import HTTPBasicAuth
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from werkzeug.security import check_password_hash
+from .cache import LRUCache
 from .models import User
 
 auth = HTTPBasicAuth()
 auth_token = HTTPBasicAuth()
+_pool_lock = threading.Lock()
+
+def init_app(app):
+	"""Create the token serializer and the verified token, user and
+	password caches shared by all the requests handled by this application."""
+	app.extensions['auth'] = {
+		'serializer': Serializer(app.config['SECRET_KEY']),
+		'tokens': LRUCache(app.config.get('AUTH_TOKEN_CACHE_SIZE', 1024)),
+		'users': LRUCache(app.config.get('AUTH_USER_CACHE_SIZE', 256)),
+		'passwords': LRUCache(app.config.get('PASSWORD_CACHE_SIZE', 1024)),
+		'pool': None
+	}
+
+def _hash_pool():
+	"""Return the process pool that runs password hashes, starting it the
+	first time it is needed."""
+	state = current_app.extensions['auth']
+	if state['pool'] is None:
+		with _pool_lock:
+			if state['pool'] is None:
+				state['pool'] = ProcessPoolExecutor(
+					current_app.config['PASSWORD_HASH_WORKERS'])
+	return state['pool']
+
+def check_password(user, password):
+	"""Verify a password against the user's hash.
+
+	With PASSWORD_HASH_WORKERS set, the hash runs in a process pool of that
+	size so that clients fetching tokens do not hold the interpreter while
+	other requests wait; the pool is off by default. With
+	PASSWORD_CACHE_TTL set, successful checks are remembered for that many
+	seconds, keyed on the username, the stored hash and an HMAC of the
+	password. Failed ones are not, so that they keep paying for the hash."""
+	config = current_app.config
+	state = current_app.extensions['auth']
+	ttl = config.get('PASSWORD_CACHE_TTL', 0)
+	if ttl:
+		digest = hmac.new(config['SECRET_KEY'].encode('utf-8'),
+			password.encode('utf-8'), sha256).hexdigest()
+		key = (user.username, user.password_hash, digest)
+		if state['passwords'].get(key):
+			return True
+	if config.get('PASSWORD_HASH_WORKERS', 0) > 0:
+		valid = _hash_pool().submit(check_password_hash, user.password_hash,
+			password).result()
+	else:
+		valid = user.verify_password(password)
+	if ttl and valid:
+		state['passwords'].set(key, True, time() + ttl)
+	return valid
 
 @auth.verify_password
 def verify_password(username, password):
 	g.user = User.query.filter_by(username=username).first()
 	if g.user is None:
 		return False
-	return g.user.verify_password(password)
+	return check_password(g.user, password)
 
 @auth.error_handler
 def unauthorized():
@@ -22,7 +80,7 @@ def unauthorized():
 @auth_token.verify_password
 def verify_auth_token(token, unused):
 	if current_app.config.get('IGNORE_AUTH') is True:
-		g.user = User.query.get(1)
+		g.user = User.get_cached(1)
 	else:
 		g.user = User.verify_auth_token(token)
 	return g.user is not None
@@ -0,0 +1,199 @@
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from itertools import chain
+from time import time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded LRU mapping with optional per-entry
+    expiration times given as UNIX timestamps."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires=None):
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ResponseCache(object):
+    """Server-side cache of rendered GET responses.
+
+    Entries are keyed on the current generation of the tables that the
+    response was rendered from. Committing a change to a table bumps its
+    generation, which makes every response that depends on it unreachable
+    until it falls out of the LRU store."""
+    def __init__(self, maxsize=1024):
+        self.entries = LRUCache(maxsize)
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, tables):
+        return tuple(self.generations.get(table, 0) for table in tables)
+
+    def invalidate(self, tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries)}
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Response cache stored in a SQLite database file, so that the entries
+    and the table generations are shared by all the processes on a host.
+    Once the store holds `maxsize` entries the oldest ones are dropped."""
+    def __init__(self, path, maxsize=1024):
+        super(SQLiteResponseCache, self).__init__(maxsize)
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, value BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS generations ('
+                         'name TEXT PRIMARY KEY, value INTEGER)')
+
+    def connection(self):
+        """Return this thread's connection to the database."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def generation(self, tables):
+        rows = dict(self.connection().execute(
+            'SELECT name, value FROM generations WHERE name IN ({0})'.format(
+                ', '.join('?' * len(tables))), tables).fetchall())
+        return tuple(rows.get(table, 0) for table in tables)
+
+    def invalidate(self, tables):
+        with self.connection() as conn:
+            for table in tables:
+                conn.execute('INSERT OR IGNORE INTO generations (name, value) '
+                             'VALUES (?, 0)', (table,))
+                conn.execute('UPDATE generations SET value = value + 1 '
+                             'WHERE name = ?', (table,))
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO responses (key, value) '
+                         'VALUES (?, ?)', (key, pickle.dumps(value)))
+            # replaced rows get a new rowid, so the oldest entries are the
+            # ones with the lowest rowids
+            conn.execute('DELETE FROM responses WHERE rowid <= '
+                         '(SELECT max(rowid) FROM responses) - ?',
+                         (self.maxsize,))
+
+    def stats(self):
+        stats = super(SQLiteResponseCache, self).stats()
+        stats['size'] = self.connection().execute(
+            'SELECT count(*) FROM responses').fetchone()[0]
+        return stats
+
+
+def init_app(app):
+    """Create the response cache selected by RESPONSE_CACHE, which can be
+    'memory' (the default), 'sqlite' or None to disable caching."""
+    backend = app.config.get('RESPONSE_CACHE', 'memory')
+    maxsize = app.config.get('RESPONSE_CACHE_SIZE', 1024)
+    if backend == 'memory':
+        app.extensions['response_cache'] = ResponseCache(maxsize)
+    elif backend == 'sqlite':
+        app.extensions['response_cache'] = SQLiteResponseCache(
+            app.config['RESPONSE_CACHE_PATH'], maxsize)
+    elif backend is not None:
+        raise ValueError('Unknown response cache: ' + backend)
+
+
+def _record_changes(session, flush_context):
+    """Remember the tables written by a flush until the session commits."""
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        changed.add(obj.__table__.name)
+
+
+def record_changes(session, *tables):
+    """Mark tables as written by statements that bypass the unit of work,
+    such as bulk inserts, so that their responses are invalidated on
+    commit."""
+    session.info.setdefault('changed_tables', set()).update(tables)
+
+
+def _invalidate_changes(session):
+    changed = session.info.pop('changed_tables', None)
+    cache = current_app.extensions.get('response_cache') \
+        if current_app else None
+    if changed and cache is not None:
+        cache.invalidate(sorted(changed))
+
+
+def _discard_changes(session):
+    session.info.pop('changed_tables', None)
+
+
+event.listen(Session, 'after_flush', _record_changes)
+event.listen(Session, 'after_commit', _invalidate_changes)
+event.listen(Session, 'after_rollback', _discard_changes)
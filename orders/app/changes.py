@@ -0,0 +1,141 @@
+"""Change feeds.
+
+Every flush that creates, updates or deletes customers, products, orders
+or items records it in the changes table, in the same transaction. feed()
+returns the changes after a cursor, so that clients that keep a copy of
+the resources only download what changed since their last sync."""
+from collections import defaultdict
+from datetime import datetime
+from flask import request
+from sqlalchemy import event, and_, select, func
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from . import db
+from .exceptions import ValidationError
+from .models import Customer, Product, Order, Item, Change
+from .summaries import _committed
+from .utils import fast_url_for
+
+_TRACKED = (Customer, Product, Order, Item)
+_MODELS = dict((model.__tablename__, model) for model in _TRACKED)
+# column that links a resource to the collection it is listed under
+_PARENTS = {Order: 'customer_id', Item: 'order_id'}
+# stay below the SQLite limit of bound parameters in the IN clauses
+_CHUNK_SIZE = 500
+
+
+def record(session, resource, operation, rows):
+    """Record a change to some resources, given as (id, parent id) pairs.
+    The previous entries of the resources are replaced."""
+    table = Change.__table__
+    now = datetime.utcnow()
+    for i in range(0, len(rows), _CHUNK_SIZE):
+        chunk = rows[i:i + _CHUNK_SIZE]
+        session.execute(table.delete().where(and_(
+            table.c.resource == resource,
+            table.c.resource_id.in_([id for id, parent in chunk]))))
+        session.execute(table.insert(), [
+            {'resource': resource, 'resource_id': id, 'parent_id': parent,
+             'operation': operation, 'changed_at': now}
+            for id, parent in chunk])
+
+
+def high_water_marks(query):
+    """Return the id of the last change recorded for each of the tracked
+    tables that a query reads, with one lookup per table in the index on
+    (resource, id). Every write to those tables records a change with a
+    higher id, so the marks only stay the same while the results do."""
+    table = Change.__table__
+    resources = sorted(set(t.name for t in find_tables(query.statement)
+                           if t.name in _MODELS))
+    return tuple(db.session.execute(select([
+        select([func.max(table.c.id)]).where(
+            table.c.resource == resource).as_scalar()
+        for resource in resources])).first())
+
+
+def _parent(obj, committed=False):
+    attr = _PARENTS.get(type(obj))
+    if attr is None:
+        return None
+    return _committed(obj, attr) if committed else getattr(obj, attr)
+
+
+def _record_changes(session, flush_context):
+    changes = defaultdict(list)
+    for obj in session.new:
+        if isinstance(obj, _TRACKED):
+            changes[(obj.__tablename__, 'created')].append(
+                (obj.id, _parent(obj)))
+    for obj in session.dirty:
+        if isinstance(obj, _TRACKED) and \
+                session.is_modified(obj, include_collections=False):
+            changes[(obj.__tablename__, 'updated')].append(
+                (obj.id, _parent(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, _TRACKED):
+            changes[(obj.__tablename__, 'deleted')].append(
+                (obj.id, _parent(obj, committed=True)))
+    for (resource, operation), rows in changes.items():
+        record(session, resource, operation, rows)
+
+
+def feed(collection, resource=None, parent_id=None, max_per_page=100,
+         kwargs=None):
+    """Return a page of the changes after the ?since= cursor, optionally
+    restricted to a type of resource and to the children of a parent. With
+    ?extended=1 the current representation of the resources that were not
+    deleted is included."""
+    since = request.args.get('since', '')
+    try:
+        since = int(since or 0)
+    except ValueError:
+        raise ValidationError('Invalid cursor: ' + since)
+    per_page = min(request.args.get('per_page', max_per_page, type=int),
+                   max_per_page)
+    extended = request.args.get('extended', 0, type=int)
+
+    query = Change.query.filter(Change.id > since)
+    if resource is not None:
+        query = query.filter(Change.resource == resource)
+    if parent_id is not None:
+        query = query.filter(Change.parent_id == parent_id)
+    # fetch one extra row to find out if there is a next page
+    changes = query.order_by(Change.id).limit(per_page + 1).all()
+    more = len(changes) > per_page
+    changes = changes[:per_page]
+    cursor = changes[-1].id if changes else since
+
+    rv = [change.export_data() for change in changes]
+    if extended == 1:
+        _attach_resources(changes, rv)
+    pages = {'since': since, 'cursor': cursor, 'per_page': per_page,
+             'next_url': None}
+    if more:
+        pages['next_url'] = fast_url_for(request.endpoint, since=cursor,
+                                         per_page=per_page, extended=extended,
+                                         **(kwargs or {}))
+    return {collection: rv, 'pages': pages}
+
+
+def _attach_resources(changes, rv):
+    """Add the resources that still exist to their changes, loading each
+    type of resource with one query."""
+    ids = defaultdict(set)
+    for change in changes:
+        if change.operation != 'deleted':
+            ids[change.resource].add(change.resource_id)
+    resources = {}
+    for resource, resource_ids in ids.items():
+        model = _MODELS[resource]
+        resource_ids = sorted(resource_ids)
+        for i in range(0, len(resource_ids), _CHUNK_SIZE):
+            for obj in model.query.filter(
+                    model.id.in_(resource_ids[i:i + _CHUNK_SIZE])):
+                resources[(resource, obj.id)] = obj.export_data()
+    for change, data in zip(changes, rv):
+        if (change.resource, change.resource_id) in resources:
+            data['data'] = resources[(change.resource, change.resource_id)]
+
+
+event.listen(Session, 'after_flush', _record_changes)
@@ -0,0 +1,97 @@
+"""Compression of response bodies.
+
+Responses of at least COMPRESS_MIN_SIZE bytes are compressed with the best
+codec that the client accepts: brotli when the brotli package is installed,
+then gzip. Compressed bodies of responses that have an ETag are kept in an
+LRU cache keyed on the tag, so an unchanged resource is compressed once.
+
+    COMPRESS               set to False to disable compression
+    COMPRESS_MIN_SIZE      smaller bodies are sent as they are
+    COMPRESS_LEVEL         gzip level, 1 to 9
+    COMPRESS_BROTLI_LEVEL  brotli quality, 0 to 11
+    COMPRESS_CACHE_SIZE    compressed bodies kept, 0 to disable the cache
+"""
+import zlib
+from flask import request
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def gzip_compress(data, level):
+    # a gzip container with a zero timestamp, so the output is reproducible
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+class Compressor(object):
+    def __init__(self, config):
+        self.min_size = config.get('COMPRESS_MIN_SIZE', 500)
+        # codecs in order of preference, with their levels
+        self.codecs = [('gzip', gzip_compress,
+                        config.get('COMPRESS_LEVEL', 6))]
+        if brotli is not None:
+            self.codecs.insert(0, ('br', brotli_compress,
+                                   config.get('COMPRESS_BROTLI_LEVEL', 5)))
+        cache_size = config.get('COMPRESS_CACHE_SIZE', 256)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def negotiate(self, accept_encodings):
+        """Return the preferred codec among those accepted by the client."""
+        best = None
+        best_quality = 0
+        for codec in self.codecs:
+            quality = accept_encodings[codec[0]]
+            if quality > best_quality:
+                best, best_quality = codec, quality
+        return best
+
+    def compress(self, rv):
+        if rv.status_code != 200 or rv.direct_passthrough or \
+                rv.is_streamed or 'Content-Encoding' in rv.headers or \
+                not rv.mimetype.startswith(COMPRESSIBLE):
+            return rv
+        rv.vary.add('Accept-Encoding')
+        codec = self.negotiate(request.accept_encodings)
+        if codec is None:
+            return rv
+        data = rv.get_data()
+        if len(data) < self.min_size:
+            return rv
+
+        name, compress, level = codec
+        etag = rv.headers.get('ETag')
+        key = (etag, request.host, name, level) \
+            if etag is not None and self.cache is not None else None
+        body = self.cache.get(key) if key is not None else None
+        if body is None:
+            body = compress(data, level)
+            if key is not None:
+                self.cache.set(key, body)
+        rv.set_data(body)
+        rv.headers['Content-Encoding'] = name
+        # the compressed bytes are a different representation, so a strong
+        # tag becomes a weak one
+        if etag is not None and not etag.startswith('W/'):
+            rv.headers['ETag'] = 'W/' + etag
+        return rv
+
+
+def init_app(app):
+    """Install the compression handler unless COMPRESS is False."""
+    if not app.config.get('COMPRESS', True):
+        return
+    compressor = app.extensions['compression'] = Compressor(app.config)
+
+    @app.after_request
+    def compress_response(rv):
+        return compressor.compress(rv)
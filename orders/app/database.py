@@ -0,0 +1,153 @@
+"""Engine configuration.
+
+SQLAlchemy is a drop-in replacement for the Flask-SQLAlchemy extension that
+gives SQLite file databases with a pool size a connection pool, and runs
+the SQLite pragmas given by the SQLITE_* configuration keys on each new
+connection:
+
+    SQLITE_JOURNAL_MODE   journal mode, 'WAL' lets readers run during commits
+    SQLITE_SYNCHRONOUS    'NORMAL' only syncs the WAL on checkpoints
+    SQLITE_MMAP_SIZE      bytes of the database file read through mmap
+    SQLITE_CACHE_SIZE     page cache per connection, negative values in KiB
+    SQLITE_BUSY_TIMEOUT   milliseconds to wait for a lock before failing
+
+Keys left unset keep the SQLite defaults.
+
+SQLALCHEMY_READ_BINDS is a list of database URIs that only serve reads, such
+as replicas of the primary database, or the SQLite database itself opened a
+second time with query_only set. GET and HEAD requests run their queries on
+one of them, picked round-robin when the session is created; once a request
+writes, the rest of it sticks to the primary database so it reads what it
+wrote. Models with a bind key of their own always use that bind.
+"""
+import itertools
+import threading
+import weakref
+from functools import partial
+from flask import request, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy, \
+    _SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+_READ_BIND = '_read_{0}'
+_SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_PRAGMAS = (('journal_mode', 'SQLITE_JOURNAL_MODE'),
+            ('synchronous', 'SQLITE_SYNCHRONOUS'),
+            ('mmap_size', 'SQLITE_MMAP_SIZE'),
+            ('cache_size', 'SQLITE_CACHE_SIZE'),
+            ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'))
+
+
+def sqlite_pragmas(config):
+    """Return the PRAGMA statements selected by a configuration."""
+    return ['PRAGMA {0}={1}'.format(pragma, config[key])
+            for pragma, key in _PRAGMAS if config.get(key) is not None]
+
+
+def configure_sqlite(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in pragmas:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+class RoutingSession(_SignallingSession):
+    """Session that sends the queries of safe requests to a read bind."""
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper, clause=None):
+        bind = self.read_bind(mapper)
+        if bind is not None:
+            return self.db.get_engine(self.app, bind=bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def read_bind(self, mapper=None):
+        """Return the key of the read bind for a query, or None when it
+        has to run on the primary database."""
+        if self._flushing or self.info.get('primary'):
+            return None
+        binds = self.app.extensions.get('read_binds')
+        if not binds or not has_request_context() or \
+                request.method not in _SAFE_METHODS:
+            return None
+        if mapper is not None and \
+                mapper.mapped_table.info.get('bind_key') is not None:
+            return None
+        # one read bind for the whole request, so it reads one snapshot
+        bind = self.info.get('read_bind')
+        if bind is None:
+            bind = self.info['read_bind'] = next(binds)
+        return bind
+
+
+def _stick_to_primary(session, flush_context):
+    session.info['primary'] = True
+
+
+event.listen(RoutingSession, 'after_flush', _stick_to_primary)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._configured = weakref.WeakSet()
+        self._configure_lock = threading.Lock()
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def init_app(self, app):
+        # read binds are regular binds with reserved keys and no tables
+        read_binds = app.config.get('SQLALCHEMY_READ_BINDS') or []
+        if read_binds:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            keys = []
+            for i, uri in enumerate(read_binds):
+                keys.append(_READ_BIND.format(i))
+                binds[keys[-1]] = uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.extensions['read_binds'] = itertools.cycle(keys)
+        super(SQLAlchemy, self).init_app(app)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        # a file database with a pool size gets a connection pool instead
+        # of the connection per checkout that pysqlite defaults to; pooled
+        # connections are used by one thread at a time, but not always by
+        # the thread that opened them
+        if info.drivername == 'sqlite' and options.get('pool_size') and \
+                info.database not in (None, '', ':memory:'):
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('connect_args', {})['check_same_thread'] = \
+                False
+        elif info.drivername == 'sqlite':
+            # the other pools of SQLite take neither of these
+            options.pop('max_overflow', None)
+            options.pop('pool_timeout', None)
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine not in self._configured:
+            with self._configure_lock:
+                if engine not in self._configured:
+                    pragmas = []
+                    if engine.dialect.name == 'sqlite':
+                        pragmas = sqlite_pragmas(app.config)
+                        if bind is not None and \
+                                bind.startswith(_READ_BIND.format('')):
+                            pragmas.append('PRAGMA query_only=1')
+                    if pragmas:
+                        event.listen(engine, 'connect',
+                                     lambda conn, record:
+                                     configure_sqlite(conn, pragmas))
+                    self._configured.add(engine)
+        return engine
@@ -1,4 +1,5 @@
 from .json import json
 from .paginate import paginate
-from .caching import cache_control, no_cache, etag
+from .caching import cache_control, no_cache, etag, versioned, cached
 from .rate_limit import rate_limit
+from .group_commit import group_commit
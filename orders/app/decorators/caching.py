@@ -1,6 +1,7 @@
 import functools
 import hashlib
-from flask import request, make_response, jsonify
+from flask import request, make_response, jsonify, current_app, g
+from ..profiling import mark
 
 def cache_control(*directives):
     def decorator(f):
@@ -20,35 +21,138 @@ def cache_control(*directives):
 def no_cache(f):
     return cache_control('private', 'no-cache', 'no-store', 'max-age=0')(f)
 
+def _opaque(tag):
+    """Return an entity tag without its weakness indicator."""
+    return tag[2:] if tag.startswith('W/') else tag
+
+def weak_etag(*parts):
+    """Build a weak ETag out of the values that identify a representation."""
+    return 'W/"' + hashlib.md5(repr(parts).encode('utf-8')).hexdigest() + '"'
+
+def check_etag(etag):
+    """Handle the If-Match and If-None-Match request headers for a resource
+    with the given ETag. Returns the 412 or 304 response to send instead of
+    the resource, or None if the request should proceed."""
+    if_match = request.headers.get('If-Match')
+    if_none_match = request.headers.get('If-None-Match')
+
+    if if_match:
+        etag_list = [tag.strip() for tag in if_match.split(',')]
+        if etag not in etag_list and '*' not in etag_list:
+            response = jsonify({'status': 412, 'error': 'precondition failed', 'message': 'precondition failed'})
+            response.status_code = 412
+            return response
+    elif if_none_match:
+        etag_list = [_opaque(tag.strip()) for tag in if_none_match.split(',')]
+        if _opaque(etag) in etag_list or '*' in etag_list:
+            response = jsonify({'status': 304, 'error': 'not modified', 'message': 'resource not modified'})
+            response.status_code = 304
+            response.headers['ETag'] = etag
+            return response
+    return None
+
 def etag(f):
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        assert request.method in ['GET', 'HEAD'], '@etag is only supported on GET and HEAD requests'
-
         rv = f(*args, **kwargs)
         rv = make_response(rv)
 
-        if rv.status_code != 200:
+        # only successful reads get an ETag, and views that computed their
+        # own from resource versions have been handled already; streamed
+        # bodies cannot be hashed without consuming them
+        if request.method not in ['GET', 'HEAD'] or rv.status_code != 200 \
+                or 'ETag' in rv.headers or rv.is_streamed:
             return rv
 
+        mark('etag')
         etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
         rv.headers['ETag'] = etag
 
-        # handle If-Match and If-None-Match request headers if present
-        if_match = request.headers.get('If-Match')
-        if_none_match = request.headers.get('If-None-Match')
-
-        if if_match:
-            etag_list = [tag.strip() for tag in if_match.split(',')]
-            if etag not in etag_list and '*' not in etag_list:
-                response = jsonify({'status': 412, 'error': 'precondition failed', 'message': 'precondition failed'})
-                response.status_code = 412
-                return response
-        elif if_none_match:
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
-            if etag in etag_list or '*' in etag_list:
-                response = jsonify({'status': 304, 'error': 'not modified', 'message': 'resource not modified'})
-                response.status_code = 304
-                return response
-        return rv
+        return check_etag(etag) or rv
     return wrapped
+
+def versioned(model):
+    """Answer conditional GETs for a single resource from its version
+    column, with one indexed query and before the view renders anything.
+    The query string is part of the tag, as it selects the fields."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            # included resources have versions of their own, so those
+            # responses are tagged from their content instead
+            if request.args.get('include'):
+                return etag(f)(*args, **kwargs)
+
+            version = model.version_of(kwargs['id'])
+            if version is None:
+                return f(*args, **kwargs)
+
+            tag = weak_etag(model.__tablename__, kwargs['id'],
+                            request.query_string, *version)
+            rv = check_etag(tag)
+            if rv is not None:
+                return rv
+
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200:
+                rv.headers['ETag'] = tag
+            return rv
+        return wrapped
+    return decorator
+
+def collection_etag(query, *parts):
+    """Return a weak ETag for a listing of the resources in a query, from
+    the last changes to the tables it reads rather than from the resources
+    themselves, so that it costs the same on any collection. Extra parts
+    identify representations that the query string does not select."""
+    from ..changes import high_water_marks
+    return weak_etag(request.full_path, *(parts + high_water_marks(query)))
+
+def cached(*models):
+    """Serve GET responses from the server-side response cache.
+
+    Responses are keyed on the endpoint, its arguments, the query string, the
+    Accept header and the authenticated user, and stop being served as soon as a change to
+    any of the given models is committed, or of any resource that can be
+    embedded with ?include= when the request has one."""
+    tables = [model.__tablename__ for model in models]
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            from .. import db
+            from ..includes import TABLES
+            cache = current_app.extensions.get('response_cache')
+            # writes that are not committed yet, such as those of earlier
+            # requests in a batch transaction, must not be cached or hidden
+            if cache is None or request.method != 'GET' or \
+                    db.session.info.get('changed_tables'):
+                return f(*args, **kwargs)
+
+            # the generation is read before rendering, so that a response
+            # rendered from data that is about to change is never reachable
+            user = getattr(g, 'user', None)
+            key = hashlib.md5(repr((request.endpoint, sorted(kwargs.items()),
+                request.query_string, request.host_url,
+                request.headers.get('Accept'),
+                user.id if user is not None else None,
+                cache.generation(TABLES if request.args.get('include')
+                                 else tables))).encode('utf-8')).hexdigest()
+
+            hit = cache.get(key)
+            if hit is not None:
+                status, headers, data = hit
+                rv = current_app.response_class(data, status=status,
+                                                headers=headers)
+                if 'ETag' in rv.headers:
+                    rv = check_etag(rv.headers['ETag']) or rv
+                rv.headers['X-Cache'] = 'HIT'
+                return rv
+
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200 and not rv.is_streamed:
+                cache.set(key, (rv.status_code, list(rv.headers),
+                                rv.get_data()))
+            rv.headers['X-Cache'] = 'MISS'
+            return rv
+        return wrapped
+    return decorator
@@ -0,0 +1,23 @@
+import functools
+from flask import current_app, request, g
+from flask.globals import _request_ctx_stack
+
+
+def group_commit(f):
+    """Run a write view on the writer thread of app.group_commit, when
+    GROUP_COMMIT is enabled, so that its commit is shared with the writes
+    of concurrent requests."""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        from .. import db
+        committer = current_app.extensions.get('group_commit')
+        # sub-requests of a batch transaction commit with their batch
+        if committer is None or request.environ.get('orders.transaction'):
+            return f(*args, **kwargs)
+
+        # the request holds no connection, and no lock, while it waits
+        db.session.close()
+        return committer.submit(f, args, kwargs,
+                                _request_ctx_stack.top.copy(),
+                                g._get_current_object())
+    return wrapped
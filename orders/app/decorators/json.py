@@ -1,5 +1,75 @@
 import functools
-from flask import jsonify
+import json as stdlib_json
+from datetime import date, datetime
+from flask import current_app
+from ..profiling import mark
+
+
+def _default(obj):
+    """Encode the types that the standard library encoder does not know.
+    Naive datetimes are in UTC, as they are in the database."""
+    if isinstance(obj, datetime):
+        return obj.isoformat() + ('Z' if obj.tzinfo is None else '')
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+class StdlibSerializer(object):
+    """Compact JSON with the standard library encoder, created once and
+    reused for every response."""
+    name = 'stdlib'
+
+    def __init__(self):
+        self.encoder = stdlib_json.JSONEncoder(separators=(',', ':'),
+                                               ensure_ascii=False,
+                                               default=_default)
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonSerializer(object):
+    """Compact JSON with orjson, which encodes datetimes in C."""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+    def dumps(self, obj):
+        return self.orjson.dumps(obj, default=_default, option=self.options)
+
+
+# serializers by name; 'auto' picks the first one that can be imported
+SERIALIZERS = {'stdlib': StdlibSerializer, 'orjson': OrjsonSerializer}
+AUTO = ('orjson', 'stdlib')
+
+
+def create_serializer(name='auto'):
+    """Create the serializer selected by name, or the fastest one installed
+    for 'auto'."""
+    if name != 'auto':
+        return SERIALIZERS[name]()
+    for name in AUTO:
+        try:
+            return SERIALIZERS[name]()
+        except ImportError:
+            pass
+    return StdlibSerializer()
+
+
+def get_serializer():
+    """Return the serializer of the application, selected by
+    JSON_SERIALIZER and created the first time it is used."""
+    serializer = current_app.extensions.get('json_serializer')
+    if serializer is None:
+        serializer = current_app.extensions['json_serializer'] = \
+            create_serializer(current_app.config.get('JSON_SERIALIZER',
+                                                     'auto'))
+    return serializer
+
 
 def json(f):
     """Generate a JSON response from a database model or a Python dictionary."""
@@ -7,6 +77,10 @@ def json(f):
     def wrapped(*args, **kwargs):
         rv = f(*args, **kwargs)
 
+        # responses produced by the view, such as a 304, are sent as they are
+        if isinstance(rv, current_app.response_class):
+            return rv
+
         status = None
         headers = None
         if isinstance(rv, tuple):
@@ -15,9 +89,13 @@ def json(f):
             headers, status = status, None
 
         if not isinstance(rv, dict):
+            mark('export')
             rv = rv.export_data()
 
-        rv = jsonify(rv)
+        # compact output, unlike jsonify(), which indents everything
+        mark('serialize')
+        rv = current_app.response_class(get_serializer().dumps(rv),
+                                        mimetype='application/json')
         if status is not None:
             rv.status_code = status
         if headers is not None:
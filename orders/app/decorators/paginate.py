@@ -1,43 +1,260 @@
+import base64
 import functools
-from flask import url_for, request
+import json
+from datetime import datetime
+from dateutil import parser as datetime_parser
+from flask import request, current_app, stream_with_context
+from sqlalchemy import and_, or_, DateTime
+from sqlalchemy.orm import load_only
+from ..exceptions import ValidationError
+from ..profiling import mark
+from ..utils import fast_url_for
+from .caching import check_etag, collection_etag
+from .json import get_serializer
 
-def paginate(collection, max_per_page=25):
+
+# query string arguments that links to other pages keep: the filters of
+# app.filters, the requested fields and the included resources; the page
+# arguments are set by the links themselves
+_LINK_ARGS = ('customer_id', 'date_from', 'date_to', 'product_id',
+              'min_quantity', 'max_quantity', 'q', 'fields', 'include')
+
+
+def _encode_cursor(values):
+    """Pack the keyset values of the last row into an opaque cursor."""
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_value(value, column):
+    if value is None:
+        return None
+    if isinstance(column.property.columns[0].type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return datetime_parser.parse(value)
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ValueError(value)
+    return value
+
+
+def _decode_cursor(cursor, columns):
+    """Unpack a cursor produced by _encode_cursor() for the given columns.
+    Anything else, including values of the wrong type, is rejected."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [_decode_value(v, column) for v, column in zip(values, columns)]
+    except (ValueError, TypeError, OverflowError):
+        raise ValidationError('Invalid cursor: ' + cursor)
+
+
+def _seek(columns, values):
+    """Build the (a, b, ...) > (x, y, ...) condition without row values,
+    which older SQLite releases do not support."""
+    clauses = []
+    for i, column in enumerate(columns):
+        terms = [c == v for c, v in zip(columns[:i], values[:i])]
+        terms.append(column > values[i])
+        clauses.append(and_(*terms))
+    return or_(*clauses)
+
+
+def _load(query, extended, keyset):
+    """Restrict a query to the columns that a listing needs: the keyset for
+    lists of URLs, or the ones behind the fields requested with ?fields=
+    for extended listings. Returns the query and the requested fields."""
+    if extended != 1:
+        return query.options(load_only(*keyset)), None
+    model = query.column_descriptions[0]['type']
+    fields = model.requested_fields()
+    return model.load_fields(query, fields, *keyset), fields
+
+
+def paginate(collection, max_per_page=25, keyset=('id',), cursor_only=False):
+    """Paginate the query returned by the view.
+
+    Clients get page numbers by default (?page=N). Sending ?after= switches
+    to cursor mode, which seeks on the `keyset` columns instead of using an
+    OFFSET and only counts the collection when ?count=1 is given. With
+    `cursor_only`, requests without a cursor return the whole collection
+    unpaged, for endpoints that were never paginated.
+
+    Conditional requests for numbered pages are answered from the last
+    entries of the change log for the tables of the collection, before any
+    resource is loaded, see app.changes.high_water_marks(). Pages of cursor
+    mode are tagged from their content instead.
+
+    Requests with ?stream=ndjson or an Accept header of application/x-ndjson
+    get the whole collection as newline delimited JSON instead, streamed
+    while rows are fetched from the database in chunks.
+
+    Requests with ?since= get the changes to the collection after a cursor
+    instead, see app.changes.feed().
+
+    Pages embed the related resources requested with ?include=, see
+    app.includes. Those pages are tagged from their content, as the resources
+    they embed change on their own.
+    """
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
             query = f(*args, **kwargs)
 
-            page = request.args.get('page', 1, type=int)
-            per_page = min(request.args.get('per_page', max_per_page, type=int), max_per_page)
-            extended = request.args.get('extended', 0, type=int)
+            if 'since' in request.args:
+                # the changes to the collection, which include deletions;
+                # the id of nested collections is the parent of the members
+                from ..changes import feed
+                model = query.column_descriptions[0]['type']
+                return feed(collection, model.__tablename__, kwargs.get('id'),
+                            kwargs=kwargs)
 
-            p = query.paginate(page, per_page)
+            # the Accept header can select the streamed representation
+            stream = _wants_stream()
+            if (request.args.get('include') or 'after' in request.args) \
+                    and not stream:
+                return _paginate(collection, query, max_per_page, keyset,
+                                 cursor_only, kwargs), {'Vary': 'Accept'}
 
-            pages = {'page': page, 'per_page': per_page, 'total': p.total,
-            'pages': p.pages}
+            etag = collection_etag(query, 'ndjson' if stream else 'json')
+            rv = check_etag(etag)
+            if rv is not None:
+                rv.vary.add('Accept')
+                return rv
+            if stream:
+                return _stream(query, keyset, etag)
+            return _paginate(collection, query, max_per_page, keyset,
+                             cursor_only, kwargs), \
+                {'ETag': etag, 'Vary': 'Accept'}
+        return wrapped
+    return decorator
 
-            if p.has_prev:
-                pages['prev_url'] = url_for(request.endpoint, page=p.prev_num,
-                per_page=per_page, extended=extended, _external=True, **kwargs)
-            else:
-                pages['prev_url'] = None
 
-            if p.has_next:
-                pages['next_url'] = url_for(request.endpoint, page=p.next_num,
-                per_page=per_page, extended=extended, _external=True, **kwargs)
-            else:
-                pages['next_url'] = None
+def _paginate(collection, query, max_per_page, keyset, cursor_only, kwargs):
+    from ..includes import requested_includes, include_columns
+    extended = request.args.get('extended', 0, type=int)
+    model = query.column_descriptions[0]['type']
+    includes = requested_includes(model)
+    query, fields = _load(query, extended,
+                          keyset + include_columns(model, includes))
+    # other arguments are left out, as their names could collide with
+    # those of fast_url_for() or of the view
+    kwargs = dict(((name, value) for name, value in request.args.items()
+                   if name in _LINK_ARGS), **kwargs)
 
-            if p.pages.count() > 0:
-                pages['first_url'] = url_for(request.endpoint, page=1,
-                per_page=per_page, extended=extended, _external=True, **kwargs)
+    if 'after' in request.args:
+        return _paginate_cursor(collection, query, max_per_page,
+                                keyset, extended, fields, includes, kwargs)
+    if cursor_only:
+        return _page(collection, model, query.all(), extended, fields,
+                     includes)
 
-                pages['last_url'] = url_for(request.endpoint, page=p.pages,
-                per_page=per_page, extended=extended, _external=True, **kwargs)
+    page = request.args.get('page', 1, type=int)
+    per_page = max(1, min(request.args.get('per_page', max_per_page, type=int), max_per_page))
 
-            # return a dictionary as a response
-            if extended == 1:
-                return { collection: [item.export_data() for item in p.items], 'pages': pages}
-            return { collection: [item.get_url() for item in p.items], 'pages': pages}
-        return wrapped
-    return decorator
+    p = query.paginate(page, per_page)
+
+    pages = {'page': page, 'per_page': per_page, 'total': p.total,
+    'pages': p.pages}
+
+    if p.has_prev:
+        pages['prev_url'] = fast_url_for(request.endpoint, page=p.prev_num,
+        per_page=per_page, extended=extended, **kwargs)
+    else:
+        pages['prev_url'] = None
+
+    if p.has_next:
+        pages['next_url'] = fast_url_for(request.endpoint, page=p.next_num,
+        per_page=per_page, extended=extended, **kwargs)
+    else:
+        pages['next_url'] = None
+
+    if p.pages > 0:
+        pages['first_url'] = fast_url_for(request.endpoint, page=1,
+        per_page=per_page, extended=extended, **kwargs)
+
+        pages['last_url'] = fast_url_for(request.endpoint, page=p.pages,
+        per_page=per_page, extended=extended, **kwargs)
+
+    # return a dictionary as a response
+    return _page(collection, model, p.items, extended, fields, includes,
+                 pages)
+
+
+def _wants_stream():
+    return request.args.get('stream') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def _stream(query, keyset, etag, chunk_size=500):
+    """Return a response that sends the resources in the query as newline
+    delimited JSON, one resource per line."""
+    extended = request.args.get('extended', 0, type=int)
+    query, fields = _load(query, extended, keyset)
+    model = query.column_descriptions[0]['type']
+    query = query.order_by(*[getattr(model, name) for name in keyset]) \
+        .yield_per(chunk_size)
+    dumps = get_serializer().dumps
+
+    def generate():
+        for item in query:
+            rv = item.export_data(fields) if extended == 1 \
+                else item.get_url()
+            yield dumps(rv) + b'\n'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/x-ndjson',
+                                      headers={'ETag': etag,
+                                               'Vary': 'Accept'})
+
+
+def _export(items, extended, fields=None):
+    mark('export')
+    if extended == 1:
+        return [item.export_data(fields) for item in items]
+    return [item.get_url() for item in items]
+
+
+def _page(collection, model, items, extended, fields, includes, pages=None):
+    """Build a page of a collection with its included resources."""
+    from ..includes import included
+    rv = {collection: _export(items, extended, fields)}
+    if pages is not None:
+        rv['pages'] = pages
+    if includes:
+        rv['included'] = included(model, items, includes)
+    return rv
+
+
+def _paginate_cursor(collection, query, max_per_page, keyset, extended,
+                     fields, includes, kwargs):
+    after = request.args.get('after', '')
+    per_page = max(1, min(request.args.get('per_page', max_per_page, type=int), max_per_page))
+    count = request.args.get('count', 0, type=int)
+
+    model = query.column_descriptions[0]['type']
+    columns = [getattr(model, name) for name in keyset]
+
+    pages = {'per_page': per_page, 'after': after or None}
+    if count == 1:
+        pages['total'] = query.order_by(None).count()
+
+    if after:
+        query = query.filter(_seek(columns, _decode_cursor(after, columns)))
+
+    # fetch one extra row to find out if there is a next page
+    items = query.order_by(*columns).limit(per_page + 1).all()
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        pages['next_url'] = fast_url_for(request.endpoint,
+            after=_encode_cursor([getattr(last, name) for name in keyset]),
+            per_page=per_page, extended=extended, count=count,
+            **kwargs)
+    else:
+        pages['next_url'] = None
+
+    return _page(collection, model, items, extended, fields, includes, pages)
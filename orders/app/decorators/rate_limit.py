@@ -1,55 +1,189 @@
 import functools
+import heapq
+import os
+import sqlite3
+import threading
+from abc import ABCMeta, abstractmethod
 from time import time
 from flask import current_app, request, g, jsonify
 
-_limiter = None
+_limiter_lock = threading.Lock()
 
-class MemRateLimit(object):
-    """Rate limiter that uses a Python dictionary as storage."""
+
+def _sliding_window(now, period, window, prev, curr):
+    """Advance a sliding window counter to `now`.
+
+    Counts are kept for the current fixed window and for the one before it,
+    which is weighted by how much of it still overlaps the sliding window
+    that ends now. Returns the updated (window, prev, curr) and the estimated
+    number of hits in the last `period` seconds."""
+    start = now - now % period
+    if window != start:
+        prev = curr if window == start - period else 0
+        curr = 0
+        window = start
+    weight = 1.0 - float(now - start) / period
+    return window, prev, curr, prev * weight + curr
+
+
+class RateLimitBackend(metaclass=ABCMeta):
+    """Storage for the rate limiter.
+
+    Backends keep a sliding window counter per key and apply hits to it with
+    hit()."""
+    @abstractmethod
+    def is_allowed(self, key, limit, period):
+        """Record a hit for a key. Returns whether it is allowed, the
+        remaining hits in the window and the time at which the current
+        window resets."""
+
+    def hit(self, now, limit, period, counter):
+        """Apply a hit to a (window, prev, curr) counter, which is None for
+        unknown keys. Returns the new counter and the is_allowed() result."""
+        window, prev, curr = counter or (None, 0, 0)
+        window, prev, curr, hits = _sliding_window(now, period, window,
+                                                   prev, curr)
+        reset = int(window + period)
+        if hits + 1 > limit:
+            return (window, prev, curr), (False, 0, reset)
+        return (window, prev, curr + 1), (True, int(limit - hits - 1), reset)
+
+
+class MemRateLimit(RateLimitBackend):
+    """Rate limiter that uses a Python dictionary as storage.
+
+    Expired keys are found through a heap ordered by expiration time, so a
+    hit costs the same regardless of how many clients are being tracked.
+    Counters are local to the process."""
     def __init__(self):
         self.counters = {}
+        self.expirations = []
+        self.lock = threading.Lock()
 
     def is_allowed(self, key, limit, period):
-        now = int(time())
-        begin_period = now
-        end_period = begin_period + period
-
-        self.cleanup(now)
-        if key in self.counters:
-            self.counters[key]['hits'] += 1
-        else:
-            self.counters[key] = {'hits': 1, 'reset': end_period}
-        allow = True
-        remaining = limit - self.counters[key]['hits']
-        if remaining < 0:
-            remaining = 0
-            allow = False
-        return allow, remaining, self.counters[key]['reset']
+        now = time()
+        with self.lock:
+            self.cleanup(now)
+            counter, expires = self.counters.get(key, (None, None))
+            counter, result = self.hit(now, limit, period, counter)
+            # a counter is needed until the window after this one is over
+            if counter[0] + 2 * period != expires:
+                expires = counter[0] + 2 * period
+                heapq.heappush(self.expirations, (expires, key))
+            self.counters[key] = (counter, expires)
+            return result
 
     def cleanup(self, now):
         """Eliminate expired keys."""
-        for key, value in list(self.counters.items()):
-            if value['reset'] < now:
+        while self.expirations and self.expirations[0][0] <= now:
+            expires, key = heapq.heappop(self.expirations)
+            # keys that moved to a newer window have a later heap entry
+            if self.counters.get(key, (None, None))[1] == expires:
                 del self.counters[key]
 
 
-def rate_limit(limit, period):
+class SQLiteRateLimit(RateLimitBackend):
+    """Rate limiter that stores its counters in a SQLite database file, so
+    that all the worker processes on a host share the same limits."""
+    cleanup_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.next_cleanup = 0
+        conn = self.connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_limits ('
+                         'key TEXT PRIMARY KEY, window_start REAL, '
+                         'prev INTEGER, curr INTEGER, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_rate_limits_expires '
+                         'ON rate_limits (expires)')
+
+    def connection(self):
+        """Return this thread's connection to the database."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def is_allowed(self, key, limit, period):
+        now = time()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if now >= self.next_cleanup:
+                self.cleanup(now)
+            row = conn.execute('SELECT window_start, prev, curr '
+                               'FROM rate_limits WHERE key = ?',
+                               (key,)).fetchone()
+            counter, result = self.hit(now, limit, period, row)
+            conn.execute('INSERT OR REPLACE INTO rate_limits '
+                         '(key, window_start, prev, curr, expires) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (key,) + counter + (counter[0] + 2 * period,))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def cleanup(self, now):
+        """Eliminate expired keys, at most once per cleanup interval."""
+        self.connection().execute('DELETE FROM rate_limits WHERE expires <= ?',
+                                  (now,))
+        self.next_cleanup = now + self.cleanup_interval
+
+
+def create_limiter(config):
+    """Create the rate limiter backend selected by RATELIMIT_BACKEND. The
+    sqlite backend needs RATELIMIT_SQLITE_PATH, without it the counters
+    stay in memory."""
+    backend = config.get('RATELIMIT_BACKEND', 'memory')
+    if backend == 'memory':
+        return MemRateLimit()
+    if backend == 'sqlite':
+        if not config.get('RATELIMIT_SQLITE_PATH'):
+            return MemRateLimit()
+        return SQLiteRateLimit(config['RATELIMIT_SQLITE_PATH'])
+    raise ValueError('Unknown rate limit backend: ' + backend)
+
+
+def _get_limiter():
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        with _limiter_lock:
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is None:
+                limiter = current_app.extensions['rate_limiter'] = \
+                    create_limiter(current_app.config)
+    return limiter
+
+
+def rate_limit(limit=None, period=None):
+    """Allow `limit` calls per client every `period` seconds. Without
+    arguments the limits come from RATELIMIT_REQUESTS and RATELIMIT_PERIOD,
+    and calls are not limited when those are not set."""
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
-            if current_app.config['TESTING']:
+            config = current_app.config
+            requests = limit or config.get('RATELIMIT_REQUESTS')
+            seconds = period or config.get('RATELIMIT_PERIOD', 60)
+            if config['TESTING'] or not requests:
                 return f(*args, **kwargs)
             else:
-                global _limiter
-                if _limiter is None:
-                    _limiter = MemRateLimit()
-
                 key = '{0}/{1}'.format(f.__name__, request.remote_addr)
-                allowed, remaining, reset = _limiter.is_allowed(key, limit, period)
+                allowed, remaining, reset = _get_limiter().is_allowed(
+                    key, requests, seconds)
 
                 g.headers = {
                     'X-RateLimit-Remaining': str(remaining),
-                    'X-RateLimit-Limit': str(limit),
+                    'X-RateLimit-Limit': str(requests),
                     'X-RateLimit-Reset': str(reset)
                 }
 
@@ -59,5 +193,5 @@ def rate_limit(limit, period):
                     return response
 
                 return f(*args, **kwargs)
-            return wrapped
-        return decorator
+        return wrapped
+    return decorator
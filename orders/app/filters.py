@@ -0,0 +1,74 @@
+"""Filters for the collection endpoints.
+
+Each function narrows the query of a listing with the filters given in the
+query string, before the paginate decorator pages it, and rejects values
+that cannot be parsed. Every filter is served by an index:
+
+    orders     ?customer_id=  ix_orders_customer_id_date_id
+               ?date_from=    ix_orders_date_id, dates are inclusive
+               ?date_to=      ix_orders_date_id, dates are exclusive
+               ?product_id=   ix_items_product_id_order_id, orders that
+                              have an item of the product
+    items      ?product_id=   ix_items_order_id, within the order
+               ?min_quantity=, ?max_quantity=
+    customers  ?q=            customers_fts, see app.search
+    products   ?q=            products_fts
+"""
+from flask import request
+from . import db
+from .exceptions import ValidationError
+from .models import Order, Item
+from .search import search
+from .utils import parse_date
+
+
+def _arg(name, convert):
+    """Return a query string argument converted with convert(), or None
+    when it is not given."""
+    value = request.args.get(name, '')
+    if not value:
+        return None
+    try:
+        return convert(value)
+    except (ValueError, TypeError, OverflowError):
+        # dateutil 2.2 raises a TypeError for some strings it cannot parse
+        raise ValidationError('Invalid {0}: {1}'.format(name, value))
+
+
+def filter_orders(query):
+    customer_id = _arg('customer_id', int)
+    if customer_id is not None:
+        query = query.filter(Order.customer_id == customer_id)
+    date_from = _arg('date_from', parse_date)
+    if date_from is not None:
+        query = query.filter(Order.date >= date_from)
+    date_to = _arg('date_to', parse_date)
+    if date_to is not None:
+        query = query.filter(Order.date < date_to)
+    product_id = _arg('product_id', int)
+    if product_id is not None:
+        query = query.filter(Order.id.in_(
+            db.session.query(Item.order_id)
+            .filter(Item.product_id == product_id)))
+    return query
+
+
+def filter_items(query):
+    product_id = _arg('product_id', int)
+    if product_id is not None:
+        query = query.filter(Item.product_id == product_id)
+    min_quantity = _arg('min_quantity', int)
+    if min_quantity is not None:
+        query = query.filter(Item.quantity >= min_quantity)
+    max_quantity = _arg('max_quantity', int)
+    if max_quantity is not None:
+        query = query.filter(Item.quantity <= max_quantity)
+    return query
+
+
+def filter_names(query, model):
+    """Filter customers or products with a search on their names."""
+    terms = request.args.get('q', '')
+    if not terms.strip():
+        return query
+    return search(query, model, terms)
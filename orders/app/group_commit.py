@@ -0,0 +1,201 @@
+"""Group commit.
+
+With GROUP_COMMIT enabled, the write views decorated with group_commit are
+not run by the thread that handles their request. They are queued to a
+single writer thread, which runs the writes that arrive together in one
+database transaction and commits them once, so a burst of writes pays for
+one commit instead of one each, and they no longer queue on the SQLite
+write lock one request at a time.
+
+Each view runs under a savepoint of its own, in a copy of its request
+context and with the g of its request, so it sees the authenticated user,
+and its commit does not end the transaction of the group. When a view
+fails, only its savepoint is rolled back and its error goes back to its
+request alone. A request only gets its response after the commit of its
+group, so a write that was answered is as durable as before.
+
+Requests wait at most GROUP_COMMIT_TIMEOUT seconds for their write and
+then fail with a 503; a write that the writer has not started by then is
+dropped, one that it has started may still be committed. If the writer
+thread dies, the requests waiting on it get its error and the next write
+starts a new one.
+
+    GROUP_COMMIT          set to True to enable group commit
+    GROUP_COMMIT_WINDOW   seconds to wait for more writes after the first
+                          one of a group, 0 to group only the writes that
+                          queued up during the previous commit
+    GROUP_COMMIT_SIZE     most writes in a group
+    GROUP_COMMIT_TIMEOUT  seconds a request waits for its write
+"""
+import os
+import threading
+import time
+from queue import Queue, Empty
+from flask import current_app
+from flask.globals import _app_ctx_stack
+from werkzeug.exceptions import ServiceUnavailable
+from . import db
+
+
+class _Write(object):
+    """A write view queued with its arguments, request context and g."""
+    def __init__(self, view, args, kwargs, context, g):
+        self.view = view
+        self.args = args
+        self.kwargs = kwargs
+        self.context = context
+        self.g = g
+        self.response = None
+        self.exception = None
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def fail(self, e):
+        self.response, self.exception = None, e
+        self.done.set()
+
+
+class GroupCommitter(object):
+    def __init__(self, app, window=0.002, size=32, timeout=30):
+        self.app = app
+        self.window = window
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, view, args, kwargs, context, g):
+        """Run a view on the writer thread and return its response once it
+        is committed, or raise the exception that the view raised."""
+        write = _Write(view, args, kwargs, context, g)
+        queue, thread = self._writer()
+        queue.put(write)
+        deadline = time.time() + self.timeout
+        # the writer is checked every second, in case it died without
+        # answering this write
+        while not write.done.wait(min(1.0, max(0, deadline - time.time()))):
+            if not thread.is_alive():
+                write.fail(ServiceUnavailable('The writer thread stopped'))
+            elif time.time() >= deadline:
+                with self.lock:
+                    write.cancelled = True
+                raise ServiceUnavailable('Timed out waiting for the write')
+        if write.exception is not None:
+            raise write.exception
+        return write.response
+
+    def _writer(self):
+        # worker processes forked from the one that created the
+        # application start a writer thread of their own, and so does the
+        # first write after the writer died
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.queue = Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run,
+                                               args=(self.queue,),
+                                               name='group-commit')
+                self.thread.daemon = True
+                self.thread.start()
+            return self.queue, self.thread
+
+    def _run(self, queue):
+        writes = []
+        try:
+            while True:
+                writes = [queue.get()]
+                deadline = time.time() + self.window
+                while len(writes) < self.size:
+                    try:
+                        timeout = deadline - time.time()
+                        writes.append(queue.get(timeout=timeout)
+                                      if timeout > 0 else queue.get_nowait())
+                    except Empty:
+                        break
+                # the session of the writer lives as long as this context
+                with self.app.app_context():
+                    try:
+                        self._commit(writes)
+                    except Exception as e:
+                        # no request is left waiting for an answer
+                        for write in writes:
+                            if not write.done.is_set():
+                                write.fail(e)
+        except BaseException as e:
+            # the writer is gone: fail the writes it took and those queued
+            # behind them, later ones go to a new writer
+            for write in writes:
+                if not write.done.is_set():
+                    write.fail(e)
+            while True:
+                try:
+                    queue.get_nowait().fail(e)
+                except Empty:
+                    break
+            raise
+
+    def _commit(self, writes):
+        committed = []
+        for write in writes:
+            with self.lock:
+                write.started = not write.cancelled
+            if not write.started:
+                write.done.set()
+            elif self._execute(write):
+                committed.append(write)
+            else:
+                write.done.set()
+        if committed:
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                for write in committed:
+                    write.response, write.exception = None, e
+        for write in committed:
+            write.done.set()
+
+    def _execute(self, write):
+        """Run a view under a savepoint, which is rolled back if it fails.
+        Returns False if it failed."""
+        write.response = write.exception = None
+        # the request context reuses the application context of the writer,
+        # which holds its session, with the g of the request
+        app_context = _app_ctx_stack.top
+        writer_g, app_context.g = app_context.g, write.g
+        try:
+            with write.context:
+                session = db.session()
+                transaction = session.transaction
+                session.begin_nested()
+                # the commit of the view only ends this subtransaction
+                session.begin(subtransactions=True)
+                try:
+                    write.response = current_app.make_response(
+                        write.view(*write.args, **write.kwargs))
+                except Exception as e:
+                    write.exception = e
+                failed = write.exception is not None or \
+                    write.response.status_code >= 400
+                # views that do not write leave their subtransaction open
+                while session.transaction is not transaction:
+                    if failed:
+                        session.rollback()
+                    else:
+                        session.commit()
+            return not failed
+        finally:
+            app_context.g = writer_g
+
+
+def init_app(app):
+    """Start group commit if GROUP_COMMIT is set."""
+    if not app.config.get('GROUP_COMMIT'):
+        return
+    app.extensions['group_commit'] = GroupCommitter(
+        app, window=app.config.get('GROUP_COMMIT_WINDOW', 0.002),
+        size=app.config.get('GROUP_COMMIT_SIZE', 32),
+        timeout=app.config.get('GROUP_COMMIT_TIMEOUT', 30))
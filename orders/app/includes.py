@@ -0,0 +1,118 @@
+"""Compound documents.
+
+Clients can ask for related resources to be embedded in a response with
+?include=, a comma separated list of relationship paths such as
+customer,items,items.product. The related resources are returned under
+"included", grouped by collection, each of them once and without the
+primary resources. Every path is loaded with one IN query per chunk of ids,
+however many resources it reaches."""
+from collections import namedtuple
+from flask import request
+from .changes import _CHUNK_SIZE
+from .exceptions import ValidationError
+from .models import Customer, Product, Order, Item
+
+# to-one relationships have the foreign key on the resource (local), to-many
+# relationships on the related resources (remote)
+Relation = namedtuple('Relation', ('model', 'local', 'remote'))
+
+RELATIONS = {
+    Customer: {'orders': Relation(Order, None, 'customer_id')},
+    Product: {},
+    Order: {'customer': Relation(Customer, 'customer_id', None),
+            'items': Relation(Item, None, 'order_id')},
+    Item: {'order': Relation(Order, 'order_id', None),
+           'product': Relation(Product, 'product_id', None)},
+}
+# responses with included resources change when any of these do
+TABLES = [model.__tablename__ for model in RELATIONS]
+
+
+def requested_includes(model):
+    """Return the relationship paths given with ?include= as a tree of
+    nested dictionaries, or None when there are none."""
+    tree = {}
+    for path in request.args.get('include', '').split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node, current = tree, model
+        for name in path.split('.'):
+            relation = RELATIONS[current].get(name)
+            if relation is None:
+                raise ValidationError('Invalid include: ' + path)
+            node = node.setdefault(name, {})
+            current = relation.model
+    return tree or None
+
+
+def include_columns(model, tree):
+    """Return the columns of a resource that its includes are loaded
+    from."""
+    if not tree:
+        return ()
+    return tuple(sorted(set(RELATIONS[model][name].local or 'id'
+                            for name in tree)))
+
+
+def included(model, objects, tree):
+    """Load the resources that a tree of includes reaches from some
+    resources of a model, and return their representations by
+    collection."""
+    loaded = dict((related, {}) for related in RELATIONS)
+    _walk(model, objects, tree, loaded)
+    primary = set(obj.id for obj in objects)
+    rv = {}
+    for related, resources in loaded.items():
+        ids = sorted(id for id in resources
+                     if related is not model or id not in primary)
+        if ids:
+            rv[related.__tablename__] = [resources[id].export_data()
+                                         for id in ids]
+    return rv
+
+
+def _walk(model, objects, tree, loaded):
+    for name, subtree in sorted(tree.items()):
+        relation = RELATIONS[model][name]
+        related = _load(relation, objects, loaded[relation.model])
+        if subtree and related:
+            _walk(relation.model, related, subtree, loaded)
+
+
+def _load(relation, objects, loaded):
+    """Load the resources related to some objects, skipping those loaded
+    already for another path. Returns the related resources."""
+    model = relation.model
+    if relation.local is not None:
+        ids = set(getattr(obj, relation.local) for obj in objects)
+        ids.discard(None)
+        missing = sorted(ids - set(loaded))
+        for i in range(0, len(missing), _CHUNK_SIZE):
+            for obj in model.query.filter(
+                    model.id.in_(missing[i:i + _CHUNK_SIZE])):
+                loaded[obj.id] = obj
+        return [loaded[id] for id in sorted(ids) if id in loaded]
+
+    column = getattr(model, relation.remote)
+    ids = sorted(set(obj.id for obj in objects))
+    related = []
+    for i in range(0, len(ids), _CHUNK_SIZE):
+        for obj in model.query.filter(
+                column.in_(ids[i:i + _CHUNK_SIZE])).order_by(model.id):
+            related.append(loaded.setdefault(obj.id, obj))
+    return related
+
+
+def export_resource(model, id):
+    """Return the representation of a resource for a GET request, with the
+    fields requested with ?fields= and the resources requested with
+    ?include=. Raises a 404 error when the resource does not exist."""
+    fields = model.requested_fields()
+    includes = requested_includes(model)
+    obj = model.load_fields(model.query, fields,
+                            *include_columns(model, includes)).get_or_404(id)
+    rv = obj.export_data(fields)
+    if includes:
+        rv['included'] = included(model, [obj], includes)
+    return rv
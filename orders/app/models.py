@@ -1,12 +1,15 @@
 from datetime import datetime
-from dateutil import parser as datetime_parser
-from dateutil.tz import tzutc
+from time import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import url_for, current_app
+from sqlalchemy import event, func, literal_column
+from sqlalchemy.orm import Session, make_transient_to_detached, load_only, \
+	object_session
+from flask import current_app, g, request, has_app_context
 from . import db
+from .cache import record_changes
 from .exceptions import ValidationError
-from .utils import split_url
+from .utils import split_url, fast_url_for, parse_date
 
 
 class User(db.Model):
@@ -27,28 +30,146 @@ class User(db.Model):
 
 	@staticmethod
 	def verify_auth_token(token):
-		s = Serializer(current_app.config['SECRET_KEY'])
-		try:
-			data = s.loads(token)
-		except:
+		auth = current_app.extensions['auth']
+		user_id = auth['tokens'].get(token)
+		if user_id is None:
+			try:
+				data, header = auth['serializer'].loads(token, return_header=True)
+			except:
+				return None
+			user_id = data['id']
+			# remember the token until it expires
+			auth['tokens'].set(token, user_id, header['exp'])
+		return User.get_cached(user_id)
+
+	@staticmethod
+	def get_cached(id):
+		"""Return the user with the given id, reusing a cached copy of the
+		row when there is one instead of querying the database."""
+		users = current_app.extensions['auth']['users']
+		user = users.get(id)
+		if user is not None:
+			return db.session.merge(user, load=False)
+		user = User.query.get(id)
+		if user is not None:
+			copy = User(id=user.id, username=user.username,
+				password_hash=user.password_hash)
+			make_transient_to_detached(copy)
+			users.set(id, copy,
+				time() + current_app.config.get('AUTH_USER_CACHE_TTL', 300))
+		return user
+
+
+def _forget_user(mapper, connection, target):
+	# a changed or deleted user must not authenticate with its cached copy;
+	# the copy is dropped again on commit, as concurrent requests can cache
+	# the old row until then
+	if has_app_context():
+		current_app.extensions['auth']['users'].delete(target.id)
+		object_session(target).info.setdefault('changed_users',
+			set()).add(target.id)
+
+
+def _forget_committed_users(session):
+	ids = session.info.pop('changed_users', None)
+	if ids and has_app_context():
+		users = current_app.extensions['auth']['users']
+		for id in ids:
+			users.delete(id)
+
+
+def _discard_changed_users(session):
+	session.info.pop('changed_users', None)
+
+
+event.listen(User, 'after_update', _forget_user)
+event.listen(User, 'after_delete', _forget_user)
+event.listen(Session, 'after_commit', _forget_committed_users)
+event.listen(Session, 'after_rollback', _discard_changed_users)
+
+
+def _known_products():
+	"""Ids of the products that were found to exist during this request, so
+	that repeated product URLs are only looked up once."""
+	known = getattr(g, 'known_products', None)
+	if known is None:
+		known = g.known_products = set()
+	return known
+
+
+def _wanted(fields, name):
+	return fields is None or name in fields
+
+
+class ExportMixin(object):
+	"""Sparse fieldsets. Clients can ask for some of the fields of
+	export_data() with ?fields=, and only the columns listed for them in
+	__export_fields__ are loaded."""
+	__export_fields__ = {}
+
+	@classmethod
+	def requested_fields(cls):
+		"""Return the set of fields given with ?fields=, or None for all of
+		them."""
+		value = request.args.get('fields')
+		fields = frozenset(f.strip() for f in (value or '').split(',')
+			if f.strip())
+		if not fields:
 			return None
-		return User.query.get(data['id'])
+		unknown = fields - set(cls.__export_fields__)
+		if unknown:
+			raise ValidationError('Invalid fields: ' + ', '.join(sorted(unknown)))
+		return fields
+
+	@classmethod
+	def load_fields(cls, query, fields, *columns):
+		"""Restrict a query to the columns needed by a set of fields, plus
+		the given ones."""
+		if fields is None:
+			return query
+		columns = set(columns)
+		for field in fields:
+			columns.update(cls.__export_fields__[field])
+		return query.options(load_only(*sorted(columns)))
+
+
+class VersionedMixin(object):
+	"""Columns bumped on every write, used to answer conditional requests
+	without rendering the resources."""
+	version = db.Column(db.Integer, nullable=False, default=1,
+		onupdate=literal_column('version') + 1)
+	updated_at = db.Column(db.DateTime, nullable=False,
+		default=datetime.utcnow, onupdate=datetime.utcnow)
 
-class Customer(db.Model):
+	@classmethod
+	def version_of(cls, id):
+		"""Return the (version, updated_at) of a resource, or None if it
+		does not exist."""
+		return db.session.query(cls.version, cls.updated_at) \
+			.filter(cls.id == id).first()
+
+
+class Customer(ExportMixin, VersionedMixin, db.Model):
 	__tablename__ = 'customers'
+	# columns needed by each field of export_data()
+	__export_fields__ = {'self_url': ('id',), 'name': ('name',),
+		'orders_url': ('id',)}
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(64), index=True)
 	orders = db.relationship('Order', backref='customer', lazy='dynamic')
 
 	def get_url(self):
-		return url_for('api.get_customer', id=self.id, _external=True)
+		return fast_url_for('api.get_customer', id=self.id)
 
-	def export_data(self):
-		return {
-			'self_url': self.get_url(),
-			'name': self.name,
-			'orders_url': url_for('api.get_customer_orders', id=self.id, _external=True)
-		}
+	def export_data(self, fields=None):
+		rv = {}
+		if _wanted(fields, 'self_url'):
+			rv['self_url'] = self.get_url()
+		if _wanted(fields, 'name'):
+			rv['name'] = self.name
+		if _wanted(fields, 'orders_url'):
+			rv['orders_url'] = fast_url_for('api.get_customer_orders', id=self.id)
+		return rv
 
 	def import_data(self, data):
 		try:
@@ -58,20 +179,24 @@ class Customer(db.Model):
 		return self
 
 
-class Product(db.Model):
+class Product(ExportMixin, VersionedMixin, db.Model):
 	__tablename__ = 'products'
+	# columns needed by each field of export_data()
+	__export_fields__ = {'self_url': ('id',), 'name': ('name',)}
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(64), index=True)
 	items = db.relationship('Item', backref='product', lazy='dynamic')
 
 	def get_url(self):
-		return url_for('api.get_product', id=self.id, _external=True)
+		return fast_url_for('api.get_product', id=self.id)
 
-	def export_data(self):
-		return {
-			'self_url': self.get_url(),
-			'name': self.name
-		}
+	def export_data(self, fields=None):
+		rv = {}
+		if _wanted(fields, 'self_url'):
+			rv['self_url'] = self.get_url()
+		if _wanted(fields, 'name'):
+			rv['name'] = self.name
+		return rv
 
 	def import_data(self, data):
 		try:
@@ -81,8 +206,24 @@ class Product(db.Model):
 		return self
 
 
-class Order(db.Model):
+def _forget_product(mapper, connection, target):
+	# later items of the request must not reference a deleted product
+	if has_app_context():
+		_known_products().discard(target.id)
+
+
+event.listen(Product, 'after_delete', _forget_product)
+
+
+class Order(ExportMixin, VersionedMixin, db.Model):
 	__tablename__ = 'orders'
+	__table_args__ = (
+		db.Index('ix_orders_date_id', 'date', 'id'),
+		db.Index('ix_orders_customer_id_date_id', 'customer_id', 'date', 'id'),
+	)
+	# columns needed by each field of export_data()
+	__export_fields__ = {'self_url': ('id',), 'customer_url': ('customer_id',),
+		'date': ('date',), 'items_url': ('id',)}
 	id = db.Column(db.Integer, primary_key=True)
 	customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), index=True)
 	date = db.Column(db.DateTime, default=datetime.now)
@@ -90,51 +231,261 @@ class Order(db.Model):
 		cascade='all, delete-orphan')
 
 	def get_url(self):
-		return url_for('api.get_order', id=self.id, _external=True)
+		return fast_url_for('api.get_order', id=self.id)
 
-	def export_data(self):
-		return {
-			'self_url': self.get_url(),
-			'customer_url': self.customer.get_url(),
-			'date': self.date.isoformat() + 'Z',
-			'items_url': url_for('api.get_order_items', id=self.id, _external=True)
-		}
+	def export_data(self, fields=None):
+		# related resources are linked from the foreign keys, without
+		# loading them
+		rv = {}
+		if _wanted(fields, 'self_url'):
+			rv['self_url'] = self.get_url()
+		if _wanted(fields, 'customer_url'):
+			rv['customer_url'] = fast_url_for('api.get_customer',
+				id=self.customer_id)
+		if _wanted(fields, 'date'):
+			rv['date'] = self.date.isoformat() + 'Z'
+		if _wanted(fields, 'items_url'):
+			rv['items_url'] = fast_url_for('api.get_order_items', id=self.id)
+		return rv
 
 	def import_data(self, data):
 		try:
-			self.date = datetime_parser.parse(data['date']).astimezone(tzutc()).replace(tzinfo=None)
+			self.date = parse_date(data['date'])
 		except KeyError as e:
 			raise ValidationError('Invalid order: missing ' + e.args[0])
 		return self
 
 
-class Item(db.Model):
+class Item(ExportMixin, VersionedMixin, db.Model):
 	__tablename__ = 'items'
+	__table_args__ = (
+		# the orders of a product, without reading the items
+		db.Index('ix_items_product_id_order_id', 'product_id', 'order_id'),
+	)
+	# columns needed by each field of export_data()
+	__export_fields__ = {'self_url': ('id',), 'order_url': ('order_id',),
+		'product_url': ('product_id',), 'quantity': ('quantity',)}
 	id = db.Column(db.Integer, primary_key=True)
 	order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
-	product_id = db.Column(db.Integer, db.ForeignKey('products.id'), index=True)
+	product_id = db.Column(db.Integer, db.ForeignKey('products.id'))
 	quantity = db.Column(db.Integer)
 
 	def get_url(self):
-		return url_for('api.get_item', id=self.id, _external=True)
+		return fast_url_for('api.get_item', id=self.id)
 
-	def export_data(self):
-		return {
-			'self_url': self.get_url(),
-			'order_url': self.order.get_url(),
-			'product_url': self.product.get_url(),
-			'quantity': self.quantity
-		}
+	def export_data(self, fields=None):
+		rv = {}
+		if _wanted(fields, 'self_url'):
+			rv['self_url'] = self.get_url()
+		if _wanted(fields, 'order_url'):
+			rv['order_url'] = fast_url_for('api.get_order', id=self.order_id)
+		if _wanted(fields, 'product_url'):
+			rv['product_url'] = fast_url_for('api.get_product',
+				id=self.product_id)
+		if _wanted(fields, 'quantity'):
+			rv['quantity'] = self.quantity
+		return rv
 
-	def import_data(self, data):
+	@staticmethod
+	def parse_data(data):
+		"""Validate an item without touching the database. Returns the id of
+		the product and the quantity."""
 		try:
 			endpoint, args = split_url(data['product_url'])
-			self.quantity = int(data['quantity'])
+			quantity = data['quantity']
 		except KeyError as e:
 			raise ValidationError('Invalid order: missing ' + e.args[0])
+		# only the conversion: ValidationError is a ValueError too
+		try:
+			quantity = int(quantity)
+		except (TypeError, ValueError):
+			raise ValidationError('Invalid quantity: ' + str(quantity))
 		if endpoint != 'api.get_product' or not 'id' in args:
 			raise ValidationError('Invalid product URL: ' + data['product_url'])
-		self.product = Product.query.get(args['id'])
-		if self.product is None:
-			raise ValidationError('Invalid product URL: ' + data['product_url'])
+		return args['id'], quantity
+
+	def import_data(self, data):
+		product_id, self.quantity = Item.parse_data(data)
+		known = _known_products()
+		if product_id not in known:
+			if db.session.query(Product.id).filter_by(id=product_id) \
+					.first() is None:
+				raise ValidationError('Invalid product URL: ' + data['product_url'])
+			known.add(product_id)
+		self.product_id = product_id
 		return self
+
+	@staticmethod
+	def import_many(data):
+		"""Validate a list of items with the same rules as import_data(),
+		loading all the products they reference with a single query. Returns
+		the column values of the items, or raises a ValidationError that
+		lists the problems with every invalid entry."""
+		if not isinstance(data, list):
+			raise ValidationError('Invalid items: expected a list')
+		parsed = []
+		errors = []
+		for i, entry in enumerate(data):
+			try:
+				if not isinstance(entry, dict):
+					raise ValidationError('Invalid item: expected an object')
+				parsed.append(Item.parse_data(entry))
+			except ValidationError as e:
+				parsed.append(None)
+				errors.append((i, e.args[0]))
+		found = _known_products()
+		ids = set(p[0] for p in parsed if p is not None) - found
+		if ids:
+			found.update(id for (id,) in db.session.query(Product.id)
+				.filter(Product.id.in_(ids)))
+		rows = []
+		for i, p in enumerate(parsed):
+			if p is None:
+				continue
+			if p[0] not in found:
+				errors.append((i, 'Invalid product URL: ' + data[i]['product_url']))
+			else:
+				rows.append({'product_id': p[0], 'quantity': p[1]})
+		if errors:
+			raise ValidationError('Invalid items', ['items[{0}]: {1}'.format(i, e)
+				for i, e in sorted(errors)])
+		return rows
+
+	@staticmethod
+	def insert_many(order_id, rows):
+		"""Add items to an order with a single multi-row insert, bypassing
+		the unit of work. Returns the ids of the new items, in the order of
+		the rows."""
+		if not rows:
+			return []
+		table = Item.__table__
+		params = [dict(row, order_id=order_id) for row in rows]
+		dialect = db.session.get_bind(Item.__mapper__).dialect
+		if dialect.implicit_returning and dialect.supports_multivalues_insert:
+			ids = [id for (id,) in db.session.execute(
+				table.insert().values(params).returning(table.c.id))]
+		else:
+			# read back the rows of the order newer than the ones it had,
+			# which must be the inserted ones unless another transaction
+			# added items to the order at the same time
+			last = db.session.query(func.max(Item.id)) \
+				.filter_by(order_id=order_id).scalar() or 0
+			db.session.execute(table.insert(), params)
+			new = db.session.query(Item.id, Item.product_id, Item.quantity) \
+				.filter(Item.order_id == order_id, Item.id > last) \
+				.order_by(Item.id).all()
+			if [(p, q) for id, p, q in new] != \
+					[(row['product_id'], row['quantity']) for row in rows]:
+				raise RuntimeError('Concurrent insert of items into order ' +
+					str(order_id))
+			ids = [id for id, p, q in new]
+		record_changes(db.session, Item.__tablename__)
+		from .summaries import add_items
+		add_items(db.session, order_id, rows)
+		from .changes import record
+		record(db.session, Item.__tablename__, 'created',
+			[(id, order_id) for id in ids])
+		return ids
+
+
+class OrderTotals(db.Model):
+	"""Number of items and units in an order, kept up to date on writes."""
+	__tablename__ = 'order_totals'
+	order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), primary_key=True)
+	items = db.Column(db.Integer, nullable=False, default=0)
+	units = db.Column(db.Integer, nullable=False, default=0)
+
+	@staticmethod
+	def get_or_empty(id):
+		return OrderTotals.query.get(id) or \
+			OrderTotals(order_id=id, items=0, units=0)
+
+	def export_data(self):
+		return {
+			'order_url': fast_url_for('api.get_order', id=self.order_id),
+			'items': self.items,
+			'units': self.units
+		}
+
+
+class CustomerSummary(db.Model):
+	"""Number of orders, items and units of a customer, kept up to date on
+	writes."""
+	__tablename__ = 'customer_summaries'
+	customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'),
+		primary_key=True)
+	orders = db.Column(db.Integer, nullable=False, default=0)
+	items = db.Column(db.Integer, nullable=False, default=0)
+	units = db.Column(db.Integer, nullable=False, default=0)
+
+	@staticmethod
+	def get_or_empty(id):
+		return CustomerSummary.query.get(id) or \
+			CustomerSummary(customer_id=id, orders=0, items=0, units=0)
+
+	def export_data(self):
+		return {
+			'customer_url': fast_url_for('api.get_customer', id=self.customer_id),
+			'orders': self.orders,
+			'items': self.items,
+			'units': self.units
+		}
+
+
+class ProductSales(db.Model):
+	"""Number of order items and units sold of a product, kept up to date on
+	writes."""
+	__tablename__ = 'product_sales'
+	product_id = db.Column(db.Integer, db.ForeignKey('products.id'),
+		primary_key=True)
+	items = db.Column(db.Integer, nullable=False, default=0)
+	units = db.Column(db.Integer, nullable=False, default=0)
+
+	@staticmethod
+	def get_or_empty(id):
+		return ProductSales.query.get(id) or \
+			ProductSales(product_id=id, items=0, units=0)
+
+	def export_data(self):
+		return {
+			'product_url': fast_url_for('api.get_product', id=self.product_id),
+			'items': self.items,
+			'units': self.units
+		}
+
+
+class Change(db.Model):
+	"""Last change of every api resource, in commit order. Each write
+	replaces the entry of the resource with a new one at the end of the log,
+	and deleted resources keep theirs as a tombstone. The autoincrement id
+	is the cursor of the change feeds; it is never reused, and as SQLite
+	serializes writers, ids are assigned in commit order."""
+	__tablename__ = 'changes'
+	__table_args__ = (
+		db.Index('ix_changes_resource_resource_id', 'resource', 'resource_id'),
+		db.Index('ix_changes_resource_id', 'resource', 'id'),
+		db.Index('ix_changes_resource_parent_id_id', 'resource', 'parent_id',
+			'id'),
+		{'sqlite_autoincrement': True}
+	)
+	id = db.Column(db.Integer, primary_key=True)
+	resource = db.Column(db.String(16), nullable=False)
+	resource_id = db.Column(db.Integer, nullable=False)
+	# the customer of an order, or the order of an item
+	parent_id = db.Column(db.Integer)
+	operation = db.Column(db.String(8), nullable=False)
+	changed_at = db.Column(db.DateTime, nullable=False,
+		default=datetime.utcnow)
+
+	def export_data(self):
+		return {
+			'url': fast_url_for(_RESOURCE_ENDPOINTS[self.resource],
+				id=self.resource_id),
+			'resource': self.resource,
+			'operation': self.operation,
+			'changed_at': self.changed_at.isoformat() + 'Z'
+		}
+
+_RESOURCE_ENDPOINTS = {'customers': 'api.get_customer',
+	'products': 'api.get_product', 'orders': 'api.get_order',
+	'items': 'api.get_item'}
@@ -0,0 +1,166 @@
+"""Per-request profiling.
+
+With PROFILING enabled, every request is split into phases that follow each
+other: 'auth' until the api blueprint has authenticated the client, 'view'
+while the view function runs its queries, 'export' while resources are
+converted to dictionaries, 'serialize' while the JSON is generated and
+'etag' while the response is hashed. SQL statements are counted and timed
+separately. The timings are sent in a Server-Timing header, and aggregated
+per endpoint into histograms served by /api/v1/_stats.
+
+mark() is the only call made from the request path when profiling is
+disabled, and it returns after one attribute lookup. No handlers or
+database events are installed at all in that case.
+"""
+import threading
+from bisect import bisect_left
+from time import time
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+_sql_events_lock = threading.Lock()
+_sql_events = False
+
+
+class Profile(object):
+    """Phase and SQL timings of one request."""
+    def __init__(self, phase):
+        self.start = self.phase_start = time()
+        self.phase = phase
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.total = None
+
+    def mark(self, phase):
+        now = time()
+        if self.phase is not None:
+            self.phases[self.phase] = self.phases.get(self.phase, 0.0) + \
+                now - self.phase_start
+        self.phase = phase
+        self.phase_start = now
+
+    def finish(self):
+        # closes the last phase, later marks are not recorded
+        self.mark(None)
+        self.total = time() - self.start
+
+    def server_timing(self):
+        """Return the value of the Server-Timing header, in milliseconds."""
+        metrics = ['{0};dur={1:.2f}'.format(phase, duration * 1000)
+                   for phase, duration in sorted(self.phases.items())]
+        metrics.append('sql;desc="{0} queries";dur={1:.2f}'.format(
+            self.sql_count, self.sql_time * 1000))
+        metrics.append('total;dur={0:.2f}'.format(self.total * 1000))
+        return ', '.join(metrics)
+
+
+class ProfileStats(object):
+    """Per-endpoint aggregates of the profiles of this process."""
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, profile):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'total_ms': 0.0, 'sql_count': 0,
+                    'sql_ms': 0.0, 'phases_ms': {},
+                    'histogram': [0] * len(BUCKETS)}
+            total = profile.total * 1000
+            stats['requests'] += 1
+            stats['total_ms'] += total
+            stats['sql_count'] += profile.sql_count
+            stats['sql_ms'] += profile.sql_time * 1000
+            for phase, duration in profile.phases.items():
+                stats['phases_ms'][phase] = \
+                    stats['phases_ms'].get(phase, 0.0) + duration * 1000
+            stats['histogram'][bisect_left(BUCKETS, total)] += 1
+
+    def export_data(self):
+        with self.lock:
+            rv = {}
+            for endpoint, stats in self.endpoints.items():
+                n = float(stats['requests'])
+                rv[endpoint] = {
+                    'requests': stats['requests'],
+                    'mean_ms': round(stats['total_ms'] / n, 3),
+                    'mean_sql_count': round(stats['sql_count'] / n, 2),
+                    'mean_sql_ms': round(stats['sql_ms'] / n, 3),
+                    'mean_phases_ms': dict(
+                        (phase, round(duration / n, 3))
+                        for phase, duration in stats['phases_ms'].items()),
+                    'histogram_ms': dict(
+                        ('le_' + ('inf' if bound == float('inf')
+                                  else str(bound)), count)
+                        for bound, count in zip(BUCKETS, stats['histogram']))
+                }
+            return rv
+
+
+def mark(phase):
+    """Start a new phase in the profile of the current request."""
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        profile.mark(phase)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_app_context() and getattr(g, 'profile', None) is not None:
+        conn.info.setdefault('profile_query_start', []).append(time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('profile_query_start')
+    if starts:
+        elapsed = time() - starts.pop()
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            profile.sql_count += 1
+            profile.sql_time += elapsed
+
+
+def _listen_sql():
+    global _sql_events
+    with _sql_events_lock:
+        if not _sql_events:
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            _sql_events = True
+
+
+def init_app(app):
+    """Install the profiling handlers if PROFILING is enabled."""
+    if not app.config.get('PROFILING'):
+        return
+    _listen_sql()
+    stats = app.extensions['profiling'] = ProfileStats()
+
+    @app.before_request
+    def start_profile():
+        g.profile = Profile('auth')
+
+    def end_auth():
+        # runs after the blueprint has authenticated the client
+        mark('view')
+    app.before_request_funcs.setdefault('api', []).append(end_auth)
+
+    @app.after_request
+    def finish_profile(rv):
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            g.profile = None
+            profile.finish()
+            rv.headers['Server-Timing'] = profile.server_timing()
+            stats.record(request.endpoint, profile)
+        return rv
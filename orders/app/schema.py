@@ -0,0 +1,53 @@
+"""Upgrades of databases created by earlier versions of the application.
+
+db.create_all() creates the tables that are missing, but leaves the ones
+that exist as they are. upgrade() also adds the columns and indexes that
+the models gained since those tables were created, so that an existing
+database does not have to be rebuilt. The aggregate tables and the search
+indexes of an upgraded database are then filled by rebuild() in
+app.summaries and app.search, see rebuild_summaries.py. Its change log
+starts empty, with the first writes after the upgrade."""
+from datetime import datetime
+from sqlalchemy import inspect
+from . import db
+
+# indexes that were replaced by others
+_DROPPED_INDEXES = {'items': ('ix_items_product_id',)}
+
+
+def _add_column(engine, table, column, now):
+    ddl = 'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+        table.name, column.name, column.type.compile(dialect=engine.dialect))
+    if not column.nullable:
+        # the rows that exist get the default of the column, or the time of
+        # the upgrade when it is computed on insert
+        default = column.default.arg
+        if callable(default):
+            default = now
+        if not isinstance(default, int):
+            default = "'{0}'".format(default)
+        ddl += ' NOT NULL DEFAULT {0}'.format(default)
+    engine.execute(ddl)
+
+
+def upgrade():
+    """Bring the schema of the database up to date with the models. Does
+    nothing on a database that is already up to date."""
+    engine = db.engine
+    db.create_all()
+    inspector = inspect(engine)
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    for table in db.metadata.sorted_tables:
+        columns = set(column['name']
+                      for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                _add_column(engine, table, column, now)
+        indexes = set(index['name']
+                      for index in inspector.get_indexes(table.name))
+        for name in _DROPPED_INDEXES.get(table.name, ()):
+            if name in indexes:
+                engine.execute('DROP INDEX ' + name)
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
@@ -0,0 +1,94 @@
+"""Full-text search on the names of customers and products.
+
+customers_fts and products_fts are FTS5 indexes of the name column, which
+read the names from the tables they index. They are created along with
+those tables, and kept in sync by triggers, so rows written by bulk inserts
+are indexed like the rest. rebuild() creates them in databases that
+predate them and indexes every name again.
+
+SQLite libraries built without FTS5 get no indexes, and searches scan the
+names with LIKE instead, as they do on other databases."""
+import re
+from sqlalchemy import event, DDL, select, literal_column, and_, or_
+from sqlalchemy.sql import table, column
+from . import db
+from .models import Customer, Product
+
+_SEARCHABLE = (Customer, Product)
+_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {0}_fts USING fts5(name, "
+    "content='{0}', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS {0}_fts_insert AFTER INSERT ON {0} BEGIN "
+    "INSERT INTO {0}_fts (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {0}_fts_delete AFTER DELETE ON {0} BEGIN "
+    "INSERT INTO {0}_fts ({0}_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {0}_fts_update AFTER UPDATE OF name ON {0} "
+    "BEGIN INSERT INTO {0}_fts ({0}_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); "
+    "INSERT INTO {0}_fts (rowid, name) VALUES (new.id, new.name); END",
+)
+_DROP = "DROP TABLE IF EXISTS {0}_fts"
+# whether the SQLite library has FTS5, the same for every connection
+_fts5 = None
+
+
+def has_fts5(bind):
+    """Return True if the SQLite library was built with FTS5."""
+    global _fts5
+    if _fts5 is None:
+        _fts5 = bool(bind.execute(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+    return _fts5
+
+
+def _use_fts5(ddl, target, bind, **kwargs):
+    return bind.dialect.name == 'sqlite' and has_fts5(bind)
+
+
+def search(query, model, terms):
+    """Restrict a query of customers or products to those with a word in
+    their name that starts with each of the words in terms."""
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    if not words:
+        return query
+    bind = query.session.get_bind(model.__mapper__)
+    if bind.dialect.name != 'sqlite' or not has_fts5(bind):
+        # without an index of words, every name is scanned for words that
+        # start with the terms
+        conditions = []
+        for word in words:
+            word = word.replace('_', '\\_')
+            conditions.append(or_(model.name.ilike(word + '%', escape='\\'),
+                                  model.name.ilike('% ' + word + '%',
+                                                   escape='\\')))
+        return query.filter(and_(*conditions))
+    fts = table(model.__tablename__ + '_fts', column('rowid'))
+    match = ' '.join('"{0}"*'.format(word) for word in words)
+    return query.filter(model.id.in_(
+        select([fts.c.rowid]).where(
+            literal_column(fts.name).op('MATCH')(match))))
+
+
+def rebuild():
+    """Create the search indexes if they are missing and index all the
+    names again."""
+    if not has_fts5(db.engine):
+        return
+    for model in _SEARCHABLE:
+        name = model.__tablename__
+        for statement in _CREATE:
+            db.session.execute(statement.format(name))
+        db.session.execute(
+            "INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(name))
+    db.session.commit()
+
+
+for model in _SEARCHABLE:
+    for statement in _CREATE:
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement.format(model.__tablename__))
+                     .execute_if(callable_=_use_fts5))
+    event.listen(model.__table__, 'before_drop',
+                 DDL(_DROP.format(model.__tablename__))
+                 .execute_if(dialect='sqlite'))
@@ -0,0 +1,159 @@
+"""Maintenance of the aggregate tables.
+
+OrderTotals, CustomerSummary and ProductSales are updated with deltas in
+the same transaction as the writes to orders and items that change them, so
+reading an aggregate is a primary key lookup. rebuild() recomputes all of
+them from scratch."""
+from collections import defaultdict
+from itertools import chain
+from sqlalchemy import event, func, select, distinct
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from . import db
+from .cache import record_changes
+from .models import Order, Item, OrderTotals, CustomerSummary, ProductSales
+
+_KEYS = {OrderTotals: 'order_id', CustomerSummary: 'customer_id',
+         ProductSales: 'product_id'}
+
+
+class _Deltas(object):
+    """Changes to the aggregate tables accumulated during a flush."""
+    def __init__(self, session):
+        self.session = session
+        self.deltas = defaultdict(lambda: defaultdict(int))
+        self.customers = {}
+        self.dropped_orders = set()
+
+    def customer_of(self, order_id):
+        if order_id not in self.customers:
+            self.customers[order_id] = self.session.execute(
+                select([Order.customer_id]).where(Order.id == order_id)) \
+                .scalar()
+        return self.customers[order_id]
+
+    def add_order(self, customer_id, order_id, sign):
+        self.customers[order_id] = customer_id
+        if customer_id is not None:
+            self.deltas[(CustomerSummary, customer_id)]['orders'] += sign
+        if sign > 0:
+            self.deltas[(OrderTotals, order_id)]['items'] += 0
+        else:
+            self.dropped_orders.add(order_id)
+
+    def add_item(self, order_id, product_id, quantity, sign):
+        for model, key in [(OrderTotals, order_id),
+                           (CustomerSummary, self.customer_of(order_id)),
+                           (ProductSales, product_id)]:
+            if key is not None:
+                delta = self.deltas[(model, key)]
+                delta['items'] += sign
+                delta['units'] += sign * (quantity or 0)
+
+    def apply(self):
+        """Write the accumulated deltas to the database."""
+        if not self.deltas and not self.dropped_orders:
+            return
+        for (model, key), delta in self.deltas.items():
+            if model is OrderTotals and key in self.dropped_orders:
+                continue
+            table = model.__table__
+            column = table.c[_KEYS[model]]
+            result = self.session.execute(table.update()
+                .where(column == key)
+                .values(**dict((name, table.c[name] + value)
+                               for name, value in delta.items())))
+            if result.rowcount == 0:
+                self.session.execute(table.insert().values(
+                    **dict(delta, **{_KEYS[model]: key})))
+        if self.dropped_orders:
+            table = OrderTotals.__table__
+            self.session.execute(table.delete().where(
+                table.c.order_id.in_(self.dropped_orders)))
+        record_changes(self.session, *[model.__tablename__
+                                       for model in _KEYS])
+
+
+def _committed(obj, attr):
+    """Return the value an attribute had before the changes being flushed."""
+    history = get_history(obj, attr)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, attr)
+
+
+def _item_key(obj, current):
+    get = getattr if current else _committed
+    return get(obj, 'order_id'), get(obj, 'product_id'), get(obj, 'quantity')
+
+
+def _cascade_deletes(session, flush_context, instances):
+    """Mark the items of deleted orders as deleted before the flush. The
+    dynamic Order.items relationship only cascades while flushing, too late
+    for the items to be in session.deleted in after_flush handlers."""
+    for obj in list(session.deleted):
+        if isinstance(obj, Order):
+            for item in obj.items:
+                session.delete(item)
+
+
+def _update_summaries(session, flush_context):
+    deltas = _Deltas(session)
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, Order):
+            deltas.add_order(_committed(obj, 'customer_id'), obj.id,
+                             1 if obj in session.new else -1)
+    for obj in session.new:
+        if isinstance(obj, Item):
+            deltas.add_item(*_item_key(obj, True), sign=1)
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            deltas.add_item(*_item_key(obj, False), sign=-1)
+    for obj in session.dirty:
+        if isinstance(obj, Item) and session.is_modified(obj):
+            old, new = _item_key(obj, False), _item_key(obj, True)
+            if old != new:
+                deltas.add_item(*old, sign=-1)
+                deltas.add_item(*new, sign=1)
+    deltas.apply()
+
+
+def add_items(session, order_id, rows):
+    """Account for items that were inserted without going through the unit
+    of work, as Item.insert_many() does."""
+    deltas = _Deltas(session)
+    for row in rows:
+        deltas.add_item(order_id, row['product_id'], row['quantity'], 1)
+    deltas.apply()
+
+
+def rebuild():
+    """Recompute all the aggregate tables from the orders and items."""
+    for model in _KEYS:
+        db.session.execute(model.__table__.delete())
+    orders, items = Order.__table__, Item.__table__
+    joined = orders.outerjoin(items, items.c.order_id == orders.c.id)
+    units = func.coalesce(func.sum(items.c.quantity), 0)
+    db.session.execute(OrderTotals.__table__.insert().from_select(
+        ['order_id', 'items', 'units'],
+        select([orders.c.id, func.count(items.c.id), units])
+        .select_from(joined).group_by(orders.c.id)))
+    db.session.execute(CustomerSummary.__table__.insert().from_select(
+        ['customer_id', 'orders', 'items', 'units'],
+        select([orders.c.customer_id, func.count(distinct(orders.c.id)),
+                func.count(items.c.id), units])
+        .select_from(joined).where(orders.c.customer_id != None)
+        .group_by(orders.c.customer_id)))
+    db.session.execute(ProductSales.__table__.insert().from_select(
+        ['product_id', 'items', 'units'],
+        select([items.c.product_id, func.count(items.c.id), units])
+        .where(items.c.product_id != None)
+        .group_by(items.c.product_id)))
+    record_changes(db.session, *[model.__tablename__ for model in _KEYS])
+    db.session.commit()
+
+
+event.listen(Session, 'before_flush', _cascade_deletes)
+event.listen(Session, 'after_flush', _update_summaries)
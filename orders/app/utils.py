@@ -1,11 +1,21 @@
+import re
+from dateutil import parser as datetime_parser
+from dateutil.tz import tzutc
+from flask import url_for, current_app
 from flask.globals import _app_ctx_stack, _request_ctx_stack
-from werkzeug.urls import url_parse
+from werkzeug.urls import url_parse, url_encode
 from werkzeug.exceptions import NotFound
+from .cache import LRUCache
+from .exceptions import ValidationError
 
+# placeholder id used to find where ids go in the URL templates
+_ID_MARKER = 918273645
+_url_templates = LRUCache(256)
+_split_urls = LRUCache(4096)
 
-def split_url(url, method='GET'):
-    """Returns the endpoint name and arguments that match a given URL. In
-    other words, this is the reverse of Flask's url_for()."""
+
+def _url_adapter():
+    """Return the URL adapter that url_for() would use."""
     appctx = _app_ctx_stack.top
     reqctx = _request_ctx_stack.top
     if appctx is None:
@@ -22,12 +32,106 @@ def split_url(url, method='GET'):
                                'adapter for request independent URL matching. '
                                'You might be able to fix this by setting '
                                'the SERVER_NAME config variable.')
+    return url_adapter
+
+
+def fast_url_for(endpoint, **values):
+    """Returns the same URL as url_for(endpoint, _external=True, **values)
+    for routes whose only argument is an integer `id`, which covers all the
+    resources in the api blueprint.
+
+    The first call for an endpoint and host builds the URL with url_for()
+    and keeps it as a template, later calls only insert the id and encode
+    any remaining values as the query string, leaving out those that are
+    None as url_for() does."""
+    url_adapter = _url_adapter()
+    id = values.pop('id', None)
+    # applications have URL maps of their own, which may differ
+    key = (endpoint, id is None, url_adapter.map, url_adapter.url_scheme,
+           url_adapter.server_name, url_adapter.script_name,
+           url_adapter.subdomain)
+    template = _url_templates.get(key)
+    if template is None:
+        if id is None:
+            template = (url_for(endpoint, _external=True), '')
+        else:
+            template = tuple(url_for(endpoint, id=_ID_MARKER, _external=True)
+                             .split(str(_ID_MARKER), 1))
+        _url_templates.set(key, template)
+    if id is None:
+        url = template[0]
+    else:
+        url = template[0] + str(int(id)) + template[1]
+    values = dict((name, value) for name, value in values.items()
+                  if value is not None)
+    if values:
+        url += '?' + url_encode(values)
+    return url
+
+
+def _route_patterns():
+    """Return regular expressions for the GET routes of the api blueprint,
+    which take an integer id or no arguments at all, along with their
+    endpoints."""
+    patterns = current_app.extensions.get('route_patterns')
+    if patterns is None:
+        patterns = []
+        for rule in current_app.url_map.iter_rules():
+            if not rule.endpoint.startswith('api.get_') or \
+                    'GET' not in rule.methods:
+                continue
+            parts = rule.rule.split('<int:id>')
+            if rule.arguments - set(['id']) or len(parts) > 2 or \
+                    (rule.arguments and len(parts) != 2):
+                continue
+            regex = r'(\d+)'.join(re.escape(part) for part in parts)
+            patterns.append((re.compile('^' + regex + '$'), rule.endpoint))
+        current_app.extensions['route_patterns'] = patterns
+    return patterns
+
+
+def _match_fast(path):
+    """Match a path against the api resource routes without going through
+    the werkzeug matcher. Returns None if no route matches."""
+    for pattern, endpoint in _route_patterns():
+        match = pattern.match(path)
+        if match is not None:
+            if pattern.groups:
+                return endpoint, {'id': int(match.group(1))}
+            return endpoint, {}
+    return None
+
+
+def split_url(url, method='GET'):
+    """Returns the endpoint name and arguments that match a given URL. In
+    other words, this is the reverse of Flask's url_for().
+
+    Results are memoized, and URLs of api resources are parsed directly,
+    falling back to the werkzeug matcher for anything else."""
+    url_adapter = _url_adapter()
+    key = (url, method, id(url_adapter.map), url_adapter.server_name)
+    result = _split_urls.get(key)
+    if result is not None:
+        return result[0], dict(result[1])
+
     parsed_url = url_parse(url)
-    if parsed_url.netloc is not '' and \
+    if parsed_url.netloc != '' and \
                     parsed_url.netloc != url_adapter.server_name:
         raise ValidationError('Invalid URL: ' + url)
-    try:
-        result = url_adapter.match(parsed_url.path, method)
-    except NotFound:
-        raise ValidationError('Invalid URL: ' + url)
-    return result
+    result = _match_fast(parsed_url.path) if method == 'GET' else None
+    if result is None:
+        try:
+            result = url_adapter.match(parsed_url.path, method)
+        except NotFound:
+            raise ValidationError('Invalid URL: ' + url)
+    _split_urls.set(key, (result[0], dict(result[1])))
+    return result[0], dict(result[1])
+
+
+def parse_date(value):
+    """Parse a date into a naive datetime in UTC, as dates are stored.
+    Dates without a timezone are taken to be in UTC already."""
+    date = datetime_parser.parse(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(tzutc()).replace(tzinfo=None)
+    return date
@@ -0,0 +1,17 @@
+"""Reproducible HTTP benchmark of the orders API.
+
+Seeds the benchmark database with a configurable number of customers,
+products, orders and items, replays a weighted mix of requests to every
+api_v1 endpoint from concurrent clients against a threaded server, and
+reports the throughput and the p50/p95/p99 latency of each endpoint as
+JSON. A report can be saved as a baseline, and later runs compared against
+it to catch regressions.
+
+Run from the orders directory:
+
+    python -m benchmarks.api --orders 20000 --save baseline.json
+    python -m benchmarks.api --orders 20000 --baseline baseline.json
+
+The data and the sequence of requests sent by each client only depend on
+--seed, so two runs with the same options replay the same workload.
+"""
@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+from app import create_app
+from . import __doc__ as description
+from .runner import run, compare
+from .seed import seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description.splitlines()[0])
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests sent by each client')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the report as a baseline')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='compare the report with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before a change is reported '
+                             'as a regression, as a fraction')
+    args = parser.parse_args()
+
+    sizes = {'customers': args.customers, 'products': args.products,
+             'orders': args.orders, 'items': args.items}
+    app = create_app('benchmark')
+    token = seed(app, seed=args.seed, **sizes)
+    report = run(app, token, sizes, args.clients, args.requests, args.seed)
+    report['options'] = dict(sizes, clients=args.clients,
+                             requests=args.requests, seed=args.seed)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != report['options']:
+            sys.stderr.write('warning: the baseline was recorded with '
+                             'different options\n')
+        report['comparison'] = compare(report, baseline, args.tolerance)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.baseline and report['comparison']['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Replay of the request mix and latency statistics."""
+import json
+import random
+import threading
+import time
+from base64 import b64encode
+from collections import defaultdict
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+from werkzeug.serving import make_server
+from .workload import Client, MIX, schedule
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def milliseconds(seconds):
+    """Round a latency for the report, which has none for empty samples."""
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def summarize(latencies, errors, seconds):
+    """Return the throughput and the latency percentiles of a sample."""
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'p50_ms': milliseconds(percentile(latencies, 50)),
+        'p95_ms': milliseconds(percentile(latencies, 95)),
+        'p99_ms': milliseconds(percentile(latencies, 99))
+    }
+
+
+def replay(port, token, sizes, requests, seed, number, samples, lock):
+    """Send the requests of one client and record their latencies."""
+    rng = random.Random(seed * 1000 + number)
+    host = '127.0.0.1:{0}'.format(port)
+    client = Client(rng, sizes, host)
+    auth = 'Basic ' + b64encode((token + ':').encode('utf-8')).decode('utf-8')
+    conn = HTTPConnection('127.0.0.1', port)
+    for name in schedule(rng, requests):
+        request = MIX[name][0](client)
+        if request is None:
+            continue
+        method, path, data, headers = request
+        headers = dict(headers, Authorization=auth)
+        body = None
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data).encode('utf-8')
+
+        start = time.time()
+        conn.request(method, path, body, headers)
+        rv = conn.getresponse()
+        rv.read()
+        elapsed = time.time() - start
+
+        if method == 'GET' and rv.getheader('ETag'):
+            client.etags[path] = rv.getheader('ETag')
+        location = rv.getheader('Location')
+        if location:
+            # remember new orders and items, for the delete operations
+            created = urlsplit(location).path
+            if '/items/' in created:
+                client.created['items'].append(created)
+            elif '/orders/' in created:
+                client.created['orders'].append(created)
+        with lock:
+            samples[name][0].append(elapsed)
+            if rv.status >= 400:
+                samples[name][1] += 1
+    conn.close()
+
+
+def run(app, token, sizes, clients, requests, seed):
+    """Serve the application from a threaded server and replay `requests`
+    requests from each of `clients` concurrent clients. Returns the report
+    of the run."""
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.socket.getsockname()[1]
+
+    samples = defaultdict(lambda: [[], 0])
+    lock = threading.Lock()
+    threads = [threading.Thread(target=replay,
+                                args=(port, token, sizes, requests, seed, i,
+                                      samples, lock))
+               for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time() - start
+    server.shutdown()
+    server.server_close()
+
+    everything = [latency for latencies, errors in samples.values()
+                  for latency in latencies]
+    return {
+        'total': summarize(everything, sum(errors for latencies, errors
+                                           in samples.values()), seconds),
+        'endpoints': dict((name, summarize(latencies, errors, seconds))
+                          for name, (latencies, errors) in samples.items())
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Compare a report with a baseline. An endpoint regresses when its p95
+    latency grows by more than `tolerance` (a fraction) and by at least a
+    millisecond, and the run regresses when its throughput drops by more
+    than `tolerance`. Returns the changes and the list of regressions."""
+    changes = {}
+    regressions = []
+    for name in sorted(report['endpoints']):
+        now = report['endpoints'][name]
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        changes[name] = {'p95_ms': [before['p95_ms'], now['p95_ms']],
+                         'p99_ms': [before['p99_ms'], now['p99_ms']]}
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance) and \
+                now['p95_ms'] - before['p95_ms'] >= 1:
+            regressions.append(name)
+    before = baseline['total']['requests_per_second']
+    now = report['total']['requests_per_second']
+    changes['requests_per_second'] = [before, now]
+    if now < before * (1 - tolerance):
+        regressions.append('requests_per_second')
+    return {'changes': changes, 'regressions': regressions}
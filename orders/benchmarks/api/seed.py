@@ -0,0 +1,60 @@
+"""Benchmark data set."""
+import os
+import random
+from datetime import datetime, timedelta
+from app import db
+from app.models import User, Customer, Product, Order, Item
+from app.summaries import rebuild
+
+USERNAME = 'bench'
+PASSWORD = 'cat'
+
+
+def remove_database(app):
+    """Delete the SQLite database of an application, with its journals."""
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not uri.startswith('sqlite:///'):
+        return
+    path = uri[len('sqlite:///'):]
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _insert(model, rows, chunk_size=10000):
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(model.__table__.insert(), rows[i:i + chunk_size])
+
+
+def seed(app, customers, products, orders, items, seed=0):
+    """Create a new database with the given number of resources. Orders are
+    spread over the customers and over the last year, and the items over
+    the orders and the products. Returns an authentication token."""
+    rng = random.Random(seed)
+    remove_database(app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        u = User(username=USERNAME)
+        u.set_password(PASSWORD)
+        db.session.add(u)
+        db.session.flush()
+
+        start = datetime(2015, 1, 1)
+        _insert(Customer, [{'name': 'customer{0}'.format(i)}
+                           for i in range(customers)])
+        _insert(Product, [{'name': 'product{0}'.format(i)}
+                          for i in range(products)])
+        _insert(Order, [{'customer_id': rng.randint(1, customers),
+                         'date': start + timedelta(
+                             seconds=rng.randint(0, 365 * 86400))}
+                        for i in range(orders)])
+        _insert(Item, [{'order_id': rng.randint(1, orders),
+                        'product_id': rng.randint(1, products),
+                        'quantity': rng.randint(1, 10)}
+                       for i in range(items)])
+        db.session.commit()
+        rebuild()
+        token = u.generate_auth_token(expires_in=86400)
+        db.session.remove()
+    return token
@@ -0,0 +1,222 @@
+"""Request mix replayed by the benchmark clients.
+
+Every operation is a function that takes a Client and returns the method,
+the path, the JSON body and the extra headers of the request to send, or
+None when there is nothing to do. Operations are picked at random with the
+weights in MIX, from a generator seeded per client.
+"""
+from datetime import datetime, timedelta
+
+API = '/api/v1'
+
+
+class Client(object):
+    """State of one benchmark client: the size of the data set, its random
+    generator, the ETags it has seen and the resources it has created."""
+    def __init__(self, rng, sizes, host):
+        self.rng = rng
+        self.host = host
+        self.sizes = sizes
+        self.etags = {}
+        self.created = {'orders': [], 'items': []}
+
+    def pick(self, resource):
+        return self.rng.randint(1, self.sizes[resource])
+
+    def page(self, resource, per_page=25):
+        return self.rng.randint(1, max(1, self.sizes[resource] // per_page))
+
+    def product_url(self):
+        return 'http://{0}{1}/products/{2}'.format(self.host, API,
+                                                   self.pick('products'))
+
+    def new_items(self, count):
+        return [{'product_url': self.product_url(),
+                 'quantity': self.rng.randint(1, 10)} for i in range(count)]
+
+    def date(self):
+        return (datetime(2015, 1, 1) + timedelta(
+            seconds=self.rng.randint(0, 365 * 86400))).isoformat() + 'Z'
+
+
+def get(path, headers=None):
+    return 'GET', API + path, None, headers or {}
+
+
+def send(method, path, data=None):
+    return method, path, data, {}
+
+
+def customers_list(c):
+    return get('/customers/?page={0}'.format(c.page('customers')))
+
+
+def customers_extended(c):
+    return get('/customers/?extended=1&page={0}'.format(c.page('customers')))
+
+
+def customers_get(c):
+    return get('/customers/{0}'.format(c.pick('customers')))
+
+
+def customers_summary(c):
+    return get('/customers/{0}/summary'.format(c.pick('customers')))
+
+
+def customers_orders(c):
+    return get('/customers/{0}/orders/?after=&extended=1'.format(
+        c.pick('customers')))
+
+
+def customers_stream(c):
+    return get('/customers/?stream=ndjson')
+
+
+def customers_create(c):
+    return send('POST', API + '/customers/', {'name': 'new customer'})
+
+
+def customers_edit(c):
+    return send('PUT', API + '/customers/{0}'.format(c.pick('customers')),
+                {'name': 'customer'})
+
+
+def products_list(c):
+    return get('/products/?page={0}'.format(c.page('products')))
+
+
+def products_get(c):
+    return get('/products/{0}'.format(c.pick('products')))
+
+
+def products_sales(c):
+    return get('/products/{0}/sales'.format(c.pick('products')))
+
+
+def products_create(c):
+    return send('POST', API + '/products/', {'name': 'new product'})
+
+
+def products_edit(c):
+    return send('PUT', API + '/products/{0}'.format(c.pick('products')),
+                {'name': 'product'})
+
+
+def orders_list(c):
+    return get('/orders/?page={0}'.format(c.page('orders')))
+
+
+def orders_extended(c):
+    return get('/orders/?extended=1&page={0}'.format(c.page('orders')))
+
+
+def orders_cursor(c):
+    return get('/orders/?after=&extended=1&per_page=25')
+
+
+def orders_get(c):
+    return get('/orders/{0}'.format(c.pick('orders')))
+
+
+def orders_conditional(c):
+    # revalidate a resource this client has fetched before, or fetch it
+    # for the first time and remember its ETag
+    path = '/orders/{0}'.format(c.rng.randint(
+        1, min(100, c.sizes['orders'])))
+    etag = c.etags.get(API + path)
+    return get(path, {'If-None-Match': etag} if etag else None)
+
+
+def orders_totals(c):
+    return get('/orders/{0}/totals'.format(c.pick('orders')))
+
+
+def orders_create(c):
+    return send('POST', API + '/customers/{0}/orders/'.format(
+        c.pick('customers')), {'date': c.date(), 'items': c.new_items(3)})
+
+
+def orders_edit(c):
+    return send('PUT', API + '/orders/{0}'.format(c.pick('orders')),
+                {'date': c.date()})
+
+
+def orders_delete(c):
+    # clients only delete what they created
+    if not c.created['orders']:
+        return None
+    return send('DELETE', c.created['orders'].pop())
+
+
+def items_list(c):
+    return get('/orders/{0}/items/?extended=1'.format(c.pick('orders')))
+
+
+def items_get(c):
+    return get('/items/{0}'.format(c.pick('items')))
+
+
+def items_create(c):
+    return send('POST', API + '/orders/{0}/items/'.format(c.pick('orders')),
+                c.new_items(1)[0])
+
+
+def items_create_bulk(c):
+    return send('POST', API + '/orders/{0}/items/'.format(c.pick('orders')),
+                c.new_items(10))
+
+
+def items_edit(c):
+    return send('PUT', API + '/items/{0}'.format(c.pick('items')),
+                c.new_items(1)[0])
+
+
+def items_delete(c):
+    if not c.created['items']:
+        return None
+    return send('DELETE', c.created['items'].pop())
+
+
+def stats(c):
+    return get('/_stats')
+
+
+# operation name: (function, weight); reads dominate, as they do in use
+MIX = {
+    'customers.list': (customers_list, 4),
+    'customers.extended': (customers_extended, 4),
+    'customers.get': (customers_get, 8),
+    'customers.summary': (customers_summary, 3),
+    'customers.orders': (customers_orders, 4),
+    'customers.stream': (customers_stream, 1),
+    'customers.create': (customers_create, 1),
+    'customers.edit': (customers_edit, 1),
+    'products.list': (products_list, 3),
+    'products.get': (products_get, 8),
+    'products.sales': (products_sales, 3),
+    'products.create': (products_create, 1),
+    'products.edit': (products_edit, 1),
+    'orders.list': (orders_list, 4),
+    'orders.extended': (orders_extended, 6),
+    'orders.cursor': (orders_cursor, 4),
+    'orders.get': (orders_get, 10),
+    'orders.conditional': (orders_conditional, 8),
+    'orders.totals': (orders_totals, 3),
+    'orders.create': (orders_create, 2),
+    'orders.edit': (orders_edit, 1),
+    'orders.delete': (orders_delete, 1),
+    'items.list': (items_list, 6),
+    'items.get': (items_get, 8),
+    'items.create': (items_create, 2),
+    'items.create_bulk': (items_create_bulk, 1),
+    'items.edit': (items_edit, 1),
+    'items.delete': (items_delete, 1),
+    'stats': (stats, 1)
+}
+
+
+def schedule(rng, count):
+    """Return the names of `count` operations drawn from MIX."""
+    names = sorted(MIX)
+    return rng.choices(names, weights=[MIX[name][1] for name in names],
+                       k=count)
@@ -0,0 +1,155 @@
+"""Load test of the threaded WSGI server against the asyncio server.
+
+Starts each server in a subprocess, opens many concurrent keep-alive
+connections that request a listing for a fixed time, and prints the
+throughput, the latency percentiles and the errors of both as JSON.
+
+Run from the orders directory:
+
+    python -m benchmarks.async_serving --connections 500 --seconds 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Customer
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def seed(customers):
+    """Create the benchmark database and return an authentication token."""
+    app = create_app('benchmark')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        u = User(username='bench')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add_all([Customer(name='customer{0}'.format(i))
+                            for i in range(customers)])
+        db.session.commit()
+        return u.generate_auth_token()
+
+
+def serve_wsgi(port):
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, create_app('benchmark'),
+                threaded=True).serve_forever()
+
+
+async def client(port, request, deadline, latencies, errors):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        errors.append('connect')
+        return
+    try:
+        while time.time() < deadline:
+            start = time.time()
+            writer.write(request)
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, value = line.split(b':', 1)
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            if not status.startswith(b'HTTP/1.1 200') and \
+                    not status.startswith(b'HTTP/1.0 200'):
+                errors.append(status.decode('latin-1').strip())
+                break
+            latencies.append(time.time() - start)
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        errors.append(type(e).__name__)
+    finally:
+        writer.close()
+
+
+def load(port, token, connections, seconds):
+    auth = b64encode((token + ':').encode('utf-8'))
+    request = (b'GET /api/v1/customers/ HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+               b'Authorization: Basic ' + auth + b'\r\n\r\n')
+    latencies = []
+    errors = []
+    loop = asyncio.new_event_loop()
+    deadline = time.time() + seconds
+    loop.run_until_complete(asyncio.gather(*[
+        client(port, request, deadline, latencies, errors)
+        for i in range(connections)]))
+    loop.close()
+    return {
+        'requests_per_second': round(len(latencies) / float(seconds), 1),
+        'p50_ms': round((percentile(latencies, 50) or 0) * 1000, 2),
+        'p99_ms': round((percentile(latencies, 99) or 0) * 1000, 2),
+        'errors': len(errors)
+    }
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            loop = asyncio.new_event_loop()
+            reader, writer = loop.run_until_complete(
+                asyncio.open_connection('127.0.0.1', port))
+            writer.close()
+            loop.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start on port {0}'.format(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--customers', type=int, default=25)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--serve', choices=['wsgi'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == 'wsgi':
+        serve_wsgi(args.port)
+        return
+
+    token = seed(args.customers)
+    env = dict(os.environ, FLASK_CONFIG='benchmark')
+    commands = {
+        'threaded_wsgi': [sys.executable, '-m', 'benchmarks.async_serving',
+                          '--serve', 'wsgi', '--port', str(args.port)],
+        'asyncio': [sys.executable, 'serve.py', '--port', str(args.port),
+                    '--workers', str(args.workers),
+                    '--threads', str(args.threads)]
+    }
+    results = {}
+    for name, command in sorted(commands.items()):
+        server = subprocess.Popen(command, env=env)
+        try:
+            wait_for(args.port)
+            results[name] = load(args.port, token, args.connections,
+                                 args.seconds)
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
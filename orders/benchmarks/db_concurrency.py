@@ -0,0 +1,122 @@
+"""Read and write throughput of the database engine under concurrency.
+
+Runs reader threads that list orders and writer threads that add orders to
+the same SQLite file, first with the default engine settings and then with
+the production profile (connection pool, WAL, synchronous=NORMAL, mmap,
+page cache and busy timeout), and prints the operations per second and the
+failed operations of each as JSON.
+
+Run from the orders directory:
+
+    python -m benchmarks.db_concurrency --readers 8 --writers 4 --seconds 10
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from app import create_app, db
+from app.models import Customer, Order
+
+PROFILES = {
+    'default': {},
+    'tuned': {
+        'SQLALCHEMY_POOL_SIZE': 16,
+        'SQLALCHEMY_MAX_OVERFLOW': 8,
+        'SQLALCHEMY_POOL_RECYCLE': 3600,
+        'SQLITE_JOURNAL_MODE': 'WAL',
+        'SQLITE_SYNCHRONOUS': 'NORMAL',
+        'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+        'SQLITE_CACHE_SIZE': -64000,
+        'SQLITE_BUSY_TIMEOUT': 10000
+    }
+}
+
+
+def remove_database(app):
+    # the journal mode is stored in the database file, so every profile
+    # starts from a new one
+    path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def worker(app, operation, deadline, counts, lock):
+    done = failed = 0
+    with app.app_context():
+        while time.time() < deadline:
+            try:
+                operation()
+                done += 1
+            except Exception:
+                db.session.rollback()
+                failed += 1
+        db.session.remove()
+    with lock:
+        counts[0] += done
+        counts[1] += failed
+
+
+def read():
+    Order.query.order_by(Order.date.desc(), Order.id.desc()).limit(25).all()
+
+
+def write():
+    db.session.add(Order(customer_id=1, date=datetime.utcnow()))
+    db.session.commit()
+
+
+def run(profile, readers, writers, seconds, orders):
+    app = create_app('benchmark')
+    app.config.update(PROFILES[profile])
+    remove_database(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Customer(name='customer'))
+        db.session.commit()
+        db.session.execute(Order.__table__.insert(), [
+            {'customer_id': 1, 'date': datetime.utcnow()}
+            for i in range(orders)])
+        db.session.commit()
+        db.session.remove()
+
+    reads, writes = [0, 0], [0, 0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=worker,
+                                args=(app, read, deadline, reads, lock))
+               for i in range(readers)]
+    threads += [threading.Thread(target=worker,
+                                 args=(app, write, deadline, writes, lock))
+                for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        db.get_engine(app).dispose()
+    return {
+        'reads_per_second': round(reads[0] / float(seconds), 1),
+        'writes_per_second': round(writes[0] / float(seconds), 1),
+        'failed_reads': reads[1],
+        'failed_writes': writes[1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--orders', type=int, default=10000)
+    args = parser.parse_args()
+    results = dict((profile, run(profile, args.readers, args.writers,
+                                 args.seconds, args.orders))
+                   for profile in sorted(PROFILES))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
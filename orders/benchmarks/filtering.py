@@ -0,0 +1,129 @@
+"""Latency and query plans of filtered and searched listings.
+
+Seeds the benchmark database with a million orders and items, then sends
+listing requests with each kind of filter of app.filters and prints, as
+JSON, the median milliseconds per request, the number of resources found
+and the distinct steps of the SQLite query plans of the statements they
+ran, where a "SCAN" of orders or items would mean a filter that misses its
+index. The response cache is disabled so every request hits the database.
+
+Run from the orders directory:
+
+    python -m benchmarks.filtering --orders 1000000 --number 20
+
+Add --no-seed to reuse the database of an earlier run.
+"""
+import argparse
+import json
+import time
+from base64 import b64encode
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User
+from .api.seed import seed, USERNAME
+
+
+def cases(sizes):
+    customer = sizes['customers'] // 2
+    product = sizes['products'] // 2
+    return [
+        ('orders_by_customer',
+         '/api/v1/orders/?customer_id={0}'.format(customer)),
+        ('orders_by_customer_cursor',
+         '/api/v1/orders/?customer_id={0}&after='.format(customer)),
+        ('orders_in_a_day',
+         '/api/v1/orders/?date_from=2015-06-01&date_to=2015-06-02'),
+        ('orders_in_a_day_cursor',
+         '/api/v1/orders/?date_from=2015-06-01&date_to=2015-06-02&after='),
+        ('orders_by_product_cursor',
+         '/api/v1/orders/?product_id={0}&after='.format(product)),
+        ('orders_by_product_and_date',
+         '/api/v1/orders/?product_id={0}&date_from=2015-06-01'
+         '&date_to=2015-07-01'.format(product)),
+        ('customers_search',
+         '/api/v1/customers/?q=customer{0}'.format(customer)),
+        ('products_search',
+         '/api/v1/products/?q=product{0}&extended=1'.format(product)),
+    ]
+
+
+def plans(app, statements):
+    """Return the distinct steps of the query plans of some statements."""
+    steps = set()
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                steps.update(row[-1] for row in cursor.fetchall())
+        finally:
+            conn.close()
+    return sorted(steps)
+
+
+def run(app, client, headers, url, number):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        rv = client.get(url, headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    data = json.loads(rv.get_data(as_text=True))
+    found = data.get('pages', {}).get('total')
+    if found is None:
+        collection = [key for key in data if key != 'pages'][0]
+        found = len(data[collection])
+
+    latencies = []
+    for i in range(number):
+        start = time.time()
+        client.get(url, headers=headers).get_data()
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return {'status': rv.status_code, 'found': found,
+            'median_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'plan': plans(app, statements)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--no-seed', action='store_true')
+    args = parser.parse_args()
+    sizes = {'customers': args.customers, 'products': args.products,
+             'orders': args.orders, 'items': args.items}
+
+    app = create_app('benchmark')
+    app.extensions.pop('response_cache', None)
+    if args.no_seed:
+        with app.app_context():
+            token = User.query.filter_by(username=USERNAME).first() \
+                .generate_auth_token(expires_in=86400)
+    else:
+        token = seed(app, **sizes)
+    headers = {'Authorization': 'Basic ' + b64encode(
+        (token + ':').encode('utf-8')).decode('utf-8')}
+
+    client = app.test_client()
+    results = {}
+    for name, url in cases(sizes):
+        results[name] = run(app, client, headers, url, args.number)
+    print(json.dumps({'sizes': sizes, 'results': results}, indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
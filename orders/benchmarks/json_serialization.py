@@ -0,0 +1,74 @@
+"""Size and encoding time of extended listings with each JSON serializer.
+
+Renders extended pages of orders and items, and encodes them with Flask's
+jsonify(), which the json decorator used to call, and with every serializer
+in app.decorators.json that is installed. Prints the bytes per response and
+the microseconds per response as JSON.
+
+Run from the orders directory:
+
+    python -m benchmarks.json_serialization --number 2000
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+from flask import jsonify
+from app import create_app, db
+from app.decorators.json import SERIALIZERS
+from app.models import Customer, Product, Order, Item
+
+
+def seed(count):
+    db.drop_all()
+    db.create_all()
+    db.session.add(Customer(name='customer'))
+    db.session.add(Product(name='product'))
+    db.session.flush()
+    start = datetime(2015, 1, 1)
+    db.session.execute(Order.__table__.insert(), [
+        {'customer_id': 1, 'date': start + timedelta(hours=i)}
+        for i in range(count)])
+    db.session.execute(Item.__table__.insert(), [
+        {'order_id': i + 1, 'product_id': 1, 'quantity': 1}
+        for i in range(count)])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--per-page', type=int, default=25)
+    args = parser.parse_args()
+
+    app = create_app('benchmark')
+    results = {}
+    with app.app_context():
+        seed(args.per_page)
+        with app.test_request_context('/api/v1/orders/?extended=1'):
+            pages = {
+                'orders': {'orders': [o.export_data() for o in
+                                      Order.query.limit(args.per_page)]},
+                'items': {'items': [i.export_data() for i in
+                                    Item.query.limit(args.per_page)]}
+            }
+            encoders = {'jsonify': lambda page: jsonify(page).get_data()}
+            for name, serializer in SERIALIZERS.items():
+                try:
+                    encoders[name] = serializer().dumps
+                except ImportError:
+                    continue
+            for name, encode in sorted(encoders.items()):
+                for collection, page in sorted(pages.items()):
+                    seconds = timeit.timeit(lambda: encode(page),
+                                            number=args.number)
+                    results.setdefault(name, {})[collection] = {
+                        'bytes': len(encode(page)),
+                        'us_per_response': round(
+                            seconds / args.number * 1e6, 1)
+                    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Latency of regular API calls while other clients keep fetching tokens.
+
+Runs the same workload with password hashing on the request thread, in the
+worker pool, and in the worker pool with the verification cache enabled,
+then prints the p50/p99 latency of the regular calls as JSON.
+
+Run from the orders directory:
+
+    python -m benchmarks.password_hashing --seconds 10
+"""
+import argparse
+import json
+import threading
+import time
+from base64 import b64encode
+from urllib.request import Request, urlopen
+from werkzeug.serving import make_server
+from app import create_app, db
+from app.models import User
+
+USERNAME = 'bench'
+PASSWORD = 'cat'
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def milliseconds(seconds):
+    """Round a latency for the report, which has none for empty samples."""
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def basic_auth(username, password):
+    return 'Basic ' + b64encode((username + ':' + password)
+                                .encode('utf-8')).decode('utf-8')
+
+
+def run(workers, cache_ttl, seconds, clients, token_clients):
+    app = create_app('benchmark')
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    app.config['PASSWORD_CACHE_TTL'] = cache_ttl
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        u = User(username=USERNAME)
+        u.set_password(PASSWORD)
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_auth_token()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{0}'.format(server.socket.getsockname()[1])
+
+    stop = threading.Event()
+    latencies = []
+    fetches = [0]
+    lock = threading.Lock()
+
+    def api_client():
+        request = Request(base + '/api/v1/customers/',
+                          headers={'Authorization': basic_auth(token, '')})
+        while not stop.is_set():
+            start = time.time()
+            urlopen(request).read()
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    def token_client():
+        request = Request(base + '/get-auth-token',
+                          headers={'Authorization': basic_auth(USERNAME,
+                                                                PASSWORD)})
+        while not stop.is_set():
+            urlopen(request).read()
+            with lock:
+                fetches[0] += 1
+
+    threads = [threading.Thread(target=api_client) for i in range(clients)] + \
+        [threading.Thread(target=token_client) for i in range(token_clients)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    server.shutdown()
+    pool = app.extensions['auth']['pool']
+    if pool is not None:
+        pool.shutdown()
+
+    return {
+        'requests': len(latencies),
+        'token_fetches': fetches[0],
+        'p50_ms': milliseconds(percentile(latencies, 50)),
+        'p99_ms': milliseconds(percentile(latencies, 99))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--token-clients', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--cache-ttl', type=int, default=10)
+    args = parser.parse_args()
+
+    results = {}
+    for name, workers, ttl in [('inline', 0, 0),
+                               ('pool', args.workers, 0),
+                               ('pool+cache', args.workers, args.cache_ttl)]:
+        results[name] = run(workers, ttl, args.seconds, args.clients,
+                            args.token_clients)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
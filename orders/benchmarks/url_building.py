@@ -0,0 +1,50 @@
+"""Time spent building resource URLs with url_for() and with fast_url_for().
+
+Builds the URLs that an extended listing of orders needs and prints the
+cost per URL of both builders as JSON.
+
+Run from the orders directory:
+
+    python -m benchmarks.url_building --iterations 100000
+"""
+import argparse
+import json
+import timeit
+from flask import url_for
+from app import create_app
+from app.utils import fast_url_for
+
+ENDPOINTS = ['api.get_order', 'api.get_customer', 'api.get_order_items']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_app('benchmark')
+    with app.test_request_context('/api/v1/orders/?extended=1'):
+        def slow():
+            for endpoint in ENDPOINTS:
+                url_for(endpoint, id=12345, _external=True)
+
+        def fast():
+            for endpoint in ENDPOINTS:
+                fast_url_for(endpoint, id=12345)
+
+        for endpoint in ENDPOINTS:
+            assert url_for(endpoint, id=12345, _external=True) == \
+                fast_url_for(endpoint, id=12345)
+
+        urls = args.iterations * len(ENDPOINTS)
+        results = {}
+        for name, f in [('url_for', slow), ('fast_url_for', fast)]:
+            seconds = min(timeit.repeat(f, number=args.iterations, repeat=3))
+            results[name] = {'us_per_url': round(seconds / urls * 1e6, 3)}
+        results['speedup'] = round(results['url_for']['us_per_url'] /
+                                   results['fast_url_for']['us_per_url'], 1)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,3 +7,56 @@ DEBUG = False
 SECRET_KEY = 'top-secret!'
 SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                           'sqlite:///' + db_path
+
+# password hashing runs in a process pool; identical credentials are not
+# re-hashed for a few seconds
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_CACHE_TTL = 10
+
+# requests per client and period on the api, with counters shared by all
+# the worker processes on the host
+RATELIMIT_REQUESTS = 300
+RATELIMIT_PERIOD = 60
+RATELIMIT_BACKEND = 'sqlite'
+RATELIMIT_SQLITE_PATH = os.path.join(basedir, '../ratelimit.sqlite')
+
+# cached responses and their invalidations are shared by all the workers
+RESPONSE_CACHE = 'sqlite'
+RESPONSE_CACHE_PATH = os.path.join(basedir, '../cache.sqlite')
+
+# serve.py: worker processes, view threads per worker and shutdown grace
+ASYNC_WORKERS = 4
+ASYNC_THREADS = 8
+ASYNC_DRAIN_TIMEOUT = 30
+
+# a pool of connections per worker process, recycled every hour
+SQLALCHEMY_POOL_SIZE = 8
+SQLALCHEMY_MAX_OVERFLOW = 8
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLALCHEMY_POOL_RECYCLE = 3600
+
+# SQLite: readers do not block behind commits, writers wait for the lock
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -64000
+SQLITE_BUSY_TIMEOUT = 10000
+
+# compact JSON from the fastest serializer installed
+JSON_SERIALIZER = 'auto'
+
+# compress responses of 500 bytes or more, caching the compressed bodies
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_LEVEL = 5
+COMPRESS_CACHE_SIZE = 1024
+
+# read-only databases for GET requests, separated by spaces; with SQLite the
+# database itself can be listed to give readers a pool of their own
+SQLALCHEMY_READ_BINDS = os.environ.get('DATABASE_READ_URLS', '').split()
+
+# with GROUP_COMMIT=1 in the environment, writes that arrive within 2ms of
+# each other share one commit, up to 32 of them
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT') == '1'
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_SIZE = 32
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3.6
+"""Upgrade the database to the current schema, then recompute the aggregate
+tables and the search indexes. Run it once on databases created by earlier
+versions of the application, and whenever the aggregates need a rebuild."""
+import os
+from app import create_app
+from app.schema import upgrade
+from app.summaries import rebuild
+from app.search import rebuild as rebuild_search
+
+if __name__ == '__main__':
+	app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+	with app.app_context():
+		upgrade()
+		rebuild()
+		rebuild_search()
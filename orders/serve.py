@@ -0,0 +1,37 @@
+#!/usr/bin/env python3.6
+"""Serve the API from asyncio event loops in one or more worker processes.
+
+The views run in a bounded thread pool in each worker. Defaults come from
+the ASYNC_WORKERS, ASYNC_THREADS and ASYNC_DRAIN_TIMEOUT configuration
+variables. The `application` object, which is only built when this module
+is imported, can also be served by any ASGI server.
+"""
+import argparse
+import os
+from app import create_app, db
+from app.asgi import WsgiToAsgi, serve
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve the orders API.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5000)
+	parser.add_argument('--workers', type=int,
+		default=app.config.get('ASYNC_WORKERS', 1))
+	parser.add_argument('--threads', type=int,
+		default=app.config.get('ASYNC_THREADS', 8))
+	parser.add_argument('--drain-timeout', type=float,
+		default=app.config.get('ASYNC_DRAIN_TIMEOUT', 30))
+	args = parser.parse_args()
+
+	with app.app_context():
+		db.create_all()
+		engine = db.get_engine(app)
+	# connections opened before forking must not be shared by the workers
+	engine.dispose()
+	serve(app, args.host, args.port, workers=args.workers,
+		threads=args.threads, drain_timeout=args.drain_timeout,
+		after_fork=engine.dispose)
+else:
+	application = WsgiToAsgi(app, threads=app.config.get('ASYNC_THREADS', 8))
@@ -1,4 +1,4 @@
 import unittest
-from .tests import TestAPI
+from . import tests
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestAPI)
\ No newline at end of file
+suite = unittest.TestLoader().loadTestsFromModule(tests)
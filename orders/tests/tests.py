@@ -1,7 +1,35 @@
+import asyncio
+import base64
+import gzip
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
-from werkzeug.exceptions import NotFound
-from app import create_app, db
-from app.models import User
+from datetime import datetime
+from http.client import HTTPConnection
+from json import dumps, loads
+from unittest import mock
+from flask import Flask, url_for, g
+from sqlalchemy import event, inspect
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+from app import create_app, db, utils
+from app.asgi import WsgiToAsgi, HTTPServer
+from app.auth import check_password
+from app.decorators.json import create_serializer
+from app.decorators.rate_limit import RateLimitBackend, MemRateLimit, \
+    SQLiteRateLimit, create_limiter
+from app.exceptions import ValidationError
+from app.group_commit import GroupCommitter
+from app.models import User, Customer, Product, Item
+from app.profiling import init_app as init_profiling
+from app.schema import upgrade
+from app.summaries import rebuild
+from app.utils import fast_url_for, split_url
 from .test_client import TestClient
 
 
@@ -171,3 +199,1343 @@ class TestAPI(unittest.TestCase):
         rv, json = self.client.get('/api/v1/orders/')
         self.assertTrue(rv.status_code == 200)
         self.assertTrue(len(json['orders']) == 0)
+
+    def test_cursor_pagination(self):
+        # add a few products
+        locations = []
+        for i in range(5):
+            rv, json = self.client.post('/api/v1/products/',
+                                        data={'name': 'prod{0}'.format(i)})
+            self.assertTrue(rv.status_code == 201)
+            locations.append(rv.headers['Location'])
+
+        # walk the collection two at a time
+        url = '/api/v1/products/?after=&per_page=2&count=1'
+        seen = []
+        while url:
+            rv, json = self.client.get(url)
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(json['pages']['total'] == 5)
+            self.assertTrue('page' not in json['pages'])
+            seen.extend(json['products'])
+            url = json['pages']['next_url']
+        self.assertTrue(seen == locations)
+
+        # the count is only computed on request
+        rv, json = self.client.get('/api/v1/products/?after=')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue('total' not in json['pages'])
+
+        # pages are tagged from their rows, without aggregating the
+        # whole collection
+        queries = self.capture_queries('/api/v1/products/?after=&per_page=2')
+        self.assertTrue(not any('sum(' in q for q in queries))
+        rv, json = self.client.get('/api/v1/products/?after=&per_page=2')
+        etag = rv.headers['ETag']
+        rv, json = self.client.get('/api/v1/products/?after=&per_page=2',
+                                   headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 304)
+
+        # pages have at least one resource
+        for per_page in (0, -3):
+            rv, json = self.client.get(
+                '/api/v1/products/?after=&per_page={0}'.format(per_page))
+            self.assertTrue(json['products'] == locations[:1])
+
+        # bad cursors are rejected
+        def cursor(values):
+            return base64.urlsafe_b64encode(dumps(values).encode('utf-8')) \
+                .decode('ascii')
+
+        for after in ['bogus', cursor([{'a': 1}]), cursor([[1]]),
+                      cursor([True]), cursor({'id': 1}), cursor([1, 2])]:
+            with self.assertRaises(ValidationError):
+                self.client.get('/api/v1/products/?after=' + after)
+        for after in [cursor([12, 1]), cursor(['yesterday-ish', 1])]:
+            with self.assertRaises(ValidationError):
+                self.client.get('/api/v1/orders/?after=' + after)
+
+    def capture_queries(self, url):
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv, json = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertTrue(rv.status_code == 200)
+        return queries
+
+    def count_queries(self, url):
+        return len(self.capture_queries(url))
+
+    def test_extended_listing_queries(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.get(customer)
+        rv, json = self.client.post(json['orders_url'],
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        rv, json = self.client.get(rv.headers['Location'])
+        items_url = json['items_url']
+
+        def add_items(n):
+            for i in range(n):
+                rv, json = self.client.post('/api/v1/products/',
+                                            data={'name': 'prod'})
+                rv, json = self.client.post(items_url, data={
+                    'product_url': rv.headers['Location'], 'quantity': 1})
+                self.assertTrue(rv.status_code == 201)
+
+        # the number of queries does not depend on the size of the page
+        add_items(2)
+        small = self.count_queries(items_url + '?extended=1')
+        add_items(8)
+        large = self.count_queries(items_url + '?extended=1')
+        self.assertTrue(small == large)
+        self.assertTrue(self.count_queries(
+            items_url + '?extended=1&after=') <= large)
+
+    def test_schema_upgrade(self):
+        # a database with the tables of the first version of the api
+        db.drop_all()
+        for statement in (
+                'CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                'username VARCHAR(64), password_hash VARCHAR(128))',
+                'CREATE TABLE customers (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(64))',
+                'CREATE TABLE products (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(64))',
+                'CREATE TABLE orders (id INTEGER PRIMARY KEY, '
+                'customer_id INTEGER REFERENCES customers (id), '
+                'date DATETIME)',
+                'CREATE TABLE items (id INTEGER PRIMARY KEY, '
+                'order_id INTEGER REFERENCES orders (id), '
+                'product_id INTEGER REFERENCES products (id), '
+                'quantity INTEGER)',
+                'CREATE INDEX ix_items_product_id ON items (product_id)',
+                "INSERT INTO customers (id, name) VALUES (1, 'john')",
+                "INSERT INTO orders (id, customer_id, date) "
+                "VALUES (1, 1, '2014-01-01 00:00:00.000000')"):
+            db.engine.execute(statement)
+
+        upgrade()
+        upgrade()
+        inspector = inspect(db.engine)
+        self.assertTrue(set(['version', 'updated_at']) <= set(
+            column['name'] for column in inspector.get_columns('orders')))
+        indexes = [index['name'] for index in inspector.get_indexes('items')]
+        self.assertTrue('ix_items_product_id_order_id' in indexes)
+        self.assertTrue('ix_items_product_id' not in indexes)
+        self.assertTrue(db.engine.has_table('changes'))
+        rebuild()
+
+        # the rows that existed work like new ones
+        u = User(username=self.default_username)
+        u.set_password(self.default_password)
+        db.session.add(u)
+        db.session.commit()
+        self.client = TestClient(self.app, u.generate_auth_token(), '')
+        rv, json = self.client.get('/api/v1/customers/1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['name'] == 'john')
+        rv, json = self.client.put('/api/v1/customers/1',
+                                   data={'name': 'John Smith'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(Customer.query.get(1).version == 2)
+        rv, json = self.client.get('/api/v1/customers/1/summary')
+        self.assertTrue(json['orders'] == 1)
+
+    def test_token_cache(self):
+        # the first request verifies the token and loads the user
+        queries = self.capture_queries('/api/v1/customers/')
+        self.assertTrue(any('users' in q for q in queries))
+
+        # later requests with the same token do not touch the users table
+        queries = self.capture_queries('/api/v1/customers/')
+        self.assertFalse(any('users' in q for q in queries))
+
+        # a change to the user drops its cached copy
+        user = User.query.filter_by(username=self.default_username).first()
+        user.set_password('dog')
+        db.session.commit()
+        queries = self.capture_queries('/api/v1/customers/')
+        self.assertTrue(any('users' in q for q in queries))
+
+        # and so does its deletion, after which its token is rejected
+        db.session.delete(user)
+        db.session.commit()
+        rv, json = self.client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 401)
+
+        # invalid tokens are still rejected
+        client = TestClient(self.app, 'bad-token', '')
+        rv, json = client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 401)
+
+    def test_password_hashing(self):
+        user = User.query.filter_by(username=self.default_username).first()
+        state = self.app.extensions['auth']
+
+        # hashes run on the request thread unless a pool is configured
+        self.assertTrue(check_password(user, self.default_password))
+        self.assertTrue(state['pool'] is None)
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        try:
+            self.assertTrue(check_password(user, self.default_password))
+            self.assertFalse(check_password(user, 'dog'))
+            self.assertTrue(state['pool'] is not None)
+        finally:
+            state['pool'].shutdown()
+            state['pool'] = None
+            del self.app.config['PASSWORD_HASH_WORKERS']
+
+        # with a TTL successful checks are remembered, for the same password
+        # and stored hash only, and failed ones are not
+        self.app.config['PASSWORD_CACHE_TTL'] = 60
+        with mock.patch.object(User, 'verify_password',
+                               side_effect=lambda password:
+                               password == self.default_password) as verify:
+            self.assertTrue(check_password(user, self.default_password))
+            self.assertTrue(check_password(user, self.default_password))
+            self.assertTrue(verify.call_count == 1)
+            self.assertFalse(check_password(user, 'dog'))
+            self.assertFalse(check_password(user, 'dog'))
+            self.assertTrue(verify.call_count == 3)
+            user.set_password('dog')
+            check_password(user, self.default_password)
+            self.assertTrue(verify.call_count == 4)
+
+    def test_conditional_get(self):
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod1'})
+        product = rv.headers['Location']
+
+        # single resources are tagged from their version
+        rv, json = self.client.get(product)
+        self.assertTrue(rv.status_code == 200)
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        rv, json = self.client.get(product, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 304)
+
+        # a write changes the tag
+        rv, json = self.client.put(product, data={'name': 'product1'})
+        rv, json = self.client.get(product, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['ETag'] != etag)
+
+        # collections are tagged from the change log, without reading the
+        # resources of the collection
+        rv, json = self.client.get('/api/v1/products/')
+        etag = rv.headers['ETag']
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        cache = self.app.extensions.pop('response_cache')
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv, json = self.client.get('/api/v1/products/',
+                                       headers={'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            self.app.extensions['response_cache'] = cache
+        self.assertTrue(rv.status_code == 304)
+        self.assertTrue(not any('FROM products' in query
+                                for query in queries))
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod2'})
+        rv, json = self.client.get('/api/v1/products/',
+                                   headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['products']) == 2)
+
+        # listings filtered on the items of the orders follow the items
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        rv, json = self.client.get(rv.headers['Location'])
+        rv, json = self.client.post(json['orders_url'],
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        rv, json = self.client.get(rv.headers['Location'])
+        items_url = json['items_url']
+        url = '/api/v1/orders/?product_id=' + product.split('/')[-1]
+        rv, json = self.client.get(url)
+        self.assertTrue(json['orders'] == [])
+        etag = rv.headers['ETag']
+        rv, json = self.client.post(items_url, data={'product_url': product,
+                                                     'quantity': 1})
+        self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['orders']) == 1)
+
+    def test_response_cache(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+
+        # the second read is served from the cache
+        rv, json = self.client.get(customer)
+        self.assertTrue(rv.headers['X-Cache'] == 'MISS')
+        self.assertTrue(self.count_queries(customer) == 0)
+        rv, json = self.client.get(customer)
+        self.assertTrue(rv.headers['X-Cache'] == 'HIT')
+        self.assertTrue(json['name'] == 'john')
+
+        # writes invalidate the cached responses
+        rv, json = self.client.put(customer, data={'name': 'John Smith'})
+        rv, json = self.client.get(customer)
+        self.assertTrue(rv.headers['X-Cache'] == 'MISS')
+        self.assertTrue(json['name'] == 'John Smith')
+
+        rv, json = self.client.get('/api/v1/_stats')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['response_cache']['hits'] == 2)
+
+    def test_ndjson(self):
+        locations = []
+        for name in ('prod1', 'prod2'):
+            rv, json = self.client.post('/api/v1/products/',
+                                        data={'name': name})
+            locations.append(rv.headers['Location'])
+
+        def get_ndjson(url, headers={}):
+            headers = dict(headers, Authorization=self.client.auth,
+                           Accept='application/x-ndjson')
+            with self.app.test_request_context(url, headers=headers):
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = self.app.dispatch_request()
+                rv = self.app.process_response(self.app.make_response(rv))
+                return rv, rv.get_data().decode('utf-8')
+
+        # a cached JSON listing is not served to a client asking for NDJSON
+        rv, json = self.client.get('/api/v1/products/')
+        self.assertTrue('Accept' in rv.vary)
+        json_etag = rv.headers['ETag']
+        rv, body = get_ndjson('/api/v1/products/')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        self.assertTrue('Accept' in rv.vary)
+        self.assertTrue([loads(line) for line in body.splitlines()] ==
+                        locations)
+
+        # both representations have tags of their own
+        self.assertTrue(rv.headers['ETag'] != json_etag)
+        rv, body = get_ndjson('/api/v1/products/',
+                              headers={'If-None-Match': json_etag})
+        self.assertTrue(rv.status_code == 200)
+        rv, body = get_ndjson('/api/v1/products/',
+                              headers={'If-None-Match': rv.headers['ETag']})
+        self.assertTrue(rv.status_code == 304)
+
+    def test_bulk_create(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        rv, json = self.client.get(rv.headers['Location'])
+        orders_url = json['orders_url']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod1'})
+        prod1 = rv.headers['Location']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod2'})
+        prod2 = rv.headers['Location']
+
+        # create two orders with their items in one request
+        rv, json = self.client.post(orders_url, data=[
+            {'date': '2014-01-01T00:00:00Z',
+             'items': [{'product_url': prod1, 'quantity': 2},
+                       {'product_url': prod2, 'quantity': 1}]},
+            {'date': '2014-01-02T00:00:00Z'}])
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(len(json['orders']) == 2)
+        rv, json = self.client.get(json['orders'][0])
+        items_url = json['items_url']
+        rv, json = self.client.get(items_url + '?extended=1')
+        self.assertTrue([(item['product_url'], item['quantity'])
+                         for item in json['items']] == [(prod1, 2), (prod2, 1)])
+
+        # add more items to an order
+        rv, json = self.client.post(items_url, data=[
+            {'product_url': prod1, 'quantity': 3},
+            {'product_url': prod2, 'quantity': 4}])
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(len(json['items']) == 2)
+        rv, json = self.client.get(json['items'][1])
+        self.assertTrue(json['product_url'] == prod2)
+        self.assertTrue(json['quantity'] == 4)
+
+        # all the problems are reported together and nothing is added
+        with self.assertRaises(ValidationError) as e:
+            self.client.post(items_url, data=[
+                {'product_url': prod1},
+                {'product_url': prod1, 'quantity': 1},
+                {'product_url': prod1 + '0', 'quantity': 1},
+                {'product_url': 'http://other.com/', 'quantity': 1},
+                {'product_url': prod1, 'quantity': 'one'}])
+        self.assertTrue(e.exception.args[1] == [
+            'items[0]: Invalid order: missing quantity',
+            'items[2]: Invalid product URL: ' + prod1 + '0',
+            'items[3]: Invalid URL: http://other.com/',
+            'items[4]: Invalid quantity: one'])
+        db.session.rollback()
+        rv, json = self.client.get(items_url)
+        self.assertTrue(len(json['items']) == 4)
+
+    def test_fast_url_for(self):
+        with self.app.test_request_context('/'):
+            for endpoint in ['api.get_customer', 'api.get_customer_orders',
+                             'api.get_order', 'api.get_order_items',
+                             'api.get_item', 'api.get_product']:
+                for id in [1, 42, 1234567]:
+                    self.assertTrue(fast_url_for(endpoint, id=id) ==
+                                    url_for(endpoint, id=id, _external=True))
+            self.assertTrue(
+                fast_url_for('api.get_orders', page=2, per_page=10,
+                             extended=1) ==
+                url_for('api.get_orders', page=2, per_page=10, extended=1,
+                        _external=True))
+
+            # None values are left out, as url_for() does
+            self.assertTrue(
+                fast_url_for('api.get_orders', page=2, per_page=None) ==
+                url_for('api.get_orders', page=2, per_page=None,
+                        _external=True))
+            self.assertTrue(fast_url_for('api.get_orders', page=None) ==
+                            url_for('api.get_orders', _external=True))
+
+        # applications on the same host do not share their templates
+        other = Flask(__name__)
+        other.config['SERVER_NAME'] = self.app.config['SERVER_NAME']
+        other.add_url_rule('/other/<int:id>', 'api.get_customer',
+                           lambda id: '')
+        with other.test_request_context('/'):
+            self.assertTrue(fast_url_for('api.get_customer', id=1) ==
+                            'http://example.com/other/1')
+        with self.app.test_request_context('/'):
+            self.assertTrue(fast_url_for('api.get_customer', id=1) ==
+                            url_for('api.get_customer', id=1, _external=True))
+
+    def test_product_lookups(self):
+        product = Product(name='prod1')
+        db.session.add(product)
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            url = product.get_url()
+
+            # URLs are parsed once, and callers get copies of the results
+            with mock.patch('app.utils._match_fast',
+                            wraps=utils._match_fast) as match:
+                endpoint, args = split_url(url)
+                args['id'] = 0
+                self.assertTrue(split_url(url) ==
+                                ('api.get_product', {'id': product.id}))
+                self.assertTrue(match.call_count == 1)
+
+            # a product is looked up once per request, until it is deleted
+            queries = []
+
+            def before_cursor_execute(conn, cursor, statement, *args):
+                queries.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            try:
+                for i in range(2):
+                    item = Item().import_data({'product_url': url,
+                                               'quantity': 1})
+                    self.assertTrue(item.product_id == product.id)
+                self.assertTrue(len(queries) == 1)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute',
+                             before_cursor_execute)
+            db.session.delete(product)
+            db.session.flush()
+            with self.assertRaises(ValidationError):
+                Item().import_data({'product_url': url, 'quantity': 1})
+            with self.assertRaises(ValidationError):
+                Item.import_many([{'product_url': url, 'quantity': 1}])
+        db.session.rollback()
+
+    def test_summaries(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.get(customer)
+        orders_url = json['orders_url']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod1'})
+        prod1 = rv.headers['Location']
+        rv, json = self.client.post(orders_url, data=[
+            {'date': '2014-01-01T00:00:00Z',
+             'items': [{'product_url': prod1, 'quantity': 2},
+                       {'product_url': prod1, 'quantity': 3}]},
+            {'date': '2014-01-02T00:00:00Z'}])
+        order1, order2 = json['orders']
+        rv, json = self.client.get(order2)
+        rv, json = self.client.post(json['items_url'],
+                                    data={'product_url': prod1, 'quantity': 4})
+        item = rv.headers['Location']
+
+        def totals():
+            rv, json = self.client.get(customer + '/summary')
+            summary = (json['orders'], json['items'], json['units'])
+            rv, json = self.client.get(prod1 + '/sales')
+            sales = (json['items'], json['units'])
+            rv, json = self.client.get(order2 + '/totals')
+            return summary, sales, (json['items'], json['units'])
+
+        self.assertTrue(totals() == ((2, 3, 9), (3, 9), (1, 4)))
+
+        # edits and deletes are applied incrementally
+        rv, json = self.client.put(item, data={'product_url': prod1,
+                                               'quantity': 1})
+        self.assertTrue(totals() == ((2, 3, 6), (3, 6), (1, 1)))
+        rv, json = self.client.delete(order1)
+        self.assertTrue(totals() == ((1, 1, 1), (1, 1), (1, 1)))
+        rv, json = self.client.delete(item)
+        self.assertTrue(totals() == ((1, 0, 0), (0, 0), (0, 0)))
+
+        # a rebuild computes the same values
+        rv, json = self.client.post(order2 + '/items/', data={
+            'product_url': prod1, 'quantity': 5})
+        expected = totals()
+        rebuild()
+        self.assertTrue(totals() == expected)
+
+    def test_sqlite_pragmas(self):
+        app = create_app('testing')
+        app.config.update(SQLITE_SYNCHRONOUS='NORMAL',
+                          SQLITE_BUSY_TIMEOUT=2500, SQLITE_CACHE_SIZE=-4000)
+        engine = db.get_engine(app)
+        self.assertTrue(engine.execute('PRAGMA synchronous').scalar() == 1)
+        self.assertTrue(engine.execute('PRAGMA busy_timeout').scalar() == 2500)
+        self.assertTrue(engine.execute('PRAGMA cache_size').scalar() == -4000)
+
+        # the default configuration leaves the SQLite defaults alone
+        self.assertTrue(db.engine.execute('PRAGMA synchronous').scalar() == 2)
+        engine.dispose()
+
+    def test_sqlite_pool(self):
+        app = create_app('testing')
+        app.config.update(SQLALCHEMY_POOL_SIZE=4, SQLALCHEMY_MAX_OVERFLOW=2,
+                          SQLALCHEMY_POOL_TIMEOUT=5)
+        engine = db.get_engine(app)
+        self.assertTrue(isinstance(engine.pool, QueuePool))
+        self.assertTrue(engine.pool.size() == 4)
+        self.assertTrue(engine.pool._max_overflow == 2)
+        self.assertTrue(engine.execute('SELECT 1').scalar() == 1)
+        engine.dispose()
+
+    def test_read_binds(self):
+        app = create_app('testing')
+        app.config['SQLALCHEMY_READ_BINDS'] = \
+            [app.config['SQLALCHEMY_DATABASE_URI']] * 2
+        db.init_app(app)
+        sessions = db.create_scoped_session()
+        mapper = Customer.__mapper__
+        replicas = [db.get_engine(app, '_read_0'),
+                    db.get_engine(app, '_read_1')]
+
+        # safe requests read from the read binds in turn
+        for replica in replicas:
+            with app.test_request_context('/api/v1/customers/'):
+                session = sessions()
+                self.assertTrue(session.get_bind(mapper) is replica)
+                self.assertTrue(session.get_bind(mapper) is replica)
+                sessions.remove()
+        self.assertTrue(
+            replicas[0].execute('PRAGMA query_only').scalar() == 1)
+
+        # after a write the request sticks to the primary database
+        with app.test_request_context('/api/v1/customers/'):
+            session = sessions()
+            self.assertTrue(session.get_bind(mapper) is replicas[0])
+            session.add(Customer(name='john'))
+            session.flush()
+            self.assertTrue(session.get_bind(mapper) is db.get_engine(app))
+            sessions.remove()
+
+        # other methods always use the primary database
+        with app.test_request_context('/api/v1/customers/', method='POST'):
+            session = sessions()
+            self.assertTrue(session.get_bind(mapper) is db.get_engine(app))
+            sessions.remove()
+        for engine in replicas + [db.get_engine(app)]:
+            engine.dispose()
+
+    def test_profiling(self):
+        # profiling is off unless it is configured
+        rv, json = self.client.get('/api/v1/customers/')
+        self.assertTrue('Server-Timing' not in rv.headers)
+        self.app = create_app('testing')
+        self.app.config['PROFILING'] = True
+        init_profiling(self.app)
+        user = User.query.filter_by(username=self.default_username).first()
+        self.client = TestClient(self.app, user.generate_auth_token(), '')
+
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.get('/api/v1/customers/?extended=1')
+        self.assertTrue(rv.status_code == 200)
+        timing = rv.headers['Server-Timing']
+        for metric in ('auth;', 'view;', 'export;', 'serialize;',
+                       'sql;desc=', 'total;'):
+            self.assertTrue(metric in timing)
+
+        # responses without a version are hashed for their ETag
+        rv, json = self.client.get(customer + '/summary')
+        self.assertTrue('etag;' in rv.headers['Server-Timing'])
+
+        rv, json = self.client.get('/api/v1/_stats')
+        self.assertTrue(rv.status_code == 200)
+        stats = json['requests']['api.get_customers']
+        self.assertTrue(stats['requests'] == 1)
+        self.assertTrue(stats['mean_sql_count'] > 0)
+        self.assertTrue(sum(stats['histogram_ms'].values()) == 1)
+        self.assertTrue(json['requests']['api.new_customer']['requests'] == 1)
+
+        # the statistics require authentication like the rest of the api
+        client = TestClient(self.app, 'bad-token', '')
+        rv, json = client.get('/api/v1/_stats')
+        self.assertTrue(rv.status_code == 401)
+
+    def test_sparse_fieldsets(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.get(customer)
+        rv, json = self.client.post(json['orders_url'],
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        order = rv.headers['Location']
+
+        # single resources
+        rv, json = self.client.get(customer + '?fields=name')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json == {'name': 'john'})
+        rv, json = self.client.get(order + '?fields=self_url,date')
+        self.assertTrue(json == {'self_url': order,
+                                 'date': '2014-01-01T00:00:00Z'})
+        with self.assertRaises(ValidationError):
+            self.client.get(order + '?fields=date,price')
+
+        # the customer row is not loaded to link to it
+        queries = self.capture_queries(order + '?fields=customer_url')
+        self.assertFalse(any('FROM customers' in q for q in queries))
+
+        # the fields select different representations
+        rv, json = self.client.get(customer)
+        etag = rv.headers['ETag']
+        rv, json = self.client.get(customer + '?fields=name',
+                                   headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+
+        # extended listings, pages keep the selected fields
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'susan'})
+        rv, json = self.client.get(
+            '/api/v1/customers/?extended=1&per_page=1&fields=name')
+        self.assertTrue(json['customers'] == [{'name': 'john'}])
+        rv, json = self.client.get(json['pages']['next_url'])
+        self.assertTrue(json['customers'] == [{'name': 'susan'}])
+        rv, json = self.client.get(
+            '/api/v1/customers/?extended=1&after=&fields=self_url')
+        self.assertTrue(json['customers'][0] == {'self_url': customer})
+
+    def test_json_serializer(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        rv, json = self.client.get(rv.headers['Location'])
+        self.assertTrue(json['name'] == 'john')
+        self.assertFalse(b'\n' in rv.data or b', ' in rv.data)
+
+        serializer = create_serializer('stdlib')
+        self.assertTrue(serializer.dumps(
+            {'date': datetime(2014, 1, 1), 'name': 'caf\xe9'}) ==
+            '{"date":"2014-01-01T00:00:00Z","name":"caf\xe9"}'.encode('utf-8'))
+
+    def test_compression(self):
+        for i in range(20):
+            rv, json = self.client.post('/api/v1/customers/',
+                                        data={'name': 'customer'})
+        client = self.app.test_client()
+        url = '/api/v1/customers/?extended=1'
+        headers = {'Authorization': self.client.auth,
+                   'Accept-Encoding': 'gzip'}
+        rv = client.get(url, headers=headers, base_url='http://example.com')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue('Accept-Encoding' in rv.headers['Vary'])
+        body = gzip.decompress(rv.data)
+        self.assertTrue(len(rv.data) < len(body))
+        self.assertTrue(len(loads(body.decode('utf-8'))['customers']) == 20)
+
+        # the compressed body is reused for an unchanged resource
+        compressor = self.app.extensions['compression']
+        self.assertTrue(len(compressor.cache) == 1)
+        rv2 = client.get(url, headers=headers, base_url='http://example.com')
+        self.assertTrue(rv2.data == rv.data)
+        self.assertTrue(len(compressor.cache) == 1)
+
+        # small responses and clients without gzip get plain bodies
+        rv = client.get(url, headers={'Authorization': self.client.auth},
+                        base_url='http://example.com')
+        self.assertFalse('Content-Encoding' in rv.headers)
+        rv = client.get('/api/v1/customers/1', headers=headers,
+                        base_url='http://example.com')
+        self.assertFalse('Content-Encoding' in rv.headers)
+
+    def test_batch(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+
+        rv, json = self.client.post('/api/v1/batch', data=[
+            {'path': customer},
+            {'method': 'POST', 'path': '/api/v1/products/',
+             'body': {'name': 'prod'}},
+            {'path': '/api/v1/customers/?extended=1'},
+            {'path': '/api/v1/customers/999'},
+            {'path': '/get-auth-token'}])
+        self.assertTrue(rv.status_code == 200)
+        responses = json['responses']
+        self.assertTrue([r['status'] for r in responses] ==
+                        [200, 201, 200, 404, 404])
+        self.assertTrue(responses[0]['body']['name'] == 'john')
+        self.assertTrue('ETag' in responses[0]['headers'])
+        product = responses[1]['headers']['Location']
+        rv, json = self.client.get(product)
+        self.assertTrue(json['name'] == 'prod')
+
+        # sub-requests run the request handlers, with a g of their own
+        seen = []
+
+        def before_request():
+            seen.append(getattr(g, 'seen', False))
+            g.seen = True
+
+        self.app.before_request(before_request)
+        try:
+            rv, json = self.client.post('/api/v1/batch', data=[
+                {'path': customer},
+                {'path': customer,
+                 'headers': {'Authorization': 'Basic Ym9ndXM6'}}])
+        finally:
+            self.app.before_request_funcs[None].remove(before_request)
+        self.assertTrue(seen == [False, False, False])
+        self.assertTrue([r['status'] for r in json['responses']] ==
+                        [200, 401])
+
+        # invalid batches are rejected as a whole
+        with self.assertRaises(ValidationError):
+            self.client.post('/api/v1/batch', data=[{'method': 'GET'}])
+        # and nested batches fail on their own
+        rv, json = self.client.post('/api/v1/batch', data=[
+            {'method': 'POST', 'path': '/api/v1/batch', 'body': []}])
+        self.assertTrue(json['responses'][0]['status'] == 400)
+
+        # in a transaction, a failed request rolls back the others
+        rv, json = self.client.post('/api/v1/batch', data={
+            'transaction': True, 'requests': [
+                {'method': 'POST', 'path': '/api/v1/products/',
+                 'body': {'name': 'prod2'}},
+                {'method': 'POST', 'path': customer + '/orders/',
+                 'body': {'date': '2014-01-01T00:00:00Z', 'items': [
+                     {'product_url': product, 'quantity': 'many'}]}},
+                {'path': customer}]})
+        self.assertTrue(json['committed'] is False)
+        self.assertTrue([r['status'] for r in json['responses']] == [201, 400])
+        rv, json = self.client.get('/api/v1/products/')
+        self.assertTrue(json['products'] == [product])
+        rv, json = self.client.get(customer + '/orders/')
+        self.assertTrue(json['orders'] == [])
+
+        rv, json = self.client.post('/api/v1/batch', data={
+            'transaction': True, 'requests': [
+                {'method': 'POST', 'path': '/api/v1/products/',
+                 'body': {'name': 'prod2'}},
+                {'method': 'POST', 'path': customer + '/orders/',
+                 'body': {'date': '2014-01-01T00:00:00Z'}}]})
+        self.assertTrue(json['committed'] is True)
+        self.assertTrue([r['status'] for r in json['responses']] == [201, 201])
+        db.session.remove()
+        rv, json = self.client.get('/api/v1/products/')
+        self.assertTrue(len(json['products']) == 2)
+        rv, json = self.client.get(customer + '/orders/')
+        self.assertTrue(len(json['orders']) == 1)
+
+    def test_change_feed(self):
+        rv, json = self.client.get('/api/v1/changes')
+        cursor = json['pages']['cursor']
+        self.assertTrue(json['changes'] == [])
+
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+        rv, json = self.client.post(customer + '/orders/', data={
+            'date': '2014-01-01T00:00:00Z',
+            'items': [{'product_url': product, 'quantity': 2}]})
+        order = rv.headers['Location']
+        rv, json = self.client.get(order)
+        rv, json = self.client.get(json['items_url'])
+        item = json['items'][0]
+
+        # changes come in commit order
+        rv, json = self.client.get('/api/v1/changes?since={0}'.format(cursor))
+        self.assertTrue([(c['url'], c['operation']) for c in json['changes']]
+                        == [(customer, 'created'), (product, 'created'),
+                            (order, 'created'), (item, 'created')])
+        cursor = json['pages']['cursor']
+
+        # only the last change of a resource is kept, and deletions leave
+        # a tombstone
+        rv, json = self.client.put(customer, data={'name': 'John'})
+        rv, json = self.client.put(customer, data={'name': 'John Smith'})
+        rv, json = self.client.delete(order)
+        rv, json = self.client.get(
+            '/api/v1/changes?extended=1&since={0}'.format(cursor))
+        changes = json['changes']
+        self.assertTrue([(c['url'], c['operation']) for c in changes] ==
+                        [(customer, 'updated'), (order, 'deleted'),
+                         (item, 'deleted')])
+        self.assertTrue(changes[0]['data']['name'] == 'John Smith')
+        self.assertFalse('data' in changes[1])
+
+        # collections give the changes to their members
+        rv, json = self.client.get('/api/v1/orders/?since=0')
+        self.assertTrue([(c['url'], c['operation']) for c in json['orders']]
+                        == [(order, 'deleted')])
+        rv, json = self.client.get(customer + '/orders/?since=0')
+        self.assertTrue(len(json['orders']) == 1)
+        rv, json = self.client.get('/api/v1/customers/?since=0&per_page=1')
+        self.assertTrue(len(json['customers']) == 1)
+        self.assertTrue(json['pages']['next_url'] is None)
+        with self.assertRaises(ValidationError):
+            self.client.get('/api/v1/changes?since=abc')
+
+    def test_includes(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        products = []
+        for name in ('prod1', 'prod2'):
+            rv, json = self.client.post('/api/v1/products/',
+                                        data={'name': name})
+            products.append(rv.headers['Location'])
+        rv, json = self.client.post(customer + '/orders/', data={
+            'date': '2014-01-01T00:00:00Z',
+            'items': [{'product_url': products[0], 'quantity': 1},
+                      {'product_url': products[1], 'quantity': 2},
+                      {'product_url': products[0], 'quantity': 3}]})
+        order = rv.headers['Location']
+
+        # one query per path, whatever the number of resources it reaches
+        url = order + '?include=customer,items,items.product'
+        self.assertTrue(len([q for q in self.capture_queries(url)
+                             if 'FROM items' in q or 'FROM products' in q])
+                        == 2)
+
+        # related resources are embedded once each
+        rv, json = self.client.get(url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['self_url'] == order)
+        included = json['included']
+        self.assertTrue([c['self_url'] for c in included['customers']] ==
+                        [customer])
+        self.assertTrue([i['quantity'] for i in included['items']] ==
+                        [1, 2, 3])
+        self.assertTrue([p['self_url'] for p in included['products']] ==
+                        products)
+
+        # primary resources are not repeated, and listings include the
+        # resources related to the page
+        item = included['items'][0]['self_url']
+        rv, json = self.client.get(item + '?include=order.items')
+        self.assertTrue(len(json['included']['items']) == 2)
+        self.assertTrue(item not in [i['self_url']
+                                     for i in json['included']['items']])
+        rv, json = self.client.get(
+            '/api/v1/orders/?include=customer&fields=self_url')
+        self.assertTrue(json['orders'] == [order])
+        self.assertTrue(len(json['included']['customers']) == 1)
+        rv, json = self.client.get(customer + '/orders/?include=items&after=')
+        self.assertTrue(len(json['included']['items']) == 3)
+
+        # embedded resources are not served stale
+        rv, json = self.client.get(url)
+        etag = rv.headers['ETag']
+        rv, json = self.client.put(products[1], data={'name': 'product2'})
+        rv, json = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['included']['products'][1]['name'] == 'product2')
+
+        with self.assertRaises(ValidationError):
+            self.client.get(order + '?include=items.customer')
+
+    def test_filters(self):
+        customers = []
+        for name in ('John Smith', 'Jane Doe'):
+            rv, json = self.client.post('/api/v1/customers/',
+                                        data={'name': name})
+            customers.append(rv.headers['Location'])
+        products = []
+        for name in ('Red Apple', 'Green Apple'):
+            rv, json = self.client.post('/api/v1/products/',
+                                        data={'name': name})
+            products.append(rv.headers['Location'])
+        orders = []
+        for customer, date, product in (
+                (customers[0], '2014-01-01T00:00:00Z', products[0]),
+                (customers[0], '2014-02-01T00:00:00Z', products[1]),
+                (customers[1], '2014-03-01T00:00:00Z', products[0])):
+            rv, json = self.client.post(customer + '/orders/', data={
+                'date': date,
+                'items': [{'product_url': product, 'quantity': 1},
+                          {'product_url': products[1], 'quantity': 5}]})
+            orders.append(rv.headers['Location'])
+        customer_id = customers[0].rsplit('/', 1)[1]
+        product_id = products[0].rsplit('/', 1)[1]
+
+        # searches match the start of the words in names, and follow renames
+        rv, json = self.client.get('/api/v1/customers/?q=smi')
+        self.assertTrue(json['customers'] == [customers[0]])
+        rv, json = self.client.get('/api/v1/products/?q=appl')
+        self.assertTrue(json['products'] == products)
+        rv, json = self.client.put(products[1], data={'name': 'Green Pear'})
+        rv, json = self.client.get('/api/v1/products/?q=apple')
+        self.assertTrue(json['products'] == [products[0]])
+        rv, json = self.client.get('/api/v1/products/?q=green+pe')
+        self.assertTrue(json['products'] == [products[1]])
+
+        # orders by customer, date range and product
+        rv, json = self.client.get(
+            '/api/v1/orders/?customer_id={0}'.format(customer_id))
+        self.assertTrue(json['orders'] == orders[:2])
+        rv, json = self.client.get('/api/v1/orders/?date_from=2014-01-15'
+                                   '&date_to=2014-03-01')
+        self.assertTrue(json['orders'] == orders[1:2])
+        rv, json = self.client.get(
+            '/api/v1/orders/?product_id={0}&after='.format(product_id))
+        self.assertTrue(json['orders'] == [orders[0], orders[2]])
+
+        # items by quantity and product
+        rv, json = self.client.get(orders[0])
+        items_url = json['items_url']
+        rv, json = self.client.get(items_url + '?min_quantity=2&extended=1')
+        self.assertTrue([i['quantity'] for i in json['items']] == [5])
+        rv, json = self.client.get(
+            items_url + '?product_id={0}&max_quantity=1'.format(product_id))
+        self.assertTrue(len(json['items']) == 1)
+
+        # links to other pages keep the filters
+        rv, json = self.client.get(
+            '/api/v1/orders/?customer_id={0}&per_page=1'.format(customer_id))
+        self.assertTrue(json['pages']['total'] == 2)
+        rv, json = self.client.get(json['pages']['next_url'])
+        self.assertTrue(json['orders'] == orders[1:2])
+
+        # other arguments are not forwarded, even when their names collide
+        # with those of the link builder
+        rv, json = self.client.get('/api/v1/orders/?per_page=1&endpoint=x'
+                                   '&id=3&unknown=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue('endpoint' not in json['pages']['next_url'])
+        self.assertTrue('unknown' not in json['pages']['next_url'])
+
+        with self.assertRaises(ValidationError):
+            self.client.get('/api/v1/orders/?date_from=yesterday-ish')
+        with self.assertRaises(ValidationError):
+            self.client.get('/api/v1/orders/?customer_id=abc')
+
+        # dates without a timezone are in UTC, in orders and in filters,
+        # whatever the timezone of the server
+        with mock.patch.dict(os.environ, {'TZ': 'America/New_York'}):
+            time.tzset()
+            try:
+                rv, json = self.client.post(customers[1] + '/orders/',
+                                            data={'date': '2014-04-01'})
+                order = rv.headers['Location']
+                rv, json = self.client.get(order)
+                self.assertTrue(json['date'] == '2014-04-01T00:00:00Z')
+                rv, json = self.client.get(
+                    '/api/v1/orders/?date_from=2014-04-01')
+                self.assertTrue(json['orders'] == [order])
+            finally:
+                time.tzset()
+
+    def test_search_without_fts5(self):
+        # SQLite libraries built without FTS5 get no search indexes, and
+        # searches scan the names instead
+        db.drop_all()
+        with mock.patch('app.search._fts5', False):
+            db.create_all()
+            self.assertFalse(db.engine.has_table('customers_fts'))
+            u = User(username=self.default_username)
+            u.set_password(self.default_password)
+            db.session.add(u)
+            db.session.commit()
+            for name in ('John Smith', 'Jane Doe', 'Joe Under_score'):
+                rv, json = self.client.post('/api/v1/customers/',
+                                            data={'name': name})
+                self.assertTrue(rv.status_code == 201)
+            rv, json = self.client.get('/api/v1/customers/?q=smi')
+            self.assertTrue(len(json['customers']) == 1)
+            rv, json = self.client.get('/api/v1/customers/?q=j+d')
+            self.assertTrue(len(json['customers']) == 1)
+            rv, json = self.client.get('/api/v1/customers/?q=under_s')
+            self.assertTrue(len(json['customers']) == 1)
+            rv, json = self.client.get('/api/v1/customers/?q=mith')
+            self.assertTrue(json['customers'] == [])
+
+    def test_group_commit(self):
+        self.app.extensions['group_commit'] = GroupCommitter(
+            self.app, window=0.5, size=4)
+        commits = []
+        inserts = []
+
+        def commit(conn):
+            commits.append(conn)
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO customers'):
+                inserts.append(statement)
+
+        # concurrent writes share a commit, and each of them gets its own
+        # response or error
+        names = ['john', None, 'jane', 'susan']
+        results = [None] * len(names)
+
+        def post(i):
+            try:
+                data = {'name': names[i]} if names[i] else {'id': 1}
+                rv, json = self.client.post('/api/v1/customers/', data=data)
+                results[i] = rv.status_code
+            except ValidationError:
+                results[i] = 'invalid'
+
+        event.listen(db.engine, 'commit', commit)
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            threads = [threading.Thread(target=post, args=(i,))
+                       for i in range(len(names))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            event.remove(db.engine, 'commit', commit)
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertTrue(results == [201, 'invalid', 201, 201])
+        self.assertTrue(len(commits) == 1)
+        # the failed write is rolled back alone, the others are not rerun
+        self.assertTrue(len(inserts) == 3)
+
+        # the writes are committed before the requests get their response
+        rv, json = self.client.get('/api/v1/customers/?extended=1')
+        self.assertTrue(sorted(c['name'] for c in json['customers']) ==
+                        ['jane', 'john', 'susan'])
+        rv, json = self.client.put(json['customers'][0]['self_url'],
+                                   data={'name': 'John Smith'})
+        self.assertTrue(rv.status_code == 200)
+
+    def test_group_commit_failures(self):
+        committer = self.app.extensions['group_commit'] = GroupCommitter(
+            self.app, window=0, size=4, timeout=0.2)
+
+        # requests waiting on a writer that dies get its error, and the
+        # next write starts a new writer
+        with mock.patch.object(committer, '_commit', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                self.client.post('/api/v1/customers/', data={'name': 'john'})
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'jane'})
+        self.assertTrue(rv.status_code == 201)
+
+        # requests give up on writes that do not start in time, and those
+        # writes are dropped
+        commit = committer._commit
+
+        def slow_commit(writes):
+            time.sleep(0.5)
+            commit(writes)
+
+        with mock.patch.object(committer, '_commit', side_effect=slow_commit):
+            with self.assertRaises(ServiceUnavailable):
+                self.client.post('/api/v1/customers/', data={'name': 'susan'})
+            time.sleep(0.5)
+        rv, json = self.client.get('/api/v1/customers/?extended=1')
+        self.assertTrue([c['name'] for c in json['customers']] == ['jane'])
+
+
+class TestRateLimit(unittest.TestCase):
+    def backends(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return [MemRateLimit(),
+                SQLiteRateLimit(os.path.join(path, 'rate-limit.sqlite'))]
+
+    def test_backends(self):
+        with self.assertRaises(TypeError):
+            RateLimitBackend()
+        with self.assertRaises(ValueError):
+            create_limiter({'RATELIMIT_BACKEND': 'redis'})
+
+        for backend in self.backends():
+            results = [backend.is_allowed('get/1.2.3.4', 2, 3600)
+                       for i in range(3)]
+            self.assertTrue([r[:2] for r in results] ==
+                            [(True, 1), (True, 0), (False, 0)])
+            self.assertTrue(backend.is_allowed('get/5.6.7.8', 2, 3600)[0])
+
+            # counters are dropped once their windows are over
+            backend.cleanup(results[0][2] + 2 * 3600)
+            if isinstance(backend, MemRateLimit):
+                self.assertTrue(backend.counters == {})
+                self.assertTrue(backend.expirations == [])
+            else:
+                self.assertTrue(backend.connection().execute(
+                    'SELECT count(*) FROM rate_limits').fetchone()[0] == 0)
+
+    def test_rate_limit(self):
+        app = create_app('testing')
+        app.config.update(TESTING=False, RATELIMIT_REQUESTS=2,
+                          RATELIMIT_PERIOD=3600, RATELIMIT_BACKEND='sqlite')
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            u = User(username='dave')
+            u.set_password('cat')
+            db.session.add(u)
+            db.session.commit()
+            client = TestClient(app, u.generate_auth_token(), '')
+            statuses = []
+            for i in range(3):
+                rv, json = client.get('/api/v1/customers/')
+                statuses.append(rv.status_code)
+            self.assertTrue(statuses == [200, 200, 429])
+            self.assertTrue(rv.headers['X-RateLimit-Limit'] == '2')
+            self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '0')
+            # without a path the sqlite backend keeps counters in memory
+            self.assertTrue(isinstance(app.extensions['rate_limiter'],
+                                       MemRateLimit))
+            db.session.remove()
+            db.drop_all()
+
+    def test_sliding_window(self):
+        backend = MemRateLimit()
+        # half of the previous window still counts
+        counter, result = backend.hit(150, 6, 100, (0, 0, 10))
+        self.assertTrue(counter == (100, 10, 1))
+        self.assertTrue(result == (True, 0, 200))
+        counter, result = backend.hit(150, 6, 100, counter)
+        self.assertTrue(result == (False, 0, 200))
+        # older windows do not
+        counter, result = backend.hit(300, 6, 100, counter)
+        self.assertTrue(counter == (300, 0, 1))
+        self.assertTrue(result == (True, 5, 400))
+
+
+class TestHTTPServer(unittest.TestCase):
+    def start(self, wsgi_app, **limits):
+        """Serve a WSGI application from a thread, returning its port."""
+        loop = asyncio.new_event_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        sock.setblocking(False)
+        asgi_app = WsgiToAsgi(wsgi_app, threads=2)
+        server = HTTPServer(asgi_app, loop)
+        vars(server).update(limits)
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(server.start(sock))
+            started.set()
+            loop.run_forever()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        started.wait()
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(server.drain(1), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(5)
+            loop.close()
+            asgi_app.executor.shutdown(wait=False)
+        self.addCleanup(stop)
+        return sock.getsockname()[1]
+
+    def send(self, port, data):
+        """Send raw bytes and return what the server answers until it
+        closes the connection."""
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        try:
+            client.sendall(data)
+            chunks = []
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        finally:
+            client.close()
+
+    def echo(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body) + 2))])
+        return [b'ok' + body]
+
+    def test_keep_alive(self):
+        port = self.start(self.echo)
+        connection = HTTPConnection('127.0.0.1', port, timeout=5)
+        for body in (b'a', b'bc'):
+            connection.request('POST', '/', body=body)
+            rv = connection.getresponse()
+            self.assertTrue(rv.status == 200)
+            self.assertTrue(rv.read() == b'ok' + body)
+        connection.close()
+
+    def test_limits(self):
+        port = self.start(self.echo, max_headers=3, max_body_size=10,
+                          read_timeout=0.2)
+        rv = self.send(port, b'GET / HTTP/1.1\r\n' +
+                       b''.join('X-{0}: 1\r\n'.format(i).encode('ascii')
+                                for i in range(5)) + b'\r\n')
+        self.assertTrue(rv.startswith(b'HTTP/1.1 431 '))
+        rv = self.send(port, b'POST / HTTP/1.1\r\nContent-Length: 11\r\n'
+                       b'\r\n' + b'x' * 11)
+        self.assertTrue(rv.startswith(b'HTTP/1.1 413 '))
+        rv = self.send(port, b'POST / HTTP/1.1\r\n'
+                       b'Transfer-Encoding: chunked\r\n\r\n'
+                       b'8\r\nxxxxxxxx\r\n8\r\nxxxxxxxx\r\n0\r\n\r\n')
+        self.assertTrue(rv.startswith(b'HTTP/1.1 413 '))
+
+        # requests that stall are dropped
+        rv = self.send(port, b'GET / HTTP/1.1\r\n')
+        self.assertTrue(rv == b'')
+
+    def test_expect_continue(self):
+        port = self.start(self.echo, max_body_size=10)
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        try:
+            # the body is only sent once the server asks for it
+            client.sendall(b'POST / HTTP/1.1\r\nContent-Length: 2\r\n'
+                           b'Expect: 100-continue\r\nConnection: close\r\n'
+                           b'\r\n')
+            self.assertTrue(client.recv(65536) ==
+                            b'HTTP/1.1 100 Continue\r\n\r\n')
+            client.sendall(b'ab')
+            rv = b''
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                rv += chunk
+            self.assertTrue(rv.startswith(b'HTTP/1.1 200 '))
+            self.assertTrue(rv.endswith(b'\r\n\r\nokab'))
+        finally:
+            client.close()
+
+        # bodies that are too large are refused without asking for them
+        rv = self.send(port, b'POST / HTTP/1.1\r\nContent-Length: 11\r\n'
+                       b'Expect: 100-continue\r\n\r\n')
+        self.assertTrue(rv.startswith(b'HTTP/1.1 413 '))
+        rv = self.send(port, b'POST / HTTP/1.1\r\nContent-Length: 2\r\n'
+                       b'Expect: something-else\r\n\r\n')
+        self.assertTrue(rv.startswith(b'HTTP/1.1 417 '))
+
+    def test_application_error(self):
+        def fail(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+
+            def generate():
+                yield b'partial'
+                if environ['PATH_INFO'] == '/fail':
+                    raise RuntimeError('failed while streaming')
+            return generate()
+
+        port = self.start(fail)
+        errors = []
+        loop_handler = mock.patch('asyncio.BaseEventLoop.'
+                                  'call_exception_handler',
+                                  side_effect=errors.append)
+        with loop_handler:
+            # a failure after the response started closes the connection,
+            # without the end of the chunked body
+            rv = self.send(port, b'GET /fail HTTP/1.1\r\n\r\n')
+        self.assertTrue(rv.startswith(b'HTTP/1.1 200 '))
+        self.assertTrue(b'partial' in rv)
+        self.assertFalse(rv.endswith(b'0\r\n\r\n'))
+        self.assertTrue(isinstance(errors[0]['exception'], RuntimeError))
+
+        # and the server goes on serving
+        connection = HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('GET', '/')
+        rv = connection.getresponse()
+        self.assertTrue(rv.status == 200 and rv.read() == b'partial')
+        connection.close()
+
+    def test_client_disconnect(self):
+        closed = threading.Event()
+
+        def stream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+
+            def generate():
+                try:
+                    while True:
+                        yield b'x' * 65536
+                finally:
+                    closed.set()
+            return generate()
+
+        # the view stops streaming when its client goes away
+        port = self.start(stream)
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(client.recv(65536).startswith(b'HTTP/1.1 200 '))
+        client.close()
+        self.assertTrue(closed.wait(5))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_api_benchmark(self):
+        from benchmarks.api.runner import run, compare
+        from benchmarks.api.seed import seed
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(path, 'bench.sqlite')
+        # the clients send the address of the server as their host
+        app.config['SERVER_NAME'] = None
+        logger = logging.getLogger('werkzeug')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+
+        # a tiny run of the harness replays every request without errors
+        sizes = {'customers': 5, 'products': 5, 'orders': 20, 'items': 50}
+        token = seed(app, **sizes)
+        report = run(app, token, sizes, 2, 25, 0)
+        self.assertTrue(report['total']['requests'] > 0)
+        self.assertTrue(report['total']['errors'] == 0)
+        self.assertTrue(compare(report, report, 0.2)['regressions'] == [])
+        with app.app_context():
+            db.get_engine(app).dispose()